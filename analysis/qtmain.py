@@ -32,8 +32,11 @@ def main():
     ui.mediaPlayer.setVideoOutput(ui.video_window)
     ui.play_button.setEnabled(True)
 
-    file = '/Volumes/groups/trc/data/Brezovec/VR Arena/exp-20181104-162518/raw_gate_data.txt'
-    data = np.genfromtxt(file, max_rows=100)
+    file = '/Volumes/groups/trc/data/Brezovec/VR Arena/exp-20181104-162518/raw_gate_data.npy'
+    if file.endswith('.npy'):
+        data = np.load(file, mmap_mode='r')[:100]
+    else:
+        data = np.genfromtxt(file, max_rows=100)
     #data = np.transpose(data)
     #data.astype(np.int8)
     #print(np.dtype(data))
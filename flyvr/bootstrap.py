@@ -0,0 +1,72 @@
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flyvr.util import serial_port_registry
+
+class RigBootstrap:
+    # Creates devices concurrently.  Most of the startup time of a device is spent waiting (serial
+    # port resets, first camera grab), so running the constructors on separate threads brings the
+    # total startup time down to that of the slowest device.
+    #
+    # A factory can wait for another device with result(name), as long as there are enough
+    # workers for every device.
+    def __init__(self, max_workers=16):
+        # list the serial ports once up front rather than once per device
+        serial_port_registry(refresh=True)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+        self.init_times = {}
+        self.start_t = time()
+
+    def add(self, name, factory):
+        self.futures[name] = self.executor.submit(self.run, name, factory)
+
+    def run(self, name, factory):
+        t0 = time()
+        try:
+            return factory()
+        finally:
+            self.init_times[name] = time() - t0
+
+    def result(self, name):
+        return self.futures[name].result()
+
+    def wait(self):
+        # returns a dictionary of the created devices, raising if any of them failed.  In that
+        # case the devices that were created are closed first, so that no serial port or camera
+        # is left open
+        results = {}
+        errors = []
+        for name, future in self.futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors.append('{}: {}'.format(name, e))
+
+        self.executor.shutdown()
+        self.report()
+
+        if errors:
+            self.close(results)
+            raise Exception('Device startup failed ({}).'.format('; '.join(errors)))
+
+        return results
+
+    def close(self, devices):
+        # devices haven't been started yet, so closing releases their hardware
+        for name, device in devices.items():
+            close = getattr(device, 'close', None)
+            if close is None:
+                continue
+            try:
+                close()
+                print('Closed {}.'.format(name))
+            except Exception as e:
+                print('Could not close {}: {}'.format(name, e))
+
+    def report(self):
+        for name in self.futures:
+            if name in self.init_times:
+                print('  {}: {:0.2f} s'.format(name, self.init_times[name]))
+        print('Devices started in {:0.2f} s'.format(time() - self.start_t))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Packs the logs of a finished trial into one file, trial.npz, next to them.  Each log becomes
+# a group of typed columns ('cam/t', 'cam/x', ...) stored uncompressed, with all times in
+# seconds from a common origin (meta['t0'], wall-clock time).  load_bundle memory-maps the
+# columns straight out of the file, so loading a trial does not parse any text.
+#
+# example:
+#   python -m flyvr.bundle /mnt/fly-data/FlyVR/exp-.../trial-1-...
+
+import os
+import os.path
+import json
+import struct
+import zipfile
+import argparse
+import numpy as np
+
+from time import time
+
+BUNDLE_NAME = 'trial.npz'
+BUNDLE_VERSION = 1
+
+# numeric logs: file name -> (stream name, column names)
+CSV_LOGS = {
+    'cam.txt': ('cam', ['t', 'x', 'y', 'angle']),
+    'cnc.txt': ('cnc', ['t', 'x', 'y']),
+    'temp.txt': ('temp', ['t', 'temp', 'humd'])
+}
+
+def read_csv_log(path, columns):
+    data = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+    if data.size == 0:
+        data = np.zeros((0, len(columns)))
+    return {name: np.ascontiguousarray(data[:, k]) for k, name in enumerate(columns)}
+
+def read_opto_log(path):
+    # lines are 'kind, t, value...' with a value that depends on the kind
+    kinds, times, values = [], [], []
+    with open(path, 'r') as f:
+        next(f, None)
+        for line in f:
+            parts = [part.strip() for part in line.strip().split(',')]
+            if len(parts) < 2:
+                continue
+            kinds.append(parts[0])
+            times.append(float(parts[1]))
+            values.append(','.join(parts[2:]))
+    return {'t': np.array(times, dtype=float), 'kind': np.array(kinds, dtype=bytes),
+            'value': np.array(values, dtype=bytes)}
+
+def read_stim_log(path):
+    times, events, params = [], [], []
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            times.append(event['t'])
+            events.append(event['event'])
+            params.append(json.dumps(event['params']))
+    return {'t': np.array(times, dtype=float), 'event': np.array(events, dtype=bytes),
+            'params': np.array(params, dtype=bytes)}
+
+def read_trial(trial_dir):
+    # returns {stream: {column: array}} for the logs found in trial_dir
+    streams = {}
+    for fname, (stream, columns) in CSV_LOGS.items():
+        path = os.path.join(trial_dir, fname)
+        if os.path.isfile(path):
+            streams[stream] = read_csv_log(path, columns)
+
+    path = os.path.join(trial_dir, 'opto.txt')
+    if os.path.isfile(path):
+        streams['opto'] = read_opto_log(path)
+
+    path = os.path.join(trial_dir, 'stimuli.jsonl')
+    if os.path.isfile(path):
+        streams['stim'] = read_stim_log(path)
+
+    return streams
+
+def bundle_trial(trial_dir, fname=BUNDLE_NAME):
+    # writes trial_dir/fname and returns its path
+    t_start = time()
+    streams = read_trial(trial_dir)
+
+    # common time origin: the earliest time in any log
+    first = [columns['t'][0] for columns in streams.values() if len(columns['t']) > 0]
+    t0 = min(first) if first else 0.0
+
+    # trial number and start time, written when the trial started
+    info = {}
+    if os.path.isfile(os.path.join(trial_dir, 'trial.json')):
+        with open(os.path.join(trial_dir, 'trial.json'), 'r') as f:
+            info = json.load(f)
+
+    meta = {'version': BUNDLE_VERSION,
+            'trial': os.path.basename(os.path.normpath(trial_dir)),
+            'start_t': info.get('start_t'),
+            't0': t0,
+            'streams': {},
+            'video': 'cam_compr.mkv' if os.path.isfile(os.path.join(trial_dir, 'cam_compr.mkv')) else None}
+
+    path = os.path.join(trial_dir, fname)
+    tmp_path = path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for stream, columns in streams.items():
+            columns['t'] = columns['t'] - t0
+            meta['streams'][stream] = {'columns': list(columns.keys()), 'length': len(columns['t'])}
+            for name, data in columns.items():
+                with zf.open('{}/{}.npy'.format(stream, name), 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.ascontiguousarray(data), allow_pickle=False)
+
+        zf.writestr('meta.json', json.dumps(meta, indent=2))
+
+    # the bundle only appears once it is complete
+    os.replace(tmp_path, path)
+
+    print('Bundled {} in {:0.2f} s'.format(meta['trial'], time() - t_start))
+    return path
+
+class TrialBundle:
+    # Columns of a bundle, memory-mapped on access: bundle['cam/t'], bundle.stream('cam')
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+
+        with zipfile.ZipFile(path, 'r') as zf:
+            self.meta = json.loads(zf.read('meta.json').decode('utf-8'))
+            infos = zf.infolist()
+
+        with open(path, 'rb') as f:
+            for info in infos:
+                if not info.filename.endswith('.npy'):
+                    continue
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise Exception('Bundle member {} is compressed.'.format(info.filename))
+
+                # the member data follows its local file header
+                f.seek(info.header_offset)
+                header = f.read(30)
+                name_len, extra_len = struct.unpack('<HH', header[26:30])
+                data_offset = info.header_offset + 30 + name_len + extra_len
+
+                # read the .npy header to find the array
+                f.seek(data_offset)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                self.offsets[info.filename[:-len('.npy')]] = (f.tell(), shape, fortran_order, dtype)
+
+        self.cache = {}
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            offset, shape, fortran_order, dtype = self.offsets[key]
+            if int(np.prod(shape)) == 0:
+                self.cache[key] = np.zeros(shape, dtype=dtype)
+            else:
+                self.cache[key] = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                                            order='F' if fortran_order else 'C')
+        return self.cache[key]
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def keys(self):
+        return self.offsets.keys()
+
+    @property
+    def streams(self):
+        return list(self.meta['streams'].keys())
+
+    def stream(self, name):
+        return {column: self['{}/{}'.format(name, column)] for column in self.meta['streams'][name]['columns']}
+
+def load_bundle(path):
+    # path is either a bundle file or a trial directory containing one
+    if os.path.isdir(path):
+        path = os.path.join(path, BUNDLE_NAME)
+    return TrialBundle(path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack FlyVR trial logs into one bundle per trial.')
+    parser.add_argument('trial_dirs', nargs='+', help='trial directories')
+    args = parser.parse_args()
+
+    for trial_dir in args.trial_dirs:
+        bundle_trial(trial_dir)
+
+if __name__ == '__main__':
+    main()
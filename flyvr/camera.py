@@ -1,24 +1,88 @@
-import cv2
 import copy
 import numpy as np
 import sys
 
-from pypylon import pylon
-from math import pi, sqrt, hypot
-from time import time
+from math import pi, sqrt, hypot, ceil
+from time import time, sleep
 from threading import Lock
 import numpy as np
 
-from flyvr.service import Service
+from flyvr.service import Service, PreparedLogging
+from flyvr.util import lazy_import
+from flyvr.writer import disk_writer
+
+# camera SDKs are only loaded once a camera is actually used
+cv2 = lazy_import('cv2')
+pylon = lazy_import('pypylon.pylon')
+
+# frame rate written into the trial videos
+VIDEO_FPS = 124.2
+
+class FrameRing:
+    # Fixed-size FIFO of recent frames (grayscale) and tracking records (t, x, y, angle, with
+    # x = nan when no fly was found).  The arrays are allocated once, on the first frame, with
+    # as many slots as fit in both the duration and the memory cap.
+    def __init__(self, duration, max_bytes, fps=VIDEO_FPS):
+        self.duration = duration
+        self.max_bytes = max_bytes
+        self.fps = fps
+
+        self.frames = None
+        self.records = None
+        self.size = 0
+        self.head = 0
+        self.count = 0
+
+    def allocate(self, shape):
+        frame_bytes = int(np.prod(shape))
+        self.size = max(min(int(self.duration*self.fps), int(self.max_bytes // frame_bytes)), 1)
+        self.frames = np.zeros((self.size, ) + tuple(shape), dtype=np.uint8)
+        self.records = np.zeros((self.size, 4), dtype=float)
+        self.head = 0
+        self.count = 0
+        print('Pre-trigger buffer: {} frames ({:0.1f} MB)'.format(self.size, self.frames.nbytes/1e6))
 
-from vrcam.train_angle import AnglePredictor
-from vrcam.finder import FlyFinder
-from vrcam.image import bound_point
+    @property
+    def full(self):
+        return self.count == self.size
+
+    def push(self, t, fly, frame):
+        # frame is the BGR save frame; its first channel holds the grayscale image
+        if self.frames is None or self.frames.shape[1:] != frame.shape[:2]:
+            self.allocate(frame.shape[:2])
+
+        if self.full:
+            self.pop()
 
-class CamThread(Service):
-    def __init__(self, defaultThresh=150, maxTime=12e-3, bufX=200, bufY=200):
+        idx = (self.head + self.count) % self.size
+        np.copyto(self.frames[idx], frame[:, :, 0])
+        if fly is not None:
+            self.records[idx] = (t, fly.centerX, fly.centerY, fly.angle)
+        else:
+            self.records[idx] = (t, np.nan, np.nan, np.nan)
+        self.count += 1
+
+    def oldest(self):
+        return self.records[self.head], self.frames[self.head]
+
+    def pop(self):
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+class CamThread(PreparedLogging, Service):
+    # Before a trial, the last pretrigger_duration seconds of frames (at most pretrigger_max_bytes)
+    # are kept in a FrameRing.  When logging starts they are written ahead of the live frames,
+    # drain_rate of them per camera frame, so that the fly's arrival is recorded without the
+    # camera loop stalling on a large write.  The drain pauses while the video queue is full;
+    # frames are only dropped (together with their cam.txt rows) if the ring overflows meanwhile.
+    def __init__(self, defaultThresh=150, maxTime=12e-3, bufX=200, bufY=200, angle_predictor=None,
+                 pretrigger_duration=5.0, pretrigger_max_bytes=256e6, drain_rate=3):
         # Serial I/O interface to CNC
-        self.cam = Camera()
+        self.cam = Camera(angle_predictor=angle_predictor)
 
         # Lock for communicating fly pose changes
         self.flyDataLock = Lock()
@@ -45,11 +109,36 @@ class CamThread(Service):
         self.logFull = None
         self.logState = False
 
+        # frames from before logging started, and those not yet written since
+        self.pretrigger = pretrigger_duration > 0
+        self.ring = FrameRing(pretrigger_duration, pretrigger_max_bytes)
+        self.drain_rate = drain_rate
+        # frames (and their rows) dropped because the ring overflowed while the video queue was full
+        self.dropped_frames = 0
+
         self.show_threshold = False
         self.draw_contours = True
 
         self.flyPresent = False
         self.fly = None
+        self.fly_t = None
+        # (fly, frame time) of the latest frame, replaced in one assignment so that readers on
+        # other threads get a matching pair
+        self.fly_sample = (None, None)
+
+        # Callbacks run on every processed frame with (fly, frame time).  Stored as a tuple
+        # that is replaced on change, so the loop can iterate without taking a lock
+        self.flyListenerLock = Lock()
+        self.fly_listeners = ()
+
+        # Reduced-size RGB preview for the GUI, produced at most preview_period apart.  Each
+        # preview is a new array that the camera thread never touches again
+        self.previewLock = Lock()
+        self.preview_size = None
+        self.preview_period = None
+        self.preview_t = 0
+        self._preview = None
+        self.preview_count = 0
 
         # call constructor from parent        
         super().__init__(maxTime=maxTime)
@@ -68,13 +157,23 @@ class CamThread(Service):
     def loopBody(self):
         
         # read and process frame
-        self.fly, self.saveFrame, self.drawFrame = self.cam.processNext()
+        fly, self.saveFrame, self.drawFrame = self.cam.processNext()
+        self.fly_t = self.cam.grab_t
+        self.fly = fly
+        self.fly_sample = (fly, self.fly_t)
 
         if self.fly is None:
             self.flyPresent = False
         else:
             self.flyPresent = True
 
+        # hand the new fly position straight to anything that needs low latency
+        for listener in self.fly_listeners:
+            listener(fly, self.fly_t)
+
+        # update the GUI preview if one is due
+        self.updatePreview()
+
         #fly.center is x, y tuple
 
         # update fly data variable
@@ -85,15 +184,30 @@ class CamThread(Service):
 
         # write logs
         with self.logLock:
-            if self.logState:
-                if self.fly is not None:
-                    logStr = (str(time()) + ',' +
+            has_frame = self.saveFrame is not None and self.saveFrame.shape != 0
+
+            if self.logState and self.ring.count == 0:
+                if has_frame and (self.logFull.full or not self.logFull.write(self.saveFrame)):
+                    # the video queue is full; keep the frame (and its row) until it can be written
+                    self.ring.push(self.fly_t, self.fly, self.saveFrame)
+                elif self.fly is not None:
+                    logStr = (str(self.fly_t) + ',' +
                               str(self.fly.centerX) + ',' +
                               str(self.fly.centerY) + ',' +
                               str(self.fly.angle) + '\n')
                     self.logFile.write(logStr)
-                if self.saveFrame is not None and self.saveFrame.shape != 0:
-                    self.logFull.write(self.saveFrame)
+            elif self.logState:
+                # still writing out the pre-trigger frames; queue this one behind them
+                if self.ring.full and not self.writeOldest():
+                    self.dropOldest()
+                if has_frame:
+                    self.ring.push(self.fly_t, self.fly, self.saveFrame)
+                # the drain stops early while the video queue is full
+                for k in range(self.drain_rate):
+                    if self.ring.count == 0 or not self.writeOldest():
+                        break
+            elif self.pretrigger and has_frame:
+                self.ring.push(self.fly_t, self.fly, self.saveFrame)
 
         # # Process frame if desired
         # if frameData is not None:
@@ -140,6 +254,54 @@ class CamThread(Service):
         with self.threshLock:
             self._threshold = val
 
+    def requestPreview(self, width, height, fps):
+        with self.previewLock:
+            self.preview_size = (width, height)
+            self.preview_period = 1.0/fps
+
+    def cancelPreview(self):
+        # stops producing previews, e.g. once the view is closed
+        with self.previewLock:
+            self.preview_size = None
+            self._preview = None
+
+    def updatePreview(self):
+        # read once, since cancelPreview may run on another thread
+        size = self.preview_size
+        if size is None or self.drawFrame is None:
+            return
+
+        if (self.fly_t - self.preview_t) < self.preview_period:
+            return
+
+        # decimate by an integer stride so the preview fits in the requested size
+        width, height = size
+        rows, cols = self.drawFrame.shape[:2]
+        step = max(1, ceil(cols/width), ceil(rows/height))
+        # cvtColor without a destination always allocates, so the preview never shares memory
+        # with drawFrame (slicing with a step of 1 returns drawFrame itself)
+        preview = cv2.cvtColor(np.ascontiguousarray(self.drawFrame[::step, ::step]), cv2.COLOR_BGR2RGB)
+
+        with self.previewLock:
+            self._preview = preview
+            self.preview_count += 1
+        self.preview_t = self.fly_t
+
+    @property
+    def preview(self):
+        # returns the latest preview frame and its sequence number
+        with self.previewLock:
+            return self._preview, self.preview_count
+
+    def add_fly_listener(self, listener):
+        with self.flyListenerLock:
+            if listener not in self.fly_listeners:
+                self.fly_listeners = self.fly_listeners + (listener,)
+
+    def remove_fly_listener(self, listener):
+        with self.flyListenerLock:
+            self.fly_listeners = tuple(l for l in self.fly_listeners if l != listener)
+
     def startLogging(self, logFile, logFull):
         with self.logLock:
             # save log state
@@ -153,21 +315,57 @@ class CamThread(Service):
             if self.logFull is not None:
                 self.logFull.release()
 
-            # open new log file
-            self.logFile = open(logFile, 'w')
-            self.logFile.write('t,x,y,angle\n')
-
-            # compressed full video
-            fourcc_compr = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
-
-            # get camera image width/height
-            cam_width = self.cam.grab_width
-            cam_height = self.cam.grab_height
-
-            self.logFull = cv2.VideoWriter(logFull, fourcc_compr, 124.2, (cam_width, cam_height))
+            # use the prepared writers if there are any, otherwise open new ones
+            self.logFile, self.logFull = self.takePreparedLog(logFile, logFull)
+
+    def openLog(self, logFile, logFull):
+        # open new log file
+        writer = disk_writer()
+        f = writer.open_text(logFile, header='t,x,y,angle\n')
+
+        # compressed full video
+        fourcc_compr = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
+
+        # get camera image width/height
+        cam_width = self.cam.grab_width
+        cam_height = self.cam.grab_height
+
+        return f, writer.add_video(logFull, cv2.VideoWriter(logFull, fourcc_compr, VIDEO_FPS, (cam_width, cam_height)))
+
+    def writeOldest(self):
+        # write the oldest buffered frame and its record; called with logLock held.  Returns False,
+        # leaving the frame buffered, if the video queue is full.  The record is only written
+        # along with its frame, so that the rows of cam.txt stay in step with the video
+        if self.logFull.full:
+            return False
+        record, frame = self.ring.oldest()
+        if not self.logFull.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)):
+            return False
+        if not np.isnan(record[1]):
+            self.logFile.write('{},{},{},{}\n'.format(*record.tolist()))
+        self.ring.pop()
+        return True
+
+    def dropOldest(self):
+        # drop the oldest buffered frame together with its record; called with logLock held
+        self.ring.pop()
+        self.dropped_frames += 1
 
     def stopLogging(self):
         with self.logLock:
+            # write out whatever is still buffered, waiting for the video queue when it is full
+            if self.logState:
+                dropped = self.dropped_frames
+                while self.ring.count > 0:
+                    if not self.writeOldest():
+                        if self.logFull.failed:
+                            self.dropOldest()
+                        else:
+                            sleep(1e-3)
+                if self.dropped_frames > dropped:
+                    print('Camera: {} frames dropped while writing the trial video.'.format(
+                        self.dropped_frames - dropped))
+
             # save log state
             self.logState = False
 
@@ -182,15 +380,29 @@ class CamThread(Service):
     def cleanup(self):
         self.cam.camera.StopGrabbing()
 
+    def close(self):
+        # releases the camera of a thread that is not running
+        self.cam.camera.StopGrabbing()
+        self.cam.camera.Close()
+
 class Camera:
-    def __init__(self, px_per_m = 37023.1016957): # calibrated for 2x on 2/6/2018):
+    def __init__(self, px_per_m = 37023.1016957, # calibrated for 2x on 2/6/2018):
+                 angle_predictor=None # already-loaded AnglePredictor, e.g. loaded in parallel at startup
+                 ):
         # Instaniate fly finder and predictor from vrcam package
-        self.angle_predictor = AnglePredictor()
+        from vrcam.finder import FlyFinder
+        if angle_predictor is None:
+            from vrcam.train_angle import AnglePredictor
+            angle_predictor = AnglePredictor()
+        self.angle_predictor = angle_predictor
         self.fly_finder = FlyFinder()
 
         # Store the number of pixels per meter
         self.px_per_m = px_per_m
 
+        # Time at which the most recent frame was retrieved
+        self.grab_t = None
+
         # Open the capture stream
         self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
         self.camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
@@ -213,6 +425,7 @@ class Camera:
                 (self.r_min <= ellipse.ma/ellipse.MA <= self.r_max))
 
     def arrow_from_point(self, img, point, angle, length=30, thickness=3, color=(0, 0, 255)):
+        from vrcam.image import bound_point
         ax = point[0] + length * np.cos(angle)
         ay = point[1] - length * np.sin(angle)
         tip = bound_point((ax, ay), img)
@@ -224,6 +437,7 @@ class Camera:
 
         # Capture a single frame
         grabResult = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
+        self.grab_t = time()
         image = self.converter.Convert(grabResult)
         inFrame = image.GetArray().copy()
         grabResult.Release()
@@ -240,6 +454,7 @@ class Camera:
         drawFrame = saveFrame.copy()
 
         if fly is not None:
+            from vrcam.image import bound_point
 
             center = fly.center
             angle = self.angle_predictor.predict(fly.patch)
@@ -5,10 +5,11 @@ from time import sleep, time
 from threading import Lock
 import serial.tools.list_ports
 
-from flyvr.service import Service
+from flyvr.service import Service, PreparedLogging
 from flyvr.util import serial_number_to_comport
+from flyvr.writer import disk_writer
 
-class CncThread(Service):
+class CncThread(PreparedLogging, Service):
     def __init__(self, maxTime=12e-3):
         # Serial I/O interface to CNC
         self.cnc = CNC()
@@ -76,9 +77,11 @@ class CncThread(Service):
             if self.logFile is not None:
                 self.logFile.close()
 
-            # open new log file if desired
-            self.logFile = open(logFile, 'w')
-            self.logFile.write('t,x,y\n')
+            # use the prepared log file if there is one, otherwise open a new one
+            self.logFile = self.takePreparedLog(logFile)
+
+    def openLog(self, logFile):
+        return disk_writer().open_text(logFile, header='t,x,y\n')
 
     def stopLogging(self):
         with self.logLock:
@@ -96,6 +99,10 @@ class CncThread(Service):
     def cleanup(self):
         del self.cnc
 
+    def close(self):
+        # stops the stage and releases the serial port of a thread that is not running
+        self.cnc.close()
+
 class CncStatus:
     def __init__(self, status):
         # compute checksum
@@ -187,10 +194,14 @@ class CNC:
         # return status
         return CncStatus(byteArrIn)
 
+    def close(self):
+        if self.ser.is_open:
+            self.setVel(0, 0)
+            self.ser.close()
+
     def __del__(self):
         print('Deleting CNC object...')
-        self.setVel(0, 0)
-        self.ser.close()
+        self.close()
     
     def velByte(self, v):
         # compute maximum integer argument to be sent to Arduino
@@ -1,16 +1,16 @@
 #!/usr/bin/env python
 
 import serial, platform, os.path
+import queue
 import numpy as np
-import matplotlib.pyplot as plt
 
 from threading import Thread, Lock, Event
 from time import time, sleep
 
-from flyrpc.transceiver import MySocketServer
-from flyrpc.util import get_kwargs
-
-from flyvr.util import serial_number_to_comport
+from flyvr.util import serial_number_to_comport, LatencyStats
+from flyvr.npylog import export_text
+from flyvr.writer import disk_writer
+from flyvr.passage import PassageDetector
 from flyvr.service import Service
 
 def format_values(values, delimeter='\t', line_ending='\n'):
@@ -20,25 +20,101 @@ def format_values(values, delimeter='\t', line_ending='\n'):
 
     return retval
 
+class LineScanParser:
+    # Splits the line-scan byte stream into frames.  The Arduino sends num_pixels pixel bytes
+    # (never 0) followed by a 0 byte, so every 0 in the stream marks the end of a frame and the
+    # parser is back in sync at the next 0 no matter how much noise came before it.
+    def __init__(self, num_pixels=128):
+        self.num_pixels = num_pixels
+        self.buf = bytearray()
+        self.synced = False
+
+        # statistics
+        self.frame_count = 0
+        self.resync_count = 0
+        self.dropped_bytes = 0
+
+    def feed(self, data, t):
+        # returns a list of (frame, t) tuples for the complete frames available so far, where
+        # t is the receive time of the chunk that completed the frame
+        self.buf += data
+
+        frames = []
+        pos = 0
+        while True:
+            end = self.buf.find(0, pos)
+            if end == -1:
+                break
+
+            length = end - pos
+            if self.synced and length == self.num_pixels:
+                frames.append((bytes(self.buf[pos:end]), t))
+            elif length > 0:
+                # partial frame before the first sync byte, or a corrupted frame
+                if self.synced:
+                    self.resync_count += 1
+                self.dropped_bytes += length
+            self.synced = True
+            pos = end + 1
+
+        del self.buf[:pos]
+
+        # a frame can't be this long, so the sync byte was lost
+        if len(self.buf) > self.num_pixels:
+            if self.synced:
+                self.resync_count += 1
+            self.dropped_bytes += len(self.buf)
+            self.buf.clear()
+            self.synced = False
+
+        self.frame_count += len(frames)
+        return frames
+
+class DispenserReader(Service):
+    # Reads line-scan frames from the serial port on its own thread and queues them for the
+    # dispenser state machine, so that gate commands never wait behind a blocking read
+    def __init__(self, dispenser):
+        self.dispenser = dispenser
+
+        # call constructor from parent
+        super().__init__()
+
+    def loopBody(self):
+        for frame in self.dispenser.read_frames():
+            self.dispenser.queue_frame(frame)
+
+    def stop(self):
+        self.done.set()
+
+        # interrupt a read that is waiting for data
+        try:
+            self.dispenser.conn.cancel_read()
+        except:
+            pass
+
+        self.thread.join()
+
 class FlyDispenser(Service):
-    def __init__(self, maxTime=12e-3):
+    DETECTOR_TYPES = ['snapshot', 'rolling']
+
+    def __init__(self, maxTime=12e-3, serial_port=None, background_region_file=None):
         # set defaults
 
-        serial_port = None
-
-        if platform.system() == 'Darwin':
-            serial_port = '/dev/tty.usbmodem1411'
-        elif platform.system() == 'Linux':
-            try:
-                serial_number = '5573731323135121E0C2' #Arduino specific
-                serial_port = serial_number_to_comport(serial_number)
-            except:
-                print('Could not connect to fly dispenser Arduino.')
-                print("  **NOTE** if this is a new Arduino, you must:")
-                print("\t (1) open: <path_to_flyvr_code>/flyvr/dispensor.py")
-                print("\t (2) edit: serial_number to match the new Arduino.")
-        else:
-            serial_port = 'COM4'
+        # serial_port can be given directly, e.g. the port of a DispenserEmulator
+        if serial_port is None:
+            if platform.system() == 'Darwin':
+                serial_port = '/dev/tty.usbmodem1411'
+            elif platform.system() == 'Linux':
+                try:
+                    serial_number = '5573731323135121E0C2' #Arduino specific
+                    serial_port = serial_number_to_comport(serial_number)
+                except:
+                    print('Could not connect to fly dispenser Arduino.')
+                    print("  **NOTE** if this is a new Arduino, you must:")
+                    print("\t (1) open: <path_to_flyvr_code>/flyvr/dispensor.py")
+                    print("\t (2) edit: serial_number to match the new Arduino.")
+            else:
+                serial_port = 'COM4'
 
         serial_baud = 115200
         serial_timeout = 4
@@ -60,13 +136,33 @@ class FlyDispenser(Service):
         # serial connection
         self.conn = None
         self.synced = False
+        self.parser = LineScanParser(num_pixels=self.num_pixels)
+
+        # frames from the reader thread; None entries only wake up the state machine.  Bounded,
+        # so that a stalled state machine can't grow it without limit; frames that don't fit
+        # are dropped and counted
+        self.frame_queue = queue.Queue(maxsize=1024)
+        self.dropped_frames = 0
+        self.command_poll_time = 0.1
+        self.reader = None
+
+        # latency from a gate command request to the serial write, and from frame receipt
+        # to the end of the state machine update for that frame.  command_t is the time of the
+        # latest request, set and taken together with the request flags under requestLock;
+        # pending_command_t is the one taken for the update that is running
+        self.command_t = None
+        self.pending_command_t = None
+        self.command_latency = LatencyStats()
+        self.frame_latency = LatencyStats()
 
         # dispenser state
         self.state = 'Reset'
 
         # set gate region file location
-        this_file = os.path.abspath(os.path.expanduser(__file__))
-        self.background_region_file = os.path.join(os.path.join(os.path.dirname(os.path.dirname(this_file)), 'calibration'), 'background_region.npy')
+        if background_region_file is None:
+            this_file = os.path.abspath(os.path.expanduser(__file__))
+            background_region_file = os.path.join(os.path.join(os.path.dirname(os.path.dirname(this_file)), 'calibration'), 'background_region.npy')
+        self.background_region_file = background_region_file
 
         # try to load gate region data
         try:
@@ -105,13 +201,26 @@ class FlyDispenser(Service):
         # Below is how many pixels in the gate exceed the fly_passed_threshold. decrease value to increase sensitivity
         self.num_needed_pixels = 2 # a combo of fly_passed = -1 and num_needed = 2 seems to work
 
+        # gate decisions come from either the calibrated background_region snapshot and fixed
+        # thresholds above ('snapshot') or the rolling background statistics ('rolling'); can be
+        # switched from the dispenser view
+        self.detector_type = 'snapshot'
+        self.detector = PassageDetector(gate_start=self.gate_start, gate_end=self.gate_end,
+                                        num_pixels=self.num_pixels)
+
         # manual command locking
+        self.requestLock = Lock()
         self.should_release = Event()
         self.should_open = Event()
         self.should_close = Event()
         self.should_calibrate_gate = Event()
         self.gate_state = None
 
+        # callbacks run with (gate state, time) whenever the gate is commanded open or closed.
+        # Stored as a tuple that is replaced on change, like CamThread.fly_listeners
+        self.gateListenerLock = Lock()
+        self.gate_listeners = ()
+
         #for opening dispenser if it is closed too long in error
         self.prev_state = None
         self.closed_gate_timer = None
@@ -126,7 +235,13 @@ class FlyDispenser(Service):
         # log file management
         self.log_lock = Lock()
         self.raw_data_file = None
+        self.raw_times_file = None
         self.gate_times_file = None
+        self.raw_log_dir = None
+
+        # raw line-scan frames are logged to raw_gate_data.npy (one uint8 row per frame) and
+        # raw_gate_times.npy; set this to also write the old raw_gate_data.txt when logging stops
+        self.raw_text_export = False
 
         # for logging the cause of gate opening and closing
         self.trigger = None
@@ -143,9 +258,47 @@ class FlyDispenser(Service):
         sleep(1.0)
         self.conn.reset_input_buffer()
 
+        # separate thread for serial reads
+        self.reader = DispenserReader(self)
+
         # call constructor from parent
         super().__init__(maxTime=maxTime)
 
+    def start(self):
+        self.reader.start()
+        super().start()
+
+    def stop(self):
+        self.reader.stop()
+        self.done.set()
+        self.wake()
+        super().stop()
+
+    def cleanup(self):
+        print('Dispenser command latency: {}'.format(self.command_latency))
+        print('Dispenser frame latency: {}'.format(self.frame_latency))
+        print('Dispenser frames: {}, resyncs: {}, dropped bytes: {}, dropped frames: {}'.format(
+            self.parser.frame_count, self.parser.resync_count, self.parser.dropped_bytes, self.dropped_frames))
+
+    def close(self):
+        # releases the serial port of a dispenser that is not running
+        if self.conn is not None:
+            self.conn.close()
+
+    def queue_frame(self, frame):
+        try:
+            self.frame_queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped_frames += 1
+
+    def wake(self):
+        # make the state machine run now rather than at the next frame; a full queue will run
+        # it anyway
+        try:
+            self.frame_queue.put_nowait(None)
+        except queue.Full:
+            pass
+
     @property
     def display_frame(self):
         with self.display_frame_lock:
@@ -157,25 +310,56 @@ class FlyDispenser(Service):
             self._display_frame = value
 
     def loopBody(self):
-        # read next frame
-        self.read_frame()
+        # wait for the next frame or command, whichever comes first
+        try:
+            item = self.frame_queue.get(timeout=self.command_poll_time)
+        except queue.Empty:
+            item = None
+
+        # run the state machine once per frame, and also for commands and timers
+        if item is not None:
+            frame, frame_t = item
+            self.process_frame(frame, frame_t)
+            self.update_state()
+            self.frame_latency.add(time() - frame_t)
+        else:
+            self.update_state()
+
+    def take_request(self, flag):
+        # called with requestLock held
+        if flag.is_set():
+            flag.clear()
+            return True
+        return False
+
+    def update_state(self):
+        # take pending requests, and the time of the latest one, up front and in one step, so
+        # that a request made while the state machine is running is kept (with its time) for
+        # the next update
+        with self.requestLock:
+            should_open = self.take_request(self.should_open)
+            should_close = self.take_request(self.should_close)
+            should_calibrate_gate = self.take_request(self.should_calibrate_gate)
+            should_release = self.take_request(self.should_release)
+            self.pending_command_t = self.command_t
+            self.command_t = None
 
         # handle manual command outside of state machine
         # this will always send the state machine back to Idle
-        if self.should_open.is_set():
+        if should_open:
             self.trigger = 'manual'
             self.send_open_gate_command()
             self.state ='Idle'
             print('Dispenser: going to Idle state.')
 
-        if self.should_close.is_set():
+        if should_close:
             self.trigger = 'manual'
             self.send_close_gate_command()
             self.state = 'Idle'
             print('Dispenser: going to Idle state.')
 
         # handle calibration
-        if self.should_calibrate_gate.is_set():
+        if should_calibrate_gate:
             if self.gate_state == 'open':
                 print('Calibrating gate...')
                 self.background_region = self.raw_data
@@ -194,7 +378,7 @@ class FlyDispenser(Service):
             self.state = 'Idle'
             print('Dispenser: going to Idle state.')
         elif self.state == 'Idle':
-            if self.should_release.is_set():
+            if should_release:
                 self.trigger = 'auto'
                 self.send_open_gate_command()
                 self.start_timer()
@@ -256,56 +440,63 @@ class FlyDispenser(Service):
         else:
             raise Exception('Invalid state.')
 
-        # clear flags
-        self.should_open.clear()
-        self.should_close.clear()
-        self.should_calibrate_gate.clear()
-        self.should_release.clear()
-
-    def read_frame(self):
-        start_byte = self.conn.read(1)[0]
-        if int(start_byte) == 0:
-            if not self.synced:
-                print('Dispenser camera is synced.')
-                self.synced = True
-            # read raw data into a list
-            frame = self.conn.read(self.num_pixels)
-            frame = list(frame)
-
-            # write frame to variable for matplotlib display
-            if self.display_type == 'raw':
-                display_frame = frame
-            elif self.display_type == 'corrected':
-                display_frame = frame
-                if self.background_region is not None:
-                    display_frame -= self.background_region
-            elif self.display_type == 'diff':
-                display_frame = frame
-                if self.prev_frame is not None:
-                    display_frame = np.abs(self.prev_frame - frame)
-            else:
-                display_frame = frame
-                if self.background_region is not None:
-                    display_frame -= self.background_region
-                display_frame = display_frame > self.display_threshold
+        # a request that did not lead to a gate command is not counted
+        self.pending_command_t = None
+
+    def read_frames(self):
+        # read everything that is waiting in one call, blocking for at least one byte
+        data = self.conn.read(max(self.conn.in_waiting, 1))
+        frames = self.parser.feed(data, time())
+
+        if self.parser.synced and not self.synced:
+            print('Dispenser camera is synced.')
+        elif self.synced and not self.parser.synced:
+            print('Dispenser camera lost sync')
+        self.synced = self.parser.synced
+
+        return frames
+
+    def process_frame(self, frame, frame_t):
+        # write frame to file
+        pixels = np.frombuffer(frame, dtype=np.uint8)
+        self.log_raw(pixels, frame_t)
+
+        # signed copy of the frame for background and difference calculations
+        frame = pixels.astype(int)
+
+        # write frame to variable for matplotlib display
+        if self.display_type == 'raw':
+            display_frame = frame
+        elif self.display_type == 'corrected':
+            display_frame = frame
+            if self.background_region is not None:
+                display_frame = display_frame - self.background_region
+        elif self.display_type == 'diff':
+            display_frame = frame
+            if self.prev_frame is not None:
+                display_frame = np.abs(self.prev_frame - frame)
+        else:
+            display_frame = frame
+            if self.background_region is not None:
+                display_frame = display_frame - self.background_region
+            display_frame = display_frame > self.display_threshold
 
-            self.display_frame = display_frame
+        self.display_frame = display_frame
 
-            # write frame to file
-            self.log_raw(frame)
+        # update background statistics
+        self.detector.update(frame)
 
-            # save previous frame for difference calculation if desired
-            self.prev_frame = self.raw_data
+        # save previous frame for difference calculation if desired
+        self.prev_frame = self.raw_data
 
-            # add frame to history
-            self.raw_data = np.array(frame)
-        else:
-            if self.synced:
-                print('Dispenser camera lost sync')
-                self.synced = False
+        # add frame to history
+        self.raw_data = frame
 
     @property
     def gate_clear(self):
+        if self.detector_type == 'rolling':
+            return self.detector.gate_clear
+
         if self.background_region is None:
             return False
 
@@ -317,6 +508,9 @@ class FlyDispenser(Service):
 
     @property
     def fly_passed(self):
+        if self.detector_type == 'rolling':
+            return self.detector.fly_passed
+
         if self.background_region is None:
             return False
 
@@ -341,30 +535,64 @@ class FlyDispenser(Service):
     def timer_done(self, duration):
         return (time() - self.timer_ref) > duration
 
+    def log_command_latency(self):
+        if self.pending_command_t is not None:
+            self.command_latency.add(time() - self.pending_command_t)
+            self.pending_command_t = None
+
     def send_open_gate_command(self):
         print('Dispenser: opening gate...')
         self.conn.write(bytes([1]))
+        self.log_command_latency()
         self.gate_state = 'open'
         self.log_gate(time(), self.gate_state)
+        self.notify_gate(self.gate_state)
+
+        # the tunnel looks different with the gate open, so learn the background again
+        self.detector.reset()
 
     def send_close_gate_command(self):
         print('Dispenser: closing gate...')
         self.conn.write(bytes([0]))
+        self.log_command_latency()
         self.gate_state = 'closed'
         self.log_gate(time(), self.gate_state)
+        self.notify_gate(self.gate_state)
         self.closed_gate_timer = time()  #to use for counting how long the gate has been closed
 
+    def add_gate_listener(self, listener):
+        with self.gateListenerLock:
+            if listener not in self.gate_listeners:
+                self.gate_listeners = self.gate_listeners + (listener,)
+
+    def remove_gate_listener(self, listener):
+        with self.gateListenerLock:
+            self.gate_listeners = tuple(l for l in self.gate_listeners if l != listener)
+
+    def notify_gate(self, gate_state):
+        t = time()
+        for listener in self.gate_listeners:
+            listener(gate_state, t)
+
+    def request(self, flag):
+        with self.requestLock:
+            self.command_t = time()
+            flag.set()
+        self.wake()
+
     def open_gate(self):
-        self.should_open.set()
+        self.request(self.should_open)
 
     def close_gate(self):
-        self.should_close.set()
+        self.request(self.should_close)
 
     def calibrate_gate(self):
-        self.should_calibrate_gate.set()
+        with self.requestLock:
+            self.should_calibrate_gate.set()
+        self.wake()
 
     def release_fly(self):
-        self.should_release.set()
+        self.request(self.should_release)
 
     def set_display_type(self, type):
         self.display_type = type
@@ -381,34 +609,50 @@ class FlyDispenser(Service):
     def set_num_needed_pixels(self, value):
         self.num_needed_pixels = value
 
+    def set_detector_type(self, type):
+        if type not in self.DETECTOR_TYPES:
+            raise Exception('Invalid detector type.')
+        self.detector_type = type
+
     def close_all_open_files(self):
-        for f in [self.raw_data_file, self.gate_times_file]:
+        for f in [self.raw_data_file, self.raw_times_file, self.gate_times_file]:
             if f is not None:
                 f.close()
 
+        if self.raw_text_export and self.raw_log_dir is not None and self.raw_data_file is not None:
+            print('Dispenser: exporting raw gate data to text...')
+            disk_writer().wait_closed(self.raw_data_file)
+            export_text(os.path.join(self.raw_log_dir, 'raw_gate_data.npy'),
+                        os.path.join(self.raw_log_dir, 'raw_gate_data.txt'))
+
     def log_gate(self, time, state):
         with self.log_lock:
             if self.gate_times_file is not None:
                 self.gate_times_file.write('{}, {}, {}\n'.format(time, state, self.trigger))
-                self.gate_times_file.flush()
                 self.trigger = None
 
-    def log_raw(self, frame):
+    def log_raw(self, frame, frame_t):
         with self.log_lock:
             if self.raw_data_file is not None:
-                self.raw_data_file.write(format_values(frame))
-                self.raw_data_file.flush()
+                self.raw_data_file.append(frame)
+                self.raw_times_file.append(frame_t)
 
     def start_logging(self, exp_dir):
         with self.log_lock:
             self.close_all_open_files()
 
-            self.raw_data_file = open(os.path.join(exp_dir, 'raw_gate_data.txt'), 'w')
-            self.gate_times_file = open(os.path.join(exp_dir, 'gate_data.txt'), 'w')
+            writer = disk_writer()
+            self.raw_data_file = writer.open_npy(os.path.join(exp_dir, 'raw_gate_data.npy'), np.uint8,
+                                                 row_shape=(self.num_pixels, ))
+            self.raw_times_file = writer.open_npy(os.path.join(exp_dir, 'raw_gate_times.npy'), np.float64)
+            self.gate_times_file = writer.open_text(os.path.join(exp_dir, 'gate_data.txt'))
+            self.raw_log_dir = exp_dir
 
     def stop_logging(self):
         with self.log_lock:
             self.close_all_open_files()
 
             self.raw_data_file = None
+            self.raw_times_file = None
             self.gate_times_file = None
+            self.raw_log_dir = None
@@ -0,0 +1,114 @@
+import os, tty, select
+import numpy as np
+
+from time import time
+
+from flyvr.service import Service
+
+class DispenserEmulator(Service):
+    # Emulates the ArduinoDispenser line-scan camera and gate on a pseudo-terminal, so that
+    # FlyDispenser can be run without hardware by connecting to DispenserEmulator.port.
+    #
+    # Like the firmware, each frame is num_pixels pixel bytes (never 0) followed by a 0 byte, and
+    # at most one gate command byte (1 = open, 0 = close) is read per frame.  Flies are scripted
+    # as passages that start a given delay after the gate opens and move down the tunnel.
+    def __init__(self,
+                 frame_period=28e-3, # exposure + delay + transfer of one frame on the real rig
+                 num_pixels=128,
+                 background=None, # background profile, defaults to a smooth synthetic one
+                 noise_std=2.0, # pixel noise in ADC counts
+                 passages=None, # list of dicts with delay, speed (px/s), width (px) and contrast
+                 seed=0
+                 ):
+
+        self.frame_period = frame_period
+        self.num_pixels = num_pixels
+        self.noise_std = noise_std
+        self.rng = np.random.RandomState(seed)
+
+        if background is None:
+            x = np.arange(num_pixels)
+            background = 120 + 50*np.sin(2*np.pi*x/num_pixels) + 10*np.cos(2*np.pi*3*x/num_pixels)
+        self.background = np.asarray(background, dtype=float)
+
+        # scripted fly passages, each used once
+        if passages is None:
+            passages = [{'delay': 1.0, 'speed': 200, 'width': 3, 'contrast': 40}]
+        self.passages = list(passages)
+        self.active = []
+
+        # gate state as seen by the firmware
+        self.gate_state = 'closed'
+        self.gate_events = []
+
+        # statistics
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+        # pseudo-terminal; the slave end is what FlyDispenser opens
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+
+        self.pixel_index = np.arange(num_pixels)
+
+        # call constructor from parent
+        super().__init__(minTime=frame_period, iter_warn=False)
+
+    def add_passage(self, delay=0.0, speed=200, width=3, contrast=40):
+        self.passages.append({'delay': delay, 'speed': speed, 'width': width, 'contrast': contrast})
+
+    def loopBody(self):
+        now = time()
+
+        # the firmware reads one command byte per frame
+        readable, _, _ = select.select([self.master], [], [], 0)
+        if readable:
+            try:
+                cmd = os.read(self.master, 1)
+            except OSError:
+                cmd = b''
+            if cmd == bytes([1]) and self.gate_state != 'open':
+                self.gate_state = 'open'
+                self.gate_events.append((now, 'open'))
+                self.release(now)
+            elif cmd == bytes([0]) and self.gate_state != 'closed':
+                self.gate_state = 'closed'
+                self.gate_events.append((now, 'closed'))
+
+        try:
+            os.write(self.master, self.make_frame(now))
+            self.frames_sent += 1
+        except BlockingIOError:
+            # nobody is reading the port
+            self.frames_dropped += 1
+
+    def release(self, now):
+        # start the next scripted passage when the gate opens
+        if self.passages:
+            passage = dict(self.passages.pop(0))
+            passage['start_t'] = now + passage['delay']
+            self.active.append(passage)
+
+    def make_frame(self, now):
+        frame = self.background + self.rng.normal(0, self.noise_std, self.num_pixels)
+
+        # flies are dark blobs moving from the top of the tunnel past the gate
+        for passage in list(self.active):
+            dt = now - passage['start_t']
+            if dt < 0:
+                continue
+            pos = dt*passage['speed'] - passage['width']
+            if pos > self.num_pixels + 3*passage['width']:
+                self.active.remove(passage)
+                continue
+            frame -= passage['contrast']*np.exp(-((self.pixel_index - pos)/passage['width'])**2)
+
+        frame = np.clip(np.round(frame), 1, 255).astype(np.uint8)
+        return frame.tobytes() + bytes([0])
+
+    def cleanup(self):
+        os.close(self.master)
+        os.close(self.slave)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Runs experiments without the GUI.  The same services that qt/qtmain.py starts from its buttons
+# are built from a JSON config file, and a short status line is printed periodically in place of
+# the GUI displays.  Nothing in here (or in the services) imports Qt.
+#
+# example:
+#   python -m flyvr.headless examples/headless.json
+
+import json
+import argparse
+
+from time import time, sleep, strftime
+
+from flyvr.bootstrap import RigBootstrap
+from flyvr.writer import disk_writer
+
+# defaults for every config entry; see examples/headless.json
+DEFAULT_CONFIG = {
+    'devices': {'cam': True, 'tracker': True, 'dispenser': True, 'opto': True, 'stim': False, 'temp': True},
+    'tracker': {'initialize': True, 'center_pos_x': None, 'center_pos_y': None, 'loop_gain': None},
+    'opto': {'foraging': True, 'params': {}},
+    'stim': {'mode': None, 'pause_duration': None, 'stim_duration': None, 'seed': None},
+    'status_interval': 10, # seconds between status lines
+    'duration': None, # seconds to run the experiment for, or None to run until interrupted
+    'max_inter_fly_wait': 10 * 60, # re-release a fly after waiting this long between trials
+    'turn_off_time': 2 * 60 * 60, # stop the experiment after waiting this long between trials
+    'init_timeout': 120 # seconds to wait for the CNC to come up
+}
+
+def load_config(fname=None):
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    if fname is None:
+        return config
+
+    with open(fname, 'r') as f:
+        user_config = json.load(f)
+
+    for key, value in user_config.items():
+        if key not in config:
+            raise Exception('Unknown config entry: {}'.format(key))
+        if isinstance(config[key], dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+
+    return config
+
+class HeadlessRig:
+    def __init__(self, config):
+        self.config = config
+
+        self.cam = None
+        self.tracker = None
+        self.dispenser = None
+        self.opto = None
+        self.stim = None
+        self.temp = None
+        self.trial = None
+
+        self.current_max_inter_fly_wait = config['max_inter_fly_wait']
+
+        devices = config['devices']
+        for name in ['cam', 'tracker', 'temp']:
+            if not devices[name]:
+                raise Exception('Experiments need the {} service.'.format(name))
+
+        if not config['tracker']['initialize'] and config['tracker']['center_pos_x'] is None:
+            raise Exception('Initialize the CNC or give the arena center in the config.')
+
+    def build(self):
+        # devices are created concurrently, then connected and started.  Services are imported
+        # here so that only the ones in use are loaded
+        devices = self.config['devices']
+        tracker_config = self.config['tracker']
+
+        boot = RigBootstrap()
+
+        from flyvr.temp import TempMonitor
+        boot.add('temp', TempMonitor)
+
+        from vrcam.train_angle import AnglePredictor
+        from flyvr.camera import CamThread
+        boot.add('angle_predictor', AnglePredictor)
+        boot.add('cam', lambda: CamThread(angle_predictor=boot.result('angle_predictor')))
+
+        boot.add('cnc', lambda: self.make_cnc(tracker_config['initialize']))
+
+        if devices['dispenser']:
+            from flyvr.dispenser import FlyDispenser
+            boot.add('dispenser', FlyDispenser)
+
+        if devices['opto']:
+            from flyvr.opto import OptoThread
+            boot.add('opto', OptoThread)
+
+        if devices['stim']:
+            from flyvr.stim import StimThread
+            boot.add('stim', StimThread)
+
+        started = boot.wait()
+
+        self.temp = started['temp']
+        self.temp.start()
+
+        self.cam = started['cam']
+        self.cam.start()
+
+        from flyvr.tracker import TrackThread
+        cnc = started['cnc']
+        cnc.start()
+        self.tracker = TrackThread(camThread=self.cam)
+        self.tracker.cncThread = cnc
+        if tracker_config['center_pos_x'] is not None:
+            self.tracker.center_pos_x = tracker_config['center_pos_x']
+            self.tracker.center_pos_y = tracker_config['center_pos_y']
+        if tracker_config['loop_gain'] is not None:
+            self.tracker.a = tracker_config['loop_gain']
+        self.tracker.start()
+        if tracker_config['initialize']:
+            self.tracker.is_init = True
+            self.tracker.start_moving_to_center()
+        self.wait_for_cnc()
+
+        if devices['dispenser']:
+            self.dispenser = started['dispenser']
+            self.dispenser.start()
+
+        if devices['opto']:
+            self.opto = started['opto']
+            self.opto.camThread = self.cam
+            self.opto.cncThread = cnc
+            self.opto.trackThread = self.tracker
+            for key, value in self.config['opto']['params'].items():
+                if not hasattr(self.opto, key):
+                    raise Exception('Unknown opto parameter: {}'.format(key))
+                if key == 'fast_trigger':
+                    # the fast trigger also has to register with the camera thread
+                    if value:
+                        self.opto.enableFastTrigger()
+                    else:
+                        self.opto.disableFastTrigger()
+                else:
+                    setattr(self.opto, key, value)
+            self.opto.foraging = self.config['opto']['foraging']
+            self.opto.start()
+
+        if devices['stim']:
+            self.stim = started['stim']
+            for key, value in self.config['stim'].items():
+                if value is not None:
+                    setattr(self.stim, key, value)
+            self.stim.check_schedule()
+            self.stim.start()
+
+    def make_cnc(self, initialize):
+        from flyvr.cnc import CncThread, cnc_home
+        if initialize:
+            print('Homing CNC...')
+            cnc_home()
+            print('Done homing CNC.')
+        return CncThread()
+
+    def cnc_ready(self):
+        if self.tracker.cncThread is None or self.tracker.cncThread.status is None:
+            return False
+        if self.config['tracker']['initialize'] and not self.tracker.is_init:
+            return False
+        return True
+
+    def wait_for_cnc(self):
+        # the CNC thread was created (and optionally homed) by make_cnc; wait for its first status
+        # and, when homing, for the stage to reach the arena center
+        t0 = time()
+        while not self.cnc_ready():
+            if time() - t0 > self.config['init_timeout']:
+                raise Exception('CNC did not come up.')
+            sleep(0.1)
+
+        if self.config['tracker']['initialize']:
+            # wait until the CNC has reached the arena center
+            while not self.tracker.is_close_to_center():
+                if time() - t0 > self.config['init_timeout']:
+                    raise Exception('CNC did not reach the center.')
+                sleep(0.1)
+
+    def start_experiment(self):
+        from flyvr.trial import TrialThread
+        self.trial = TrialThread(cam=self.cam,
+                                 cnc=self.tracker.cncThread,
+                                 dispenser=self.dispenser,
+                                 tracker=self.tracker,
+                                 opto=self.opto,
+                                 stim=self.stim,
+                                 ui=None,
+                                 flyplot=None,
+                                 temp=self.temp)
+        self.trial.start()
+        print('Started experiment {}'.format(self.trial.exp))
+
+        if self.dispenser is not None:
+            self.dispenser.release_fly()
+
+    def check_inter_fly_wait(self):
+        # returns False once the rig has waited too long for a fly
+        if self.trial is None or self.trial.trial_start_t is not None or self.trial.trial_end_t is None:
+            self.current_max_inter_fly_wait = self.config['max_inter_fly_wait']
+            return True
+
+        inter_fly_wait = time() - self.trial.trial_end_t
+
+        # re-release fly if we've been waiting too long (and keep trying)
+        if inter_fly_wait > self.current_max_inter_fly_wait:
+            self.current_max_inter_fly_wait += self.config['max_inter_fly_wait']
+            if self.dispenser is not None:
+                print('No fly for {:0.0f} s, releasing again.'.format(inter_fly_wait))
+                self.dispenser.release_fly()
+
+        if inter_fly_wait > self.config['turn_off_time']:
+            print('No fly for {:0.0f} s, stopping.'.format(inter_fly_wait))
+            return False
+
+        return True
+
+    def status_line(self):
+        parts = [strftime('%H:%M:%S')]
+
+        if self.trial is not None:
+            parts.append('trial {} ({})'.format(getattr(self.trial, 'trial_num', '-'), self.trial.state))
+            if self.trial.trial_start_t is not None:
+                parts.append('{:0.0f} s'.format(time() - self.trial.trial_start_t))
+
+        if self.dispenser is not None:
+            parts.append('dispenser {} / gate {}'.format(self.dispenser.state, self.dispenser.gate_state))
+
+        if self.opto is not None:
+            parts.append('LED {} / {} food'.format(self.opto.led_status, len(self.opto.foodspots)))
+
+        if self.temp is not None:
+            parts.append('{}C {}%'.format(self.temp.temp, self.temp.humd))
+
+        writer = disk_writer()
+        parts.append('writer backlog {}'.format(writer.backlog))
+        if len(writer.failed_streams) > 0:
+            parts.append('{} FAILED log files'.format(len(writer.failed_streams)))
+
+        return ', '.join(parts)
+
+    def run(self):
+        t0 = time()
+        last_status_t = 0
+        try:
+            while True:
+                if self.config['duration'] is not None and (time() - t0) > self.config['duration']:
+                    print('Experiment duration reached.')
+                    break
+
+                if not self.check_inter_fly_wait():
+                    break
+
+                if (time() - last_status_t) >= self.config['status_interval']:
+                    print(self.status_line())
+                    last_status_t = time()
+
+                sleep(0.5)
+        except KeyboardInterrupt:
+            print('Interrupted.')
+
+    def shutdown(self):
+        if self.trial is not None:
+            # stop the trial thread first, so that only this thread ends the running trial
+            self.trial.stop()
+            if self.trial.trial_start_t is not None:
+                self.trial._stop_trial()
+            # the last trial's logs have to be written out before it can be bundled
+            self.trial.wait_for_bundles()
+        if self.tracker is not None:
+            self.tracker.stop()
+        if self.opto is not None:
+            self.opto.off()
+            self.opto.stop()
+        if self.stim is not None:
+            self.stim.stop()
+        if self.cam is not None:
+            self.cam.stop()
+        if self.dispenser is not None:
+            self.dispenser.stop()
+            self.dispenser.stop_logging()
+        if self.temp is not None:
+            self.temp.stop()
+        disk_writer().stop()
+        print('Shutdown complete.')
+
+def main():
+    parser = argparse.ArgumentParser(description='Run FlyVR experiments without the GUI.')
+    parser.add_argument('config', nargs='?', default=None, help='JSON config file')
+    args = parser.parse_args()
+
+    rig = HeadlessRig(load_config(args.config))
+    try:
+        rig.build()
+        rig.start_experiment()
+        rig.run()
+    finally:
+        rig.shutdown()
+
+if __name__ == '__main__':
+    main()
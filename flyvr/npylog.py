@@ -0,0 +1,104 @@
+import numpy as np
+
+from time import time
+
+# Appends rows to a .npy file through a memory map.  The header is written with a fixed amount of
+# padding so that it can be rewritten in place as the row count grows, which means the file is a
+# valid .npy file (loadable with np.load) after every flush, not just after close.
+class NpyAppender:
+    MAGIC = b'\x93NUMPY\x01\x00'
+    HEADER_LEN = 128
+
+    def __init__(self, path, dtype, row_shape=(),
+                 chunk_rows=65536, # file capacity grows by this many rows at a time
+                 batch_size=256, # rows held in memory before they are copied to the map
+                 flush_interval=1.0 # maximum time rows are held in memory (s)
+                 ):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape, dtype=np.int64))
+        self.chunk_rows = chunk_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # rows waiting to be written
+        self.pending = np.zeros((batch_size, ) + self.row_shape, dtype=self.dtype)
+        self.num_pending = 0
+
+        # rows already in the file
+        self.count = 0
+        self.capacity = 0
+        self.map = None
+
+        self.file = open(path, 'w+b')
+        self.write_header()
+        self.last_flush = time()
+
+    def header(self):
+        shape = (self.count, ) + self.row_shape
+        info = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), shape)
+        pad = self.HEADER_LEN - len(self.MAGIC) - 2 - len(info) - 1
+        if pad < 0:
+            raise Exception('npy header too long.')
+        info = info + ' '*pad + '\n'
+        return self.MAGIC + (len(info)).to_bytes(2, 'little') + info.encode('latin1')
+
+    def write_header(self):
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.flush()
+
+    def grow(self, min_rows):
+        # extend the file and re-map it
+        while self.capacity < min_rows:
+            self.capacity += self.chunk_rows
+
+        if self.map is not None:
+            self.map.flush()
+            self.map = None
+
+        self.file.truncate(self.HEADER_LEN + self.capacity*self.row_bytes)
+        self.map = np.memmap(self.file, dtype=self.dtype, mode='r+', offset=self.HEADER_LEN,
+                             shape=(self.capacity, ) + self.row_shape)
+
+    def append(self, row):
+        self.pending[self.num_pending] = row
+        self.num_pending += 1
+
+        if self.num_pending >= self.batch_size:
+            self.flush()
+
+    def flush_if_due(self):
+        if self.num_pending > 0 and (time() - self.last_flush) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.num_pending > 0:
+            if self.count + self.num_pending > self.capacity:
+                self.grow(self.count + self.num_pending)
+
+            self.map[self.count:self.count+self.num_pending] = self.pending[:self.num_pending]
+            self.map.flush()
+            self.count += self.num_pending
+            self.num_pending = 0
+
+            self.write_header()
+
+        self.last_flush = time()
+
+    def close(self):
+        self.flush()
+        self.map = None
+
+        # drop the unused capacity at the end of the file
+        self.file.truncate(self.HEADER_LEN + self.count*self.row_bytes)
+        self.write_header()
+        self.file.close()
+
+def export_text(npy_path, txt_path, delimeter='\t'):
+    # write a .npy log out as one text line per row, e.g. for older analysis scripts
+    data = np.load(npy_path, mmap_mode='r')
+    fmt = '%d' if np.issubdtype(data.dtype, np.integer) else '%.18e'
+    np.savetxt(txt_path, data.reshape(len(data), -1), fmt=fmt, delimiter=delimeter)
@@ -1,37 +1,45 @@
 import serial, platform
 import os.path
 
-from math import pi
+from math import pi, hypot
 import numpy as np
 from time import sleep, time
 from threading import Lock, Thread
 import serial.tools.list_ports
 
-from flyvr.service import Service
-from flyvr.tracker import TrackThread
-from flyvr.trial import TrialThread
-from flyvr.cnc import CncThread
-from flyvr.camera import CamThread
+from flyvr.service import Service, PreparedLogging
 
-from flyvr.util import serial_number_to_comport
+from flyvr.util import serial_number_to_comport, precise_time, LatencyStats
+from flyvr.writer import disk_writer
+from flyvr.trajectory import TrajectoryMetrics
+from flyvr.reward import reward_map_for_trial
 from random import choice
 
-class OptoThread(Service):
+class OptoThread(PreparedLogging, Service):
     ON_COMMAND = 0xbe
     OFF_COMMAND = 0xef
 
-    def __init__(self, cncThread=None, camThread=None, trackThread=None, minTime=5e-3, maxTime=12e-3):
-        # Serial interface to opto arduino
-        com = None
-        if com is None:
-            if platform.system() == 'Linux':
-                com = serial_number_to_comport('557323235303519180B1')
-            else:
-                raise Exception('Opto not supported on this platform.')
+    def __init__(self, cncThread=None, camThread=None, trackThread=None, minTime=5e-3, maxTime=12e-3, fast_trigger=False,
+                 ser=None, clock=time):
+        # time source for all of the foraging logic (replaced by a virtual clock in simulation)
+        self.clock = clock
+
+        if ser is None:
+            # Serial interface to opto arduino
+            com = None
+            if com is None:
+                if platform.system() == 'Linux':
+                    com = serial_number_to_comport('557323235303519180B1')
+                else:
+                    raise Exception('Opto not supported on this platform.')
 
-        # set up serial connection
-        self.ser = serial.Serial(port=com, baudrate=9600)
-        sleep(2)
+            # set up serial connection
+            ser = serial.Serial(port=com, baudrate=9600)
+            sleep(2)
+        self.ser = ser
+
+        # put the LED in a known state so that later commands only need to be sent on a change
+        self.write(self.OFF_COMMAND)
 
         # Setup locks
         self.pulseLock = Lock()
@@ -39,6 +47,23 @@ class OptoThread(Service):
         self.logFile = None
         self.logState = False
 
+        # reward map loaded ahead of time by prepareRewardMap
+        self.preparedRewardMap = None
+
+        # LED commands are only sent on a change of state.  If led_keepalive is set (in sec),
+        # the current state is re-sent at that period in case the arduino missed a byte
+        self.ledLock = Lock()
+        self.led_keepalive = None
+        self.last_command_t = self.clock()
+
+        # optional fast path: the camera thread checks trigger zones on every frame and turns the
+        # light on directly, while this loop keeps the policy logic (off time, on time, food creation)
+        self.fast_trigger = False
+        self.fast_in_zone = False
+        self.zone_entry_t = None #frame time at which the fly entered food, for latency
+        self.fast_entry_t = None #the same, as seen by the fast path; the earlier of the two is used
+        self.light_latency = LatencyStats()
+
         # Store thread handles
         self.camThread = camThread
         self.cncThread = cncThread
@@ -47,27 +72,32 @@ class OptoThread(Service):
         # general variables to set
         self.camX = None
         self.camY = None
+        self.frame_t = None
         self.led_status = 'off'
         self.trial_start_t = None
 
         # set foodspot parameters and variables
         self.foodspots = []  # stores the x,y location of foodspots
         self.food_rad = 0.005  # radius of foodspot
-        self.fly_movement_threshold = 0.5e-3  # amount the camx or camy must be greater than to say the fly is moving
         self.food_boundary_hysteresis = 0.1  # 0.01 #time
         self.food_distance_hysteresis = 0.005  # distance
 
+        # optional precomputed reward map (replaces foodspots when set).  reward_map_path is a .npy file
+        # or a directory with one .npy file per trial; map values >= reward_threshold count as food
+        self.reward_map = None
+        self.reward_map_path = None
+        self.reward_map_resolution = 1e-3 #meters per pixel
+        self.reward_threshold = 1
+        self.reward_level = 0
+
         # Set foraging parameters
         self.foraging = False  #if foraging button selected in GUI this will change to true
         self.foraging_distance_min = 0.03 #distane from center requirement in meters
         self.path_distance_min = 0.01 #min walk distance from a foodspot to make more food
         self.min_dist_from_food = 0.05  # in meters. min geo distance the fly must walk to get a new foodspot
-        self.distance_since_last_food = 0  #needs to start at 0 resets each time gets food, this is path distance
-        self.list_prev_y = [0]  #involved in tracking the total distance the fly walks
-        self.list_prev_x = [0]  #involved in tracking the total distance the fly walks
+        self.trajectory = TrajectoryMetrics(min_step=0.005)  #path length, path distance since food (resets each time gets food), speed and moving state; requires moves half a cm before updating path
         self.max_foodspots = 90  # to control the number of foodspots (set high, but this won't turn on unless selected)
         self.time_since_last_food_min = 30  # in sec minimum amount of time required to elapse before food made
-        self.total_distance = 0  #collects running total of distance walked
         self.distance_away_required = .03  # this is the distance away from a foodspot a fly needs to walk for the override of the off time
 
         #set foodspot creation parameters
@@ -79,7 +109,6 @@ class OptoThread(Service):
         self.far_from_food = False #state to store if fly is far enough away from previous foodspot
         self.distance_correct = False  #true if fly is far enough away from the center
         self.path_distance_correct = False  #true if fly has walked far enough since the previous food (path style)
-        self.fly_moving = False #true if fly is moving
         self.more_food = True #if false then reached max foodspots or max duration
         self.time_override = False  ##if true will override time off restriction if the fly is self.distance_away_required away from foodspot
         self.dist_from_center = None #straight line distance from center
@@ -134,16 +163,25 @@ class OptoThread(Service):
         # call constructor from parent        
         super().__init__(maxTime=maxTime, minTime=minTime)
 
+        if fast_trigger:
+            self.enableFastTrigger()
+
     # overriding method from parent...
     def loopBody(self):
         if self.trial_start_t is None:
             self.off()
 
+        if self.led_keepalive is not None and (self.clock() - self.last_command_t) >= self.led_keepalive:
+            with self.ledLock:
+                self.write(self.ON_COMMAND if self.led_status == 'on' else self.OFF_COMMAND)
+
         ### Get Fly Position ###
 
-        if self.camThread is not None and self.camThread.fly is not None:
-            self.camX = self.camThread.fly.centerX
-            self.camY = self.camThread.fly.centerY
+        fly = self.camThread.fly if self.camThread is not None else None
+        if fly is not None:
+            self.camX = fly.centerX
+            self.camY = fly.centerY
+            self.frame_t = self.camThread.fly_t
         else:
             self.camX = None
             self.camY = None
@@ -168,72 +206,72 @@ class OptoThread(Service):
             # calculate distance from center
             x_dist = np.abs(self.flyX) - np.abs(self.trackThread.center_pos_x)
             y_dist = np.abs(self.flyY) - np.abs(self.trackThread.center_pos_y)
-            self.dist_from_center = np.sqrt(x_dist*x_dist + y_dist*y_dist)
-
-            # #Calculate total length of fly travel path (previous version
-            # immediate_distance = np.sqrt((abs(x_dist)-abs(self.list_prev_x[-1]))**2 + (abs(y_dist)-abs(self.list_prev_y[-1]))**2)
-            # self.list_prev_x.append(x_dist) #update list of checked values
-            # self.list_prev_y.append(y_dist)
-            # self.total_distance += immediate_distance  # running total
-            # self.distance_since_last_food += immediate_distance  # this resets with every foodspot
-
-            #1.26.26 new version with some euc movement required (choose based on distance from center)
-            #need it not to update for every twitch the fly does. require distance of some value before adding to path
-            #Calculate total length of fly travel path
-            immediate_distance = np.sqrt((abs(x_dist)-abs(self.list_prev_x[-1]))**2 + (abs(y_dist)-abs(self.list_prev_y[-1]))**2)
-            if immediate_distance > .005: #requires moves half a cm before updating
-                self.list_prev_x.append(x_dist) #update list of checked values
-                self.list_prev_y.append(y_dist)
-                self.total_distance += immediate_distance  # running total
-                self.distance_since_last_food += immediate_distance  # this resets with every foodspot
-
-
-            if self.foraging:
-                # define food spot if all requirements are met
-                self.checkFoodCreation()
-
-                #if find that food should be created, record a foodspot and change shouldcreatefood state back to false
-                if self.shouldCreateFood and self.more_food == True: #more_food will be false if the duration of food allowed is reached or max foodspots reached
-                    self.defineFoodSpot()  #this records the foodspot x,y coordinates in foodspots and logs it in txt file
-                    self.on() #this may break things, but I think not. 
-                    self.shouldCreateFood = False
-
-                # changes fly_in_food state to true if fly is in foodspot by checking x,y positions with the food_radius as a buffer
-                #also resets the time_of_last_food and the distance_since_last_food
-                
-                for foodspot in self.foodspots:
-                    if foodspot['x'] - self.food_rad <= self.flyX <= foodspot['x'] + self.food_rad and \
-                       foodspot['y'] - self.food_rad <= self.flyY <= foodspot['y'] + self.food_rad:
-                        self.time_of_last_food = time()
-                        self.distance_since_last_food = 0 #reset distance when get to food
-                        self.fly_in_food = True
-                        #print("fly in foodspot!")
-                        #print(foodspot)
-                        # #maybe I should have a condition that if it is not the most recent foodspot no other things matter except override and off time
-                        # if self.allowfoodspotreturns == True and foodspot != self.foodspots[-1]:
-                        #     if  self.fly_in_food == True: #if it isn't the last foodspot and the fly is in it
-                        #         self.fly_in_previous_foodspot = True
-                        #     else:
-                        #         self.fly_in_previous_foodspot = False
-                        continue
-
-                    else:
-                        self.fly_in_food = False
-                        # self.fly_in_previous_foodspot = False  ##can't put this here because it will check the last foodspot last
-
-                #set up checking for previous foodspots
-                if self.allowfoodspotreturns == True:
-                    for foodspot in self.foodspots[:-1]:  #since this is looking for previous foodspots, ignore the most recent one
+            self.dist_from_center = hypot(x_dist, y_dist)
+
+            #update running path length and speed (constant memory, only the last anchor point is kept)
+            self.trajectory.update(self.flyX, self.flyY, self.clock())
+
+            if self.foraging or self.reward_map is not None:
+                was_in_food = self.fly_in_food
+
+                if self.reward_map is not None:
+                    # reward geometry comes from a precomputed map, a single lookup per tick
+                    self.checkRewardMap()
+                else:
+                    # define food spot if all requirements are met
+                    self.checkFoodCreation()
+
+                    #if find that food should be created, record a foodspot and change shouldcreatefood state back to false
+                    if self.shouldCreateFood and self.more_food == True: #more_food will be false if the duration of food allowed is reached or max foodspots reached
+                        self.defineFoodSpot()  #this records the foodspot x,y coordinates in foodspots and logs it in txt file
+                        self.zone_entry_t = self.frame_t #the fly is in the new food from this frame on, for latency
+                        self.on() #this may break things, but I think not. 
+                        self.shouldCreateFood = False
+
+                    # changes fly_in_food state to true if fly is in foodspot by checking x,y positions with the food_radius as a buffer
+                    #also resets the time_of_last_food and the distance_since_last_food
+                    for foodspot in self.foodspots:
                         if foodspot['x'] - self.food_rad <= self.flyX <= foodspot['x'] + self.food_rad and \
                            foodspot['y'] - self.food_rad <= self.flyY <= foodspot['y'] + self.food_rad:
-                            self.time_of_last_food = time()
-                            self.distance_since_last_food = 0 #reset distance when get to food
+                            self.time_of_last_food = self.clock()
+                            self.trajectory.mark_food() #reset distance when get to food
                             self.fly_in_food = True
-                            self.fly_in_previous_foodspot = True
-                            print(f"fly returned to foodspot! {foodspot}")
+                            #print("fly in foodspot!")
+                            #print(foodspot)
+                            # #maybe I should have a condition that if it is not the most recent foodspot no other things matter except override and off time
+                            # if self.allowfoodspotreturns == True and foodspot != self.foodspots[-1]:
+                            #     if  self.fly_in_food == True: #if it isn't the last foodspot and the fly is in it
+                            #         self.fly_in_previous_foodspot = True
+                            #     else:
+                            #         self.fly_in_previous_foodspot = False
                             continue
+
                         else:
-                            self.fly_in_previous_foodspot = False
+                            self.fly_in_food = False
+                            # self.fly_in_previous_foodspot = False  ##can't put this here because it will check the last foodspot last
+
+                    #set up checking for previous foodspots
+                    if self.allowfoodspotreturns == True:
+                        for foodspot in self.foodspots[:-1]:  #since this is looking for previous foodspots, ignore the most recent one
+                            if foodspot['x'] - self.food_rad <= self.flyX <= foodspot['x'] + self.food_rad and \
+                               foodspot['y'] - self.food_rad <= self.flyY <= foodspot['y'] + self.food_rad:
+                                self.time_of_last_food = self.clock()
+                                self.trajectory.mark_food() #reset distance when get to food
+                                self.fly_in_food = True
+                                self.fly_in_previous_foodspot = True
+                                print(f"fly returned to foodspot! {foodspot}")
+                                continue
+                            else:
+                                self.fly_in_previous_foodspot = False
+
+                # remember when the fly entered food so the light latency can be logged (also with
+                # the fast trigger, which may miss entries that this loop turns the light on for)
+                if self.fly_in_food and not was_in_food:
+                    if self.led_status == 'off':
+                        self.zone_entry_t = self.frame_t
+                elif not self.fly_in_food:
+                    self.zone_entry_t = None
+
                 if self.allowfoodspotreturns is False and self.set_off_time == False: #if off_time is on it doesn't really matter if the fly walks over a foodspot again 
                     if self.fly_in_previous_foodspot == True: 
                         #don't make more food or turn on light!
@@ -245,35 +283,15 @@ class OptoThread(Service):
                     #the first line checks to make sure the light doesn't flicker on and off due to tracking issues by having a time hysteresis if the light had recently turned opn
                 #self.time_in_out_change resets every time the light turns off to keep track of off time
                 #if self.time_in_out_change is None or time() - self.time_in_out_change >= self.food_boundary_hysteresis: #boundary_hysteresis is in time
-                if time() - self.off_time_track >= self.food_boundary_hysteresis: #boundary_hysteresis is in time
+                if self.clock() - self.off_time_track >= self.food_boundary_hysteresis: #boundary_hysteresis is in time
 
                     if self.fly_in_food:
                         if self.led_status == 'off': #the light is off when the fly is in food if the fly has just entered food or led on time has elapsed
-                            if self.set_off_time == False and self.allowfoodspotreturns == True: #if don't care about off time elapsing then turn on
+                            if self.lightAllowed():
                                 self.on()
-                            elif self.set_off_time == False and self.allowfoodspotreturns == False: #if don't care about off time elapsing then turn on
-                                #need to make sure it's the first time
-                                if self.shouldCreateFood == True:
-                                    self.on()
-                            elif self.set_off_time == True and self.time_override == False:  #turn the light on only if off time has passed and it doesn't meet override criteria
-                                if (time() - self.off_time_track) > self.min_off_time: #if off time passage is greater than min off time then turn on
-                                    self.on()
-                            #if time override is true then allow foodspot to turn on even if time has not elapsed (check to make sure this doesn't always overrride distance)
-                            elif self.set_off_time == True and self.time_override == True and self.distance_away_reached == True: #turn the light on
-                                self.on()
-                                print('on because override allowed')
-                            #also need a condition so it will turn on if the time has elapsed even if teh override is true (could probably combo this into previous one, but I'll keep it separate)
-                            elif self.set_off_time == True and self.time_override == True and self.distance_away_reached == False:
-                                if (time() - self.off_time_track) > self.min_off_time: #if off time passage is greater than min off time then turn on
-                                    self.on()
-                                    print('on because of THIS condition at line 224')
-                            else:
-                                print('no light on, state not specified--distance away reached = ', self.distance_away_reached)
-
-
                         elif self.led_status == 'on':
                             if self.set_on_time == True: #turn the light off if it has been on too long
-                                if (time() - self.on_time_track) > self.max_on_time:
+                                if (self.clock() - self.on_time_track) > self.max_on_time:
                                     #self.time_in_out_change = time()  #6.5.20 adding this here because it doesn't make sense to only have it sometimes when the light turns off?
                                     self.off()
                     #this will only be true if allow previous foodspot returns is selected
@@ -298,13 +316,169 @@ class OptoThread(Service):
                             # even if fly has left foodspot then wait until time is up to turn off
                             elif self.full_light_on == True:  #if keep light on for on time selected
                                 if self.set_on_time == True:  # turn the light off if it has been on too long
-                                    if (time() - self.on_time_track) > self.max_on_time:
+                                    if (self.clock() - self.on_time_track) > self.max_on_time:
                                         #self.time_in_out_change = time()
                                         self.off()
 
 
 
 
+    def resetTrial(self):
+        # reset foodspots and foraging state between trials
+        self.foodspots = []
+        self.closest_food = None
+        self.fly_in_food = False
+
+        self.dist_from_center = None
+        self.trajectory.reset()
+        self.far_from_food = False
+        self.distance_correct = False  # for center
+        self.path_distance_correct = False  # total path
+
+        self.long_time_since_food = True
+        self.shouldCreateFood = False
+        self.time_of_last_food = None
+        self.time_since_last_food = None
+
+    def randomizeTrialParameters(self):
+        # pick this trial's randomized parameters; returns what was chosen so it can be recorded
+        chosen = {}
+        if self.shouldRandomizeOffTime == True:
+            self.min_off_time = choice([10, 20, 40, 60])
+            print(f'min off time by randomize chosen = {self.min_off_time}')
+            chosen["min off time chosen"] = self.min_off_time
+        if self.shouldRandomizeFoodDistance == True:
+            self.shouldCheckFoodDistance = True
+            self.min_dist_from_food = choice([.15, .05]) #, 40, 60]) #not currently set in GUI to specify these
+            print(f'min euc distance from food by randomize chosen = {self.min_dist_from_food}')
+            chosen["food euc distance chosen"] = self.min_dist_from_food
+        if self.shouldRandomizePathDistance == True:
+            self.path_distance_min = choice([ .05, .15]) #, 40, 60]) #not currently set in GUI to specify these
+            #self.distance_away_required = choice([5, 15]) #distance_away_required is for off_time override not for distance
+            self.shouldCheckTotalPathDistance = True
+            print(f'min path distance from food by randomize chosen = {self.path_distance_min}')
+            chosen["food path distance chosen"] = self.path_distance_min
+        return chosen
+
+    def lightAllowed(self):
+        # decides whether the light may turn on now that the fly is in food (the light is off)
+        # this is shared by the opto loop and the camera-thread fast path
+        off_elapsed = self.clock() - self.off_time_track
+        if off_elapsed < self.food_boundary_hysteresis: #boundary_hysteresis is in time
+            return False
+
+        if self.set_off_time == False and (self.allowfoodspotreturns == True or self.reward_map is not None): #if don't care about off time elapsing then turn on
+            return True
+        elif self.set_off_time == False and self.allowfoodspotreturns == False:
+            #need to make sure it's the first time
+            return self.shouldCreateFood
+        elif self.time_override == True and self.distance_away_reached == True:
+            #if time override is true then allow foodspot to turn on even if time has not elapsed
+            return True
+        else:
+            #turn the light on only if off time has passed
+            return off_elapsed > self.min_off_time
+
+    def inTriggerZone(self, x, y):
+        reward_map = self.reward_map
+        if reward_map is not None:
+            return reward_map.lookup(x - self.trackThread.center_pos_x, y - self.trackThread.center_pos_y) >= self.reward_threshold
+
+        # the light is controlled by the most recent foodspot, and by older ones only if returns are allowed
+        foodspots = self.foodspots
+        if self.allowfoodspotreturns:
+            candidates = foodspots
+        else:
+            candidates = foodspots[-1:]
+
+        for foodspot in candidates:
+            if foodspot['x'] - self.food_rad <= x <= foodspot['x'] + self.food_rad and \
+               foodspot['y'] - self.food_rad <= y <= foodspot['y'] + self.food_rad:
+                return True
+        return False
+
+    def checkRewardMap(self):
+        self.reward_level = self.reward_map.lookup(self.flyX - self.trackThread.center_pos_x,
+                                                   self.flyY - self.trackThread.center_pos_y)
+        if self.reward_level >= self.reward_threshold:
+            self.time_of_last_food = self.clock()
+            self.trajectory.mark_food() #reset distance when get to food
+            self.fly_in_food = True
+        else:
+            self.fly_in_food = False
+
+    def prepareRewardMap(self, trial_num):
+        # load the next trial's reward map ahead of time
+        if self.reward_map_path is None:
+            self.preparedRewardMap = None
+            return
+
+        reward_map = reward_map_for_trial(self.reward_map_path, trial_num, resolution=self.reward_map_resolution)
+        self.preparedRewardMap = (trial_num, reward_map)
+
+    def loadRewardMap(self, trial_num):
+        if self.reward_map_path is None:
+            self.reward_map = None
+            return
+
+        prepared = self.preparedRewardMap
+        self.preparedRewardMap = None
+        if prepared is not None and prepared[0] == trial_num:
+            self.reward_map = prepared[1]
+        else:
+            self.reward_map = reward_map_for_trial(self.reward_map_path, trial_num, resolution=self.reward_map_resolution)
+        self.reward_level = 0
+        print(f'loaded reward map {self.reward_map.name}')
+        with self.logLock:
+            if self.logFile is not None:
+                self.logFile.write('{}, {}, {}\n'.format('reward-map', precise_time(), self.reward_map.name))
+
+    ### Fast path: check trigger zones on every camera frame ###
+    def enableFastTrigger(self):
+        if self.camThread is None:
+            print('Cannot enable opto fast trigger without a camera thread.')
+            return
+        self.fast_trigger = True
+        self.camThread.add_fly_listener(self.onFlyFrame)
+
+    def disableFastTrigger(self):
+        self.fast_trigger = False
+        if self.camThread is not None:
+            self.camThread.remove_fly_listener(self.onFlyFrame)
+
+    def onFlyFrame(self, fly, frame_t):
+        # called from the camera thread for each processed frame, so it must stay cheap
+        if fly is None or self.trial_start_t is None or not (self.foraging or self.reward_map is not None):
+            self.fast_in_zone = False
+            return
+
+        cnc_status = self.cncThread.status if self.cncThread is not None else None
+        if cnc_status is None:
+            return
+
+        in_zone = self.inTriggerZone(fly.centerX + cnc_status.posX, fly.centerY + cnc_status.posY)
+        if in_zone and not self.fast_in_zone:
+            if self.led_status == 'off':
+                self.fast_entry_t = frame_t
+                if self.lightAllowed():
+                    self.on()
+        elif not in_zone:
+            self.fast_entry_t = None
+        self.fast_in_zone = in_zone
+
+    @property
+    def total_distance(self):
+        return self.trajectory.total_distance
+
+    @property
+    def distance_since_last_food(self):
+        return self.trajectory.distance_since_last_food
+
+    @property
+    def fly_moving(self):
+        # true if fly is moving (speed with hysteresis, from the trajectory metrics)
+        return self.trajectory.moving
+
     def checkFoodCreation(self):
 
         ### Check - make sure food isn't too close to other food ###
@@ -352,7 +526,7 @@ class OptoThread(Service):
 
         ### Check - make sure the fly hasn't recently passed through a spot ###
         if self.time_of_last_food is not None:
-            self.time_since_last_food = time() - self.time_of_last_food
+            self.time_since_last_food = self.clock() - self.time_of_last_food
             if self.time_since_last_food > self.time_since_last_food_min:
                 self.long_time_since_food = True
             else:
@@ -360,14 +534,6 @@ class OptoThread(Service):
         else:
             self.long_time_since_food = True  #since the fly wouldnt have had food yet
 
-        ### Check - make sure fly is moving ###
-        if self.camX is not None:
-            if abs(self.camX) > self.fly_movement_threshold or \
-               abs(self.camY) > self.fly_movement_threshold:
-               self.fly_moving = True
-            else:
-                self.fly_moving = False
-
 
         #adding criteria that foodspot not be at the same location or very close to another foodspot (must be food_distance_hysteresis away even if no other restrictions)
         if self.closest_food is not None:
@@ -412,21 +578,21 @@ class OptoThread(Service):
         ## add max time for foodspots here (i.e. 2 minutes of foodspots allowed (at other parameters and then no more))
         #this is new! test! 20240821
         if self.shouldCheckMaxFoodTime:
-            if self.trial_start_t and (time() - self.trial_start_t)  >= self.max_food_time: ##self.trial_start_t is set to time() at the start of the trial 
+            if self.trial_start_t and (self.clock() - self.trial_start_t)  >= self.max_food_time: ##self.trial_start_t is set to time() at the start of the trial 
                 self.shouldCreateFood = False   
                 self.more_food = False
                 print(f"no more food because allowed duration for food has elapsed. Duration = {self.max_food_time} s ")
         
         #if the on time has not elapsed then another foodspot should not be made either
         #not sure why there are still a couple foodspots if the fly moves while light remains on...7.22.22
-        if self.set_on_time and (time() - self.on_time_track) <= self.max_on_time: 
+        if self.set_on_time and (self.clock() - self.on_time_track) <= self.max_on_time: 
             self.shouldCreateFood = False
             self.on_time_correct = False
             print("no new food because on time not over")
             return
 
         #food should not be made if off time has not elapsed and time override is false
-        if self.time_override == False and self.set_off_time and (time() - self.off_time_track) <= self.min_off_time: #if the on time has not elapsed then another foodspot should not be made either
+        if self.time_override == False and self.set_off_time and (self.clock() - self.off_time_track) <= self.min_off_time: #if the on time has not elapsed then another foodspot should not be made either
             self.shouldCreateFood = False
             self.on_time_correct = False
             return
@@ -458,22 +624,44 @@ class OptoThread(Service):
 
 
     def on(self):
-        print('TURNED ON (in opto)')
-        self.led_status = 'on'
-        self.logLED(self.led_status)
-        self.write(self.ON_COMMAND)
-        self.on_time_track = time()
+        with self.ledLock:
+            # only talk to the arduino and log if the light actually changes
+            if self.led_status != 'on':
+                #print('TURNED ON (in opto)')
+                self.led_status = 'on'
+                self.write(self.ON_COMMAND)
+                self.logLED(self.led_status)
+
+                # latency from the frame where the fly entered food to the light command
+                entries = [t for t in (self.zone_entry_t, self.fast_entry_t) if t is not None]
+                if len(entries) > 0:
+                    latency = self.clock() - min(entries)
+                    self.light_latency.add(latency)
+                    self.logLatency(latency)
+                self.zone_entry_t = None
+                self.fast_entry_t = None
+            self.on_time_track = self.clock()
 
     def off(self):
-        #print('TURNED OFF')
-        self.led_status = 'off'
-        self.logLED(self.led_status)
-        self.write(self.OFF_COMMAND)
-        self.off_time_track = time()
-        #self.time_in_out_change = time()
+        with self.ledLock:
+            if self.led_status != 'off':
+                #print('TURNED OFF')
+                self.led_status = 'off'
+                self.write(self.OFF_COMMAND)
+                self.logLED(self.led_status)
+            self.off_time_track = self.clock()
+            #self.time_in_out_change = time()
+
+    def cleanup(self):
+        self.disableFastTrigger()
+
+    def close(self):
+        # releases the serial port of a thread that is not running
+        self.ser.close()
 
     def write(self, cmd):
         self.ser.write(bytearray([cmd]))
+        self.last_command_t = self.clock()
 
     def pulse(self, on_duration=5, off_duration=5):
         def target():
@@ -496,23 +684,19 @@ class OptoThread(Service):
     def logLED(self, led_status):
         with self.logLock:
             if self.logFile is not None:
-                print("log file not none in led status logging")
-                self.logFile.write('{}, {}, {}\n'.format('led', time(), led_status))
-                self.logFile.flush()
+                self.logFile.write('{}, {}, {}\n'.format('led', precise_time(), led_status))
 
     def logFood(self, x, y):
         #print("log food called")
         with self.logLock:
             if self.logFile is not None:
-                self.logFile.write('{}, {}, {}, {}\n'.format('food', time(), x, y))
-                self.logFile.flush()
+                self.logFile.write('{}, {}, {}, {}\n'.format('food', precise_time(), x, y))
                 print("foodspot logged")
 
     def logFoodRemoval(self):
         with self.logLock:
             if self.logFile is not None:
-                self.logFile.write('{}, {}\n'.format('food-removed', time()))
-                self.logFile.flush()
+                self.logFile.write('{}, {}\n'.format('food-removed', precise_time()))
 
     # def logFoodRevisitNoFood(self, x, y):
     #     with self.logLock:
@@ -520,6 +704,11 @@ class OptoThread(Service):
     #             self.logFile.write('{}, {}, {}, {}\n'.format('food-revisited but not given food', time(), x, y))
     #             self.logFile.flush()
 
+    def logLatency(self, latency):
+        with self.logLock:
+            if self.logFile is not None:
+                self.logFile.write('{}, {}, {}\n'.format('latency', precise_time(), latency))
+
     def startLogging(self, logFile):
         with self.logLock:
             self.logState = True
@@ -528,9 +717,12 @@ class OptoThread(Service):
                 self.logFile.close()
                 print("log file closed")
 
-            self.logFile = open(logFile, 'w')
+            # log lines are written out by the disk writer
+            self.logFile = self.takePreparedLog(logFile)
             print("logFile opened")
-            self.logFile.write('time, LED Status\n')
+
+    def openLog(self, logFile):
+        return disk_writer().open_text(logFile, header='time, LED Status\n')
 
     def stopLogging(self):
         with self.logLock:
@@ -0,0 +1,121 @@
+import numpy as np
+
+class PassageDetector:
+    # Detects flies in the dispenser tunnel from line-scan frames.  Each pixel keeps an
+    # exponentially weighted mean and variance of its background, and a fly shows up as pixels
+    # whose z-score against that background is large.  Pixels that currently look like a fly
+    # are not folded into the background, so a fly sitting still does not fade away.
+    def __init__(self,
+                 gate_start, # first pixel of the gate region
+                 gate_end, # first pixel downstream of the gate
+                 num_pixels=128,
+                 alpha=0.02, # weight of each new frame in the background statistics
+                 warmup_frames=20, # frames used to estimate the initial background
+                 gate_z=4.0, # z-score for a gate pixel to count as occupied
+                 passed_z=4.0, # z-score for a downstream pixel to count as a passing fly
+                 gate_pixels_needed=2, # gate is occupied if at least this many pixels are
+                 passed_pixels_needed=3, # fly has passed if at least this many pixels are
+                 min_std=1.0 # lower bound on the per-pixel noise, in ADC counts
+                 ):
+
+        # store settings
+        self.gate_start = gate_start
+        self.gate_end = gate_end
+        self.num_pixels = num_pixels
+        self.alpha = alpha
+        self.warmup_frames = warmup_frames
+        self.gate_z = gate_z
+        self.passed_z = passed_z
+        self.gate_pixels_needed = gate_pixels_needed
+        self.passed_pixels_needed = passed_pixels_needed
+        self.min_std = min_std
+
+        # background statistics
+        self.mean = np.zeros(num_pixels)
+        self.var = np.ones(num_pixels)
+        self.std = np.ones(num_pixels)
+
+        # ring of recent frames, used to get a robust initial background
+        self.ring = np.zeros((warmup_frames, num_pixels))
+        self.ring_index = 0
+
+        # per-frame work buffers, allocated once
+        self.frame = np.zeros(num_pixels)
+        self.diff = np.zeros(num_pixels)
+        self.incr = np.zeros(num_pixels)
+        self.scale = np.zeros(num_pixels)
+        self.z = np.zeros(num_pixels)
+        self.abs_z = np.zeros(num_pixels)
+        self.background = np.zeros(num_pixels, dtype=bool)
+
+        self.reset()
+
+    def reset(self):
+        # start estimating the background over again, e.g. after the gate moved
+        self.frame_count = 0
+        self.ring_index = 0
+        self.z[:] = 0
+        self.abs_z[:] = 0
+
+        self.gate_count = 0
+        self.passed_count = 0
+
+    @property
+    def warmed_up(self):
+        return self.frame_count >= self.warmup_frames
+
+    def update(self, frame):
+        self.frame[:] = frame
+
+        # keep recent frames in the ring
+        self.ring[self.ring_index] = self.frame
+        self.ring_index = (self.ring_index + 1) % self.warmup_frames
+        self.frame_count += 1
+
+        if not self.warmed_up:
+            return
+
+        if self.frame_count == self.warmup_frames:
+            # median/MAD over the warm-up frames, so that a fly passing during warm-up
+            # does not end up in the background
+            np.median(self.ring, axis=0, out=self.mean)
+            np.median(np.abs(self.ring - self.mean), axis=0, out=self.std)
+            self.std *= 1.4826
+            np.maximum(self.std, self.min_std, out=self.std)
+            np.square(self.std, out=self.var)
+
+        # z-scores against the background
+        np.subtract(self.frame, self.mean, out=self.diff)
+        np.divide(self.diff, self.std, out=self.z)
+        np.abs(self.z, out=self.abs_z)
+
+        self.gate_count = int(np.count_nonzero(self.abs_z[self.gate_start:self.gate_end] > self.gate_z))
+        self.passed_count = int(np.count_nonzero(self.abs_z[self.gate_end:] > self.passed_z))
+
+        # update statistics for background pixels only
+        np.less_equal(self.abs_z, min(self.gate_z, self.passed_z), out=self.background)
+        np.multiply(self.diff, self.alpha, out=self.incr)
+        self.incr *= self.background
+        self.mean += self.incr
+
+        self.diff *= self.incr
+        self.var += self.diff
+        np.multiply(self.background, -self.alpha, out=self.scale)
+        self.scale += 1
+        self.var *= self.scale
+
+        np.maximum(self.var, self.min_std*self.min_std, out=self.var)
+        np.sqrt(self.var, out=self.std)
+
+    @property
+    def gate_clear(self):
+        return self.warmed_up and self.gate_count < self.gate_pixels_needed
+
+    @property
+    def fly_passed(self):
+        return self.warmed_up and self.passed_count >= self.passed_pixels_needed
+
+    def masks(self):
+        # copies of the current occupied-pixel masks for the gate and downstream regions
+        return (self.abs_z[self.gate_start:self.gate_end] > self.gate_z,
+                self.abs_z[self.gate_end:] > self.passed_z)
@@ -0,0 +1,50 @@
+import os.path
+import numpy as np
+
+from math import floor
+
+class RewardMap:
+    def __init__(self,
+                 data, # 2D raster, data[row, col] with rows along y and columns along x
+                 resolution, # size of one pixel in meters
+                 origin=None, # arena (x, y) of the outer corner of pixel [0, 0], in meters
+                 name=None
+                 ):
+
+        self.data = np.ascontiguousarray(data)
+        if self.data.ndim != 2:
+            raise Exception('Reward map must be a 2D array.')
+
+        self.rows, self.cols = self.data.shape
+        self.resolution = resolution
+        self.inv_resolution = 1.0/resolution
+
+        # by default the map is centered on the arena center
+        if origin is None:
+            origin = (-self.cols*resolution/2, -self.rows*resolution/2)
+        self.origin_x, self.origin_y = origin
+
+        self.name = name
+
+    @classmethod
+    def load(cls, path, resolution, origin=None):
+        return cls(np.load(path), resolution=resolution, origin=origin, name=os.path.basename(path))
+
+    def lookup(self, x, y):
+        # x, y are arena coordinates (meters from the arena center); outside the map there is no reward
+        col = floor((x - self.origin_x)*self.inv_resolution)
+        row = floor((y - self.origin_y)*self.inv_resolution)
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            return self.data.item(row, col)
+        return 0
+
+def reward_map_for_trial(path, trial_num, resolution, origin=None):
+    # path is either a single .npy file used for every trial, or a directory of .npy
+    # files that are used in sorted order, one per trial
+    if os.path.isdir(path):
+        files = sorted(f for f in os.listdir(path) if f.endswith('.npy'))
+        if len(files) == 0:
+            raise Exception('No reward maps found in {}.'.format(path))
+        path = os.path.join(path, files[(trial_num - 1) % len(files)])
+
+    return RewardMap.load(path, resolution=resolution, origin=origin)
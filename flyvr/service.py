@@ -77,3 +77,36 @@ class Service:
     # subclasses should override loop body
     def loopBody(self):
         pass
+
+class PreparedLogging:
+    # Mixin for services whose log files can be opened ahead of time, so that starting a trial only
+    # has to swap them in.  The service provides logLock and openLog(*paths), which returns the
+    # log handle (or a tuple of handles) for those paths; startLogging calls takePreparedLog.
+    preparedLog = None
+
+    def prepareLogging(self, *paths):
+        log = self.openLog(*paths)
+        self.cancelPreparedLogging()
+        with self.logLock:
+            self.preparedLog = (paths, log)
+
+    def cancelPreparedLogging(self):
+        with self.logLock:
+            if self.preparedLog is not None:
+                self.closeLog(self.preparedLog[1])
+            self.preparedLog = None
+
+    def takePreparedLog(self, *paths):
+        # returns the log prepared for these paths, or opens it now; called with logLock held
+        if self.preparedLog is not None and self.preparedLog[0] == paths:
+            log = self.preparedLog[1]
+        else:
+            if self.preparedLog is not None:
+                self.closeLog(self.preparedLog[1])
+            log = self.openLog(*paths)
+        self.preparedLog = None
+        return log
+
+    def closeLog(self, log):
+        for handle in (log if isinstance(log, tuple) else (log, )):
+            handle.close()
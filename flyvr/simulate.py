@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Offline foraging-protocol simulator.  Recorded trials (cam.txt + cnc.txt) are replayed through
+# OptoThread's decision logic on a virtual clock, with the opto serial port replaced by a recorder,
+# so that protocol parameters can be compared before spending rig time.
+#
+# example:
+#   python -m flyvr.simulate /mnt/fly-data/FlyVR/exp-*/trial-* --grid grid.json --out sweep.csv
+# where grid.json maps OptoThread attribute names to lists of values, e.g.
+#   {"min_off_time": [10, 20, 40], "set_off_time": [true], "path_distance_min": [0.01, 0.05]}
+
+import os, os.path
+import io
+import json
+import random
+import argparse
+import itertools
+import contextlib
+import numpy as np
+
+from multiprocessing import Pool
+
+from flyvr.opto import OptoThread
+
+class SimClock:
+    def __init__(self, t=0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+class SerialRecorder:
+    # stands in for the opto serial port, keeping every command byte with its (virtual) time
+    def __init__(self, clock):
+        self.clock = clock
+        self.commands = []
+
+    def write(self, data):
+        t = self.clock()
+        for byte in data:
+            self.commands.append((t, byte))
+
+class SimFly:
+    def __init__(self, centerX, centerY):
+        self.centerX = centerX
+        self.centerY = centerY
+
+class SimCncStatus:
+    def __init__(self, posX, posY):
+        self.posX = posX
+        self.posY = posY
+
+# minimal stand-ins for the camera, CNC and tracker threads that OptoThread reads from
+class SimCam:
+    def __init__(self):
+        self.fly = None
+        self.fly_t = None
+
+class SimCnc:
+    def __init__(self):
+        self.status = None
+
+class SimTracker:
+    def __init__(self, center_pos_x, center_pos_y):
+        self.center_pos_x = center_pos_x
+        self.center_pos_y = center_pos_y
+
+def load_trajectory(trial_dir):
+    # camera samples only exist while the fly was found; CNC position is interpolated onto them
+    cam = np.loadtxt(os.path.join(trial_dir, 'cam.txt'), delimiter=',', skiprows=1, ndmin=2)
+    cnc = np.loadtxt(os.path.join(trial_dir, 'cnc.txt'), delimiter=',', skiprows=1, ndmin=2)
+
+    # cam.txt starts with the pre-trigger frames from before the trial; replay from the trial
+    # start (trial.json is missing for trials recorded before it was written)
+    trial_file = os.path.join(trial_dir, 'trial.json')
+    if os.path.exists(trial_file):
+        with open(trial_file, 'r') as f:
+            start_t = json.load(f)['start_t']
+        cam = cam[cam[:, 0] >= start_t]
+
+    t = cam[:, 0]
+    return {'name': os.path.basename(os.path.normpath(trial_dir)),
+            't': t,
+            'camX': cam[:, 1],
+            'camY': cam[:, 2],
+            'cncX': np.interp(t, cnc[:, 0], cnc[:, 1]),
+            'cncY': np.interp(t, cnc[:, 0], cnc[:, 2])}
+
+def led_on_time(commands, t_end):
+    # total time the LED was commanded on
+    on_time = 0
+    on_since = None
+    for t, cmd in commands:
+        if cmd == OptoThread.ON_COMMAND and on_since is None:
+            on_since = t
+        elif cmd == OptoThread.OFF_COMMAND and on_since is not None:
+            on_time += t - on_since
+            on_since = None
+    if on_since is not None:
+        on_time += t_end - on_since
+    return on_time
+
+def simulate(trajectory, params, tick=5e-3, max_gap=0.1, seed=0,
+             center_pos_x=0.348625, center_pos_y=0.332775):
+    t = trajectory['t']
+    if len(t) == 0:
+        raise Exception('Empty trajectory.')
+
+    # randomized protocol parameters are drawn from the seed so that runs are repeatable
+    random.seed(seed)
+
+    clock = SimClock(t[0])
+    ser = SerialRecorder(clock)
+    cam = SimCam()
+    cnc = SimCnc()
+    tracker = SimTracker(center_pos_x, center_pos_y)
+
+    opto = OptoThread(cncThread=cnc, camThread=cam, trackThread=tracker, ser=ser, clock=clock)
+    opto.foraging = True
+    for key, value in params.items():
+        if not hasattr(opto, key):
+            raise Exception('Unknown opto parameter: {}'.format(key))
+        setattr(opto, key, value)
+
+    # same trial start sequence as TrialThread
+    opto.loadRewardMap(1)
+    opto.resetTrial()
+    opto.trial_start_t = clock()
+    opto.randomizeTrialParameters()
+
+    # step the opto loop on its own period, holding the latest camera sample like the live system
+    camX, camY = trajectory['camX'], trajectory['camY']
+    cncX, cncY = trajectory['cncX'], trajectory['cncY']
+    idx = 0
+    n = len(t)
+    for now in np.arange(t[0], t[-1], tick):
+        clock.t = now
+        while idx + 1 < n and t[idx + 1] <= now:
+            idx += 1
+
+        if now - t[idx] <= max_gap:
+            cam.fly = SimFly(camX[idx], camY[idx])
+            cam.fly_t = t[idx]
+            cnc.status = SimCncStatus(cncX[idx], cncY[idx])
+        else:
+            cam.fly = None
+
+        opto.loopBody()
+
+    latency = opto.light_latency
+    return {'trial': trajectory['name'],
+            'duration': float(t[-1] - t[0]),
+            'foodspots': len(opto.foodspots),
+            'led_on_time': float(led_on_time(ser.commands, t[-1])),
+            'led_onsets': sum(1 for _, cmd in ser.commands if cmd == OptoThread.ON_COMMAND),
+            'reward_latency_mean': float(latency.mean) if latency.count else None,
+            'reward_latency_max': float(latency.max) if latency.count else None,
+            'path_length': float(opto.total_distance)}
+
+# one trajectory per trial directory is cached in each worker process
+_trajectory_cache = {}
+
+def _run_job(job):
+    trial_dir, params, tick, seed = job
+    if trial_dir not in _trajectory_cache:
+        _trajectory_cache[trial_dir] = load_trajectory(trial_dir)
+
+    # the opto logic prints a lot of state while it runs, which is not useful here
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = simulate(_trajectory_cache[trial_dir], params, tick=tick, seed=seed)
+
+    result.update(params)
+    return result
+
+def parameter_grid(grid):
+    keys = sorted(grid.keys())
+    for values in itertools.product(*[grid[key] for key in keys]):
+        yield dict(zip(keys, values))
+
+def sweep(trial_dirs, grid, tick=5e-3, seed=0, processes=None):
+    jobs = [(trial_dir, params, tick, seed) for params in parameter_grid(grid) for trial_dir in trial_dirs]
+    with Pool(processes=processes) as pool:
+        return pool.map(_run_job, jobs)
+
+def write_results(results, fname):
+    columns = []
+    for result in results:
+        for key in result:
+            if key not in columns:
+                columns.append(key)
+
+    with open(fname, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for result in results:
+            f.write(','.join(str(result.get(key, '')) for key in columns) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded trials through the opto foraging logic.')
+    parser.add_argument('trial_dirs', nargs='+', help='trial directories containing cam.txt and cnc.txt')
+    parser.add_argument('--grid', default=None, help='JSON file mapping opto parameters to lists of values')
+    parser.add_argument('--out', default='sweep.csv', help='CSV file for the results')
+    parser.add_argument('--tick', type=float, default=5e-3, help='simulated opto loop period (s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for randomized protocol parameters')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    grid = {}
+    if args.grid is not None:
+        with open(args.grid, 'r') as f:
+            grid = json.load(f)
+
+    results = sweep(args.trial_dirs, grid, tick=args.tick, seed=args.seed, processes=args.processes)
+    write_results(results, args.out)
+
+    for result in results:
+        print(result)
+    print('Wrote {} results to {}'.format(len(results), args.out))
+
+if __name__ == '__main__':
+    main()
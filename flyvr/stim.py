@@ -3,14 +3,11 @@
 # Example client program that walks through all available stimuli.
 
 import json
-from flystim.stim_server import launch_stim_server
 from time import time
+from threading import Lock, Event
 
-from random import choice
-from math import pi
-
-from flystim.screen import Screen
-from flyrpc.multicall import MyMultiCall
+from random import Random
+from math import pi, hypot
 
 from time import sleep
 
@@ -18,12 +15,19 @@ import numpy as np
 
 import os, os.path
 
+from collections import deque
+
+from flyvr.service import Service
+from flyvr.util import LatencyStats, ValueStats
+from flyvr.writer import disk_writer
 
 
 def pretty_json(d):
     return json.dumps(d, indent=2, sort_keys=True)
 
 def get_bigrig_screen(dir):
+    from flystim.screen import Screen
+
     w = 43 * 2.54e-2
     h = 24 * 2.54e-2
 
@@ -58,10 +62,134 @@ def get_bigrig_screen(dir):
     return Screen(id=id, server_number=1, rotation=rotation, width=w, height=h, offset=offset, fullscreen=fullscreen,
                   name='BigRig {} Screen'.format(dir.title()))
 
-class StimThread:
-    def __init__(self, angle_change_thresh=3):
-        screens = [get_bigrig_screen(dir) for dir in ['n', 'e', 's', 'w', 'gui']]
-        self.manager = launch_stim_server(screens)
+class PoseExtrapolator:
+    # Predicts the fly pose a short time ahead, from its velocity and angular velocity fit by least
+    # squares over the last window seconds of samples.  Each prediction is later compared with
+    # the pose the fly actually had at that time (interpolated between samples), along with the
+    # error of simply showing the latest sample, as done without extrapolation.
+    def __init__(self, window=50e-3, max_horizon=0.1, max_samples=16):
+        self.window = window
+        self.max_horizon = max_horizon
+
+        self.samples = deque(maxlen=max_samples)
+        self.pending = deque(maxlen=max_samples)
+
+        self.pos_error = ValueStats('mm', scale=1e3)
+        self.angle_error = ValueStats('deg')
+        self.held_pos_error = ValueStats('mm', scale=1e3)
+        self.held_angle_error = ValueStats('deg')
+
+    def reset(self):
+        self.samples.clear()
+        self.pending.clear()
+
+    def reset_stats(self):
+        for stats in [self.pos_error, self.angle_error, self.held_pos_error, self.held_angle_error]:
+            stats.reset()
+
+    def add(self, t, x, y, angle):
+        # angle may be None (no orientation estimate); the position is still tracked
+        if t is None or x is None or y is None:
+            # fly lost; start over once it is found again
+            self.reset()
+            return
+
+        if len(self.samples) > 0:
+            last_t, _, _, last_angle = self.samples[-1]
+            if t <= last_t:
+                # same camera frame as before
+                return
+
+            # unwrap the angle so that velocities are continuous across +/-180 degrees
+            if angle is not None and last_angle is not None:
+                angle = last_angle + ((angle - last_angle + 180) % 360 - 180)
+
+            self.check_predictions(self.samples[-1], (t, x, y, angle))
+
+        self.samples.append((t, x, y, angle))
+
+    def check_predictions(self, prev, sample):
+        t0, x0, y0, a0 = prev
+        t1, x1, y1, a1 = sample
+
+        while len(self.pending) > 0 and self.pending[0][0] <= t1:
+            target_t, predicted, held = self.pending.popleft()
+            if target_t < t0:
+                continue
+
+            # actual pose at the target time
+            f = (target_t - t0) / (t1 - t0)
+            x = x0 + f*(x1 - x0)
+            y = y0 + f*(y1 - y0)
+
+            self.pos_error.add(hypot(predicted[0] - x, predicted[1] - y))
+            self.held_pos_error.add(hypot(held[0] - x, held[1] - y))
+
+            if None not in [a0, a1, predicted[2], held[2]]:
+                angle = a0 + f*(a1 - a0)
+                self.angle_error.add(abs((predicted[2] - angle + 180) % 360 - 180))
+                self.held_angle_error.add(abs((held[2] - angle + 180) % 360 - 180))
+
+    def predict(self, target_t):
+        # returns the predicted (x, y, angle) at target_t, or None if there are no samples.  The
+        # angle is None if the latest sample has none
+        if len(self.samples) == 0:
+            return None
+
+        last_t, last_x, last_y, last_angle = self.samples[-1]
+        held = (last_x, last_y, last_angle)
+
+        recent = [sample for sample in self.samples if (last_t - sample[0]) <= self.window]
+        if len(recent) < 2:
+            return held
+
+        # least-squares slopes
+        n = len(recent)
+        mean_t = sum(s[0] for s in recent) / n
+        var_t = sum((s[0] - mean_t)**2 for s in recent)
+        if var_t <= 0:
+            return held
+
+        def slope(k):
+            return sum((s[0] - mean_t)*s[k] for s in recent) / var_t
+
+        horizon = min(max(target_t - last_t, 0), self.max_horizon)
+
+        # the angle is only extrapolated when every recent sample has one
+        if all(s[3] is not None for s in recent):
+            predicted_angle = last_angle + slope(3)*horizon
+        else:
+            predicted_angle = last_angle
+
+        predicted = (last_x + slope(1)*horizon,
+                     last_y + slope(2)*horizon,
+                     predicted_angle)
+
+        self.pending.append((target_t, predicted, held))
+
+        return predicted
+
+class StimThread(Service):
+    # The trial thread posts the latest fly pose with updateStim, which returns immediately.  This
+    # thread sends it to the stimulus server no faster than send_rate, so poses posted in between
+    # are coalesced into the newest one, and a pose whose camera frame is older than max_pose_age by
+    # the time it would be sent is dropped rather than shown late.
+    #
+    # Starting and stopping a trial's stimulus (nextTrial, stopStim) also happen on this thread.
+    #
+    # The pose that is sent is extrapolated to when it will be on screen, render_latency after it
+    # is sent, to make up for the camera, trial loop and rendering delays.
+    MODES = ['single_stim', 'multi_stim', 'multi_rotation', 'rotating_bars', 'corner_bars', 'loom']
+
+    def __init__(self, angle_change_thresh=3, send_rate=60, max_pose_age=50e-3, seed=None,
+                 schedule_duration=2*60*60, render_latency=30e-3, max_extrapolation=0.1,
+                 manager=None # already-launched stimulus server manager
+                 ):
+        if manager is None:
+            from flystim.stim_server import launch_stim_server
+            screens = [get_bigrig_screen(dir) for dir in ['n', 'e', 's', 'w', 'gui']]
+            manager = launch_stim_server(screens)
+        self.manager = manager
 
         self.manager.hide_corner_square()
 
@@ -73,7 +201,22 @@ class StimThread:
 
         self.mode = None
         self.stim_loaded = False
-        self.stim_state = {}
+
+        # per-trial stimulus schedule; seed=None draws a new sequence of trial seeds every run
+        self.seed = seed
+        self.seed_rng = None
+        self.schedule_duration = schedule_duration
+        self.stim_specs = []
+        self.stim_spec_json = []
+        self.schedule_t = np.zeros(0)
+        self.schedule_spec = np.zeros(0, dtype=np.int32)
+        self.schedule_pos = 0
+        self.schedule_start_t = None
+        self.schedule_rng = None
+        self.schedule_open = False
+        self.schedule_end = 0
+        self.schedule_next_t = 0
+        self.spec_index = {}
 
         self.closed_loop_pos = False
         self.closed_loop_angle = False
@@ -81,35 +224,113 @@ class StimThread:
         self.angle_change_thresh = angle_change_thresh
         self.last_angle = 0
 
-    def get_random_direction(self):
-        return choice([-400, -200, -100, -20, 20, 100, 200, 400])
-
-    def get_random_stim(self):
-        stim_type = choice(['SineGrating', 'SineGrating', 'Dark', 'Bright', 'Grey', 'RandomCheckerboard'])
-        if stim_type is 'SineGrating':
-            angle = choice([0, 90])
+        # latest pose posted by the trial thread
+        self.max_pose_age = max_pose_age
+        self.poseLock = Lock()
+        self.pose = None
+        self.new_pose = Event()
+
+        # pose extrapolation to the expected display time; render_latency=0 sends the latest pose
+        self.render_latency = render_latency
+        self.extrapolator = PoseExtrapolator(max_horizon=max_extrapolation)
+
+        # calls to the stimulus server are made from one thread at a time
+        self.managerLock = Lock()
+
+        # trial start/stop requests waiting for this thread
+        self.commandLock = Lock()
+        self.commands = []
+
+        # stimulus events of the current trial
+        self.logLock = Lock()
+        self.eventLog = None
+
+        # statistics
+        self.send_latency = LatencyStats()
+        self.pose_age = LatencyStats()
+        self.poses_posted = 0
+        self.poses_sent = 0
+        self.coalesced_count = 0
+        self.stale_count = 0
+
+        # call constructor from parent
+        super().__init__(minTime=1.0/send_rate, iter_warn=False)
+
+    def get_random_direction(self, rng):
+        return rng.choice([-400, -200, -100, -20, 20, 100, 200, 400])
+
+    def get_random_stim(self, rng):
+        stim_type = rng.choice(['SineGrating', 'SineGrating', 'Dark', 'Bright', 'Grey', 'RandomCheckerboard'])
+        if stim_type == 'SineGrating':
+            angle = rng.choice([0, 90])
             kwargs = {'name': 'SineGrating', 'angle': angle, 'period': 20, 'rate': 0, 'color': 1.0,
                       'background': 0.0}
-        elif stim_type is 'Grey':
+        elif stim_type == 'Grey':
             kwargs = {'name': 'ConstantBackground', 'background': 0.5}
-        elif stim_type is 'Dark':
+        elif stim_type == 'Dark':
             kwargs = {'name': 'ConstantBackground', 'background': 0.0}
-        elif stim_type is 'Bright':
+        elif stim_type == 'Bright':
             kwargs = {'name': 'ConstantBackground', 'background': 1.0}
-        elif stim_type is 'RandomCheckerboard':
+        elif stim_type == 'RandomCheckerboard':
             kwargs = {'name': 'RandomGrid', 'update_rate': 0}
         else:
             raise Exception('Invalid stimulus type.')
         return kwargs
 
-    def updateStim(self, trial_dir, fly_pos_x, fly_pos_y, fly_angle):
+    def updateStim(self, trial_dir, fly_pos_x, fly_pos_y, fly_angle, pose_t=None):
+        # called from the trial thread; never waits on the stimulus server.  pose_t is when the
+        # pose was measured (camera frame time)
+        if pose_t is None:
+            pose_t = time()
+
+        with self.poseLock:
+            if self.pose is not None:
+                self.coalesced_count += 1
+            self.pose = (pose_t, fly_pos_x, fly_pos_y, fly_angle)
+            self.extrapolator.add(pose_t, fly_pos_x, fly_pos_y, fly_angle)
+            self.poses_posted += 1
+
+        self.new_pose.set()
+
+    def loopBody(self):
+        self.new_pose.wait(0.1)
+        self.new_pose.clear()
+
+        self.run_commands()
+
+        with self.poseLock:
+            pose = self.pose
+            self.pose = None
+
         if self.manager is None:
             return
 
-        if not self.stim_loaded:
+        with self.managerLock:
+            if not self.stim_loaded:
+                return
+
+            if pose is not None:
+                self.send_pose(pose)
+
+            self.run_schedule(time() - self.schedule_start_t)
+
+    def send_pose(self, pose):
+        pose_t, fly_pos_x, fly_pos_y, fly_angle = pose
+
+        if (time() - pose_t) > self.max_pose_age:
+            self.stale_count += 1
             return
 
+        if self.render_latency > 0:
+            with self.poseLock:
+                predicted = self.extrapolator.predict(time() + self.render_latency)
+            if predicted is not None:
+                fly_pos_x, fly_pos_y, fly_angle = predicted
+                if fly_angle is not None:
+                    fly_angle = (fly_angle + 180) % 360 - 180
+
         # send fly position and orientation to stimulus
+        from flyrpc.multicall import MyMultiCall
         multicall = MyMultiCall(self.manager)
 
         if self.closed_loop_pos:
@@ -127,78 +348,165 @@ class StimThread:
             multicall.set_global_theta_offset(0)
 
         if len(multicall.request_list) > 0:
+            t0 = time()
             multicall()
+            t1 = time()
 
-        if self.mode == 'multi_rotation':
-            t = time()
-            if self.stim_state['paused']:
-                if (t-self.stim_state['last_update']) > self.pause_duration:
-                    rate = self.get_random_direction()
-                    kwargs = {'rate': rate}
-                    self.manager.update_stim(**kwargs)
-                    self.manager.start_stim()
-                    self.log_to_dir('UpdateStim: {}'.format(pretty_json(kwargs)), trial_dir)
-
-                    self.stim_state['last_update'] = t
-                    self.stim_state['paused'] = False
-            elif (t-self.stim_state['last_update']) > self.stim_duration:
-                self.manager.pause_stim()
-                self.log_to_dir('PauseStim', trial_dir)
-                self.stim_state['last_update'] = t
-                self.stim_state['paused'] = True
-        elif self.mode == 'single_stim':
-            pass
-        elif self.mode == 'multi_stim':
-            t = time()
-            if (t - self.stim_state['last_update']) > self.stim_duration:
-                kwargs = self.get_random_stim()
-                #self.manager.update_stim(**kwargs)
-                self.manager.load_stim(**kwargs)
-                self.manager.start_stim()
-                self.log_to_dir('UpdateStim: {}'.format(pretty_json(kwargs)), trial_dir)
+            self.send_latency.add(t1 - t0)
+            self.pose_age.add(t1 - pose_t)
+            self.poses_sent += 1
 
-                self.stim_state['last_update'] = t
-        #elif self.mode == 'minseung':
-            pass
-        elif self.mode == 'rotating_bars':
-            pass
-        elif self.mode == 'corner_bars':
-            pass
-        else:
-            raise Exception('Invalid MrStim mode.')
+    def cleanup(self):
+        self.run_commands()
+        self.stopLogging()
+
+        print('Stimulus send latency: {}'.format(self.send_latency))
+        print('Stimulus pose age when shown: {}'.format(self.pose_age))
+        print('Stimulus poses posted: {}, sent: {}, coalesced: {}, stale: {}'.format(
+            self.poses_posted, self.poses_sent, self.coalesced_count, self.stale_count))
+
+    def post_command(self, command, trial_dir):
+        # trial start/stop requests from the trial thread are run in order on this thread
+        with self.commandLock:
+            self.commands.append((command, trial_dir))
+        self.new_pose.set()
+
+    def run_commands(self):
+        with self.commandLock:
+            commands = self.commands
+            self.commands = []
+
+        for command, trial_dir in commands:
+            command(trial_dir)
 
     def stopStim(self, trial_dir):
+        self.post_command(self._stop_stim, trial_dir)
+
+    def nextTrial(self, trial_dir): #was nextStim
+        self.post_command(self._next_trial, trial_dir)
+
+    def _stop_stim(self, trial_dir):
         if self.manager is None:
             return
 
-        self.manager.stop_stim()
-        self.stim_loaded = False
+        with self.managerLock:
+            self.manager.stop_stim()
+            self.stim_loaded = False
+
+        self.log_event('StopStim')
+
+        with self.poseLock:
+            extrapolator = self.extrapolator
+            error = {'pos_m': [extrapolator.pos_error.mean, extrapolator.pos_error.max],
+                     'angle_deg': [extrapolator.angle_error.mean, extrapolator.angle_error.max],
+                     'held_pos_m': [extrapolator.held_pos_error.mean, extrapolator.held_pos_error.max],
+                     'held_angle_deg': [extrapolator.held_angle_error.mean, extrapolator.held_angle_error.max],
+                     'count': extrapolator.pos_error.count}
+            print('Pose prediction error: {}, {} (latest pose: {}, {})'.format(
+                extrapolator.pos_error, extrapolator.angle_error,
+                extrapolator.held_pos_error, extrapolator.held_angle_error))
+        self.log_event('PoseError', error)
+        self.stopLogging()
+
+    def _next_trial(self, trial_dir):
+        if self.manager is None:
+            return
 
-        self.log_to_dir('StopStim', trial_dir)
+        self.startLogging(trial_dir)
 
-    def nextTrial(self, trial_dir): #was nextStim
-        if self.manager is None:
+        with self.poseLock:
+            self.extrapolator.reset()
+            self.extrapolator.reset_stats()
+
+        # the whole trial's stimulus sequence is drawn here from a logged seed, so that it can be
+        # reproduced and nothing is drawn or formatted while the trial runs
+        if self.seed_rng is None:
+            self.seed_rng = Random(self.seed)
+        trial_seed = self.seed_rng.randrange(2**32)
+
+        # a bad mode or duration would otherwise stop this thread while trials keep running
+        error = self.schedule_error()
+        if error is not None:
+            print('No stimulus for this trial: ' + error)
+            self.log_event('ScheduleError', {'mode': self.mode, 'error': error})
             return
 
+        self.build_schedule(Random(trial_seed))
+        self.log_event('Schedule', {'seed': trial_seed, 'mode': self.mode, 'specs': self.stim_specs,
+                                    'times': self.schedule_t.tolist(), 'spec_index': self.schedule_spec.tolist()})
+
+        print('Moving to next trial stimuli.')
+
+        with self.managerLock:
+            # stimuli scheduled at the start of the trial are loaded right away
+            self.schedule_start_t = time()
+            self.run_schedule(0)
+            self.stim_loaded = True
+
+    def schedule_error(self):
+        # returns why a schedule can't be built for the current mode and durations, or None
+        if self.mode not in self.MODES:
+            return 'Invalid Stim mode: {}.'.format(self.mode)
+
+        needed = {'multi_stim': ['stim_duration', 'schedule_duration'],
+                  'multi_rotation': ['stim_duration', 'pause_duration', 'schedule_duration']}.get(self.mode, [])
+        for name in needed:
+            value = getattr(self, name)
+            if value is None or value <= 0:
+                return '{} must be positive in {} mode, not {}.'.format(name, self.mode, value)
+
+        return None
+
+    def check_schedule(self):
+        error = self.schedule_error()
+        if error is not None:
+            raise Exception(error)
+
+    def build_schedule(self, rng):
+        # fills schedule_t (seconds from the start of the trial) and schedule_spec (index into
+        # stim_specs) for the current mode.  Each spec is a (manager method, kwargs) pair and is
+        # stored once no matter how often it is used.  Modes that keep changing the stimulus are
+        # drawn schedule_duration at a time, and extended from the same rng when a trial gets
+        # to the end (see extend_schedule)
+        self.check_schedule()
+
+        self.stim_specs = []
+        self.stim_spec_json = []
+        self.spec_index = {}
+        self.schedule_t = np.zeros(0)
+        self.schedule_spec = np.zeros(0, dtype=np.int32)
+        self.schedule_pos = 0
+
+        self.schedule_rng = rng
+        self.schedule_open = self.mode in ['multi_stim', 'multi_rotation']
+        self.schedule_end = 0
+        self.schedule_next_t = 0
+
+        times = []
+        specs = []
+
+        def add(t, method, kwargs=None):
+            self.add_to_schedule(times, specs, t, method, kwargs)
+
         if self.mode == 'single_stim':
-            kwargs = self.get_random_stim()
+            add(0, 'load_stim', self.get_random_stim(rng))
             #TODO: fix this
             # trajectory = RectangleTrajectory(x=0, y=90, angle=0, w=3, h=180)
             # kwargs = {'name': 'MovingPatch', 'trajectory': trajectory.to_dict()}
-            self.stim_state = {}
 
         elif self.mode == 'multi_stim':
-            kwargs = self.get_random_stim()
-            self.stim_state = {'last_update': time()}
+            pass # drawn by extend_schedule
 
         elif self.mode == 'multi_rotation':
-            rate = self.get_random_direction()
-            kwargs = {'name': 'SineGrating', 'angle': 0, 'period': 20, 'rate': rate, 'color': 1.0, 'background': 0.0}
-            self.stim_state = {'last_update': time(), 'paused': False}
+            kwargs = {'name': 'SineGrating', 'angle': 0, 'period': 20, 'rate': self.get_random_direction(rng),
+                      'color': 1.0, 'background': 0.0}
+            add(0, 'load_stim', kwargs)
+            self.schedule_next_t = self.stim_duration
 
         elif self.mode == 'rotating_bars':
             kwargs = {'name': 'RotatingGrating', 'rate': 30, 'period': 20, 'mean': 0.5, 'contrast': 1.0, \
                       'profile': 'square', 'color': [0, 0, 1, 1]}
+            add(0, 'load_stim', kwargs)
 
             # rate = 10, period = 20, mean = 0.5, contrast = 1.0, offset = 0.0, profile = 'square',
             # color = [1, 1, 1, 1], cylinder_radius = 1, cylinder_height = 10, theta = 0, phi = 0, angle = 0
@@ -212,6 +520,7 @@ class StimThread:
              kwargs = {'name': 'RandomBars', 'period': 90, 'vert_extent': 170, 'width': 10, \
                        'distribution_data':distribution_data, 'start_seed': 0, 'update_rate': 0.0, \
                        'background': 1.0, 'color': [0.0, 0.0, 1.0, 1.0], 'theta_offset': 46}
+             add(0, 'load_stim', kwargs)
 
         elif self.mode == 'loom':
             pass #TODO: fix this
@@ -263,29 +572,100 @@ class StimThread:
             # kwargs = {'name': 'MovingPatch', 'background': 0.5, 'trajectory': trajectory}
 
 
-        else:
-            raise Exception('Invalid Stim mode.')
-
-        print('Moving to next trial stimuli.')
+        self.append_schedule(times, specs)
+        if self.schedule_open:
+            self.extend_schedule()
 
-        self.manager.load_stim(**kwargs)
-        self.manager.start_stim()
-        self.stim_loaded = True
+    def extend_schedule(self):
+        # draws the next schedule_duration seconds of an open-ended mode; returns the (times,
+        # spec indices) that were added
+        rng = self.schedule_rng
+        end = self.schedule_end + self.schedule_duration
+        t = self.schedule_next_t
 
-        self.log_to_dir('NewStim: {}'.format(pretty_json(kwargs)), trial_dir)
+        times = []
+        specs = []
 
-    def log_to_dir(self, text, dir):
-        if dir is None:
-            return
+        def add(t, method, kwargs=None):
+            self.add_to_schedule(times, specs, t, method, kwargs)
 
-        stimuli_file_name = os.path.join(dir, 'stimuli.txt')
+        if self.mode == 'multi_stim':
+            while t < end:
+                add(t, 'load_stim', self.get_random_stim(rng))
+                t += self.stim_duration
 
-        file_mode = 'a' if os.path.isfile(stimuli_file_name) else 'w'
-        self.stimuli_file = open(stimuli_file_name, file_mode)
-
-        self.stimuli_file.write('@{} {}\n'.format(time(), text))
-
-        self.stimuli_file.flush()
-        self.stimuli_file.close()
-
-        print('stimuli logged.')
\ No newline at end of file
+        elif self.mode == 'multi_rotation':
+            while t < end:
+                add(t, 'pause_stim')
+                t += self.pause_duration
+                add(t, 'update_stim', {'rate': self.get_random_direction(rng)})
+                t += self.stim_duration
+
+        self.schedule_next_t = t
+        self.schedule_end = end
+        self.append_schedule(times, specs)
+        return times, specs
+
+    def add_to_schedule(self, times, specs, t, method, kwargs=None):
+        spec = [method, kwargs]
+        key = json.dumps(spec, sort_keys=True)
+        if key not in self.spec_index:
+            self.spec_index[key] = len(self.stim_specs)
+            self.stim_specs.append(spec)
+            self.stim_spec_json.append(json.dumps(kwargs))
+        times.append(t)
+        specs.append(self.spec_index[key])
+
+    def append_schedule(self, times, specs):
+        self.schedule_t = np.concatenate((self.schedule_t, np.array(times, dtype=float)))
+        self.schedule_spec = np.concatenate((self.schedule_spec, np.array(specs, dtype=np.int32)))
+
+    def run_schedule(self, elapsed):
+        # runs every scheduled stimulus change that is due; called with managerLock held
+        while self.schedule_open and elapsed >= self.schedule_end:
+            times, specs = self.extend_schedule()
+            print('Stimulus schedule extended to {:0.0f} s.'.format(self.schedule_end))
+            self.log_event('ScheduleExtended', {'specs': self.stim_specs, 'times': times, 'spec_index': specs})
+
+        while self.schedule_pos < len(self.schedule_t) and self.schedule_t[self.schedule_pos] <= elapsed:
+            index = self.schedule_spec[self.schedule_pos]
+            method, kwargs = self.stim_specs[index]
+
+            if method == 'load_stim':
+                self.manager.load_stim(**kwargs)
+                self.manager.start_stim()
+                self.write_event('NewStim', self.stim_spec_json[index])
+            elif method == 'update_stim':
+                self.manager.update_stim(**kwargs)
+                self.manager.start_stim()
+                self.write_event('UpdateStim', self.stim_spec_json[index])
+            elif method == 'pause_stim':
+                self.manager.pause_stim()
+                self.write_event('PauseStim', self.stim_spec_json[index])
+
+            self.schedule_pos += 1
+
+    def startLogging(self, trial_dir):
+        with self.logLock:
+            if self.eventLog is not None:
+                self.eventLog.close()
+            self.eventLog = None
+
+            if trial_dir is not None:
+                # one JSON object per line: time, event type and stimulus parameters
+                self.eventLog = disk_writer().open_text(os.path.join(trial_dir, 'stimuli.jsonl'))
+
+    def stopLogging(self):
+        with self.logLock:
+            if self.eventLog is not None:
+                self.eventLog.close()
+            self.eventLog = None
+
+    def log_event(self, event, params=None):
+        self.write_event(event, json.dumps(params))
+
+    def write_event(self, event, params_json):
+        # params_json is already serialized, so scheduled events are not formatted again
+        with self.logLock:
+            if self.eventLog is not None:
+                self.eventLog.write('{{"t": {!r}, "event": "{}", "params": {}}}\n'.format(time(), event, params_json))
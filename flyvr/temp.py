@@ -4,9 +4,10 @@ from threading import Thread, Lock, Event
 from time import time, sleep
 
 from flyvr.util import serial_number_to_comport
-from flyvr.service import Service
+from flyvr.service import Service, PreparedLogging
+from flyvr.writer import disk_writer
 
-class TempMonitor(Service):
+class TempMonitor(PreparedLogging, Service):
     def __init__(self, maxTime=12e-3):
         serial_port = None
 
@@ -72,6 +73,11 @@ class TempMonitor(Service):
 
         sleep(1)
 
+    def close(self):
+        # releases the serial port of a monitor that is not running
+        if self.conn is not None:
+            self.conn.close()
+
     def read_temp(self):
         raw_data = str(self.conn.readline())
         parts = raw_data.split(',')
@@ -87,9 +93,11 @@ class TempMonitor(Service):
             if self.logFile is not None:
                 self.logFile.close()
 
-            # open new log file
-            self.logFile = open(logFile, 'w')
-            self.logFile.write('t,temp,humd\n')
+            # use the prepared log file if there is one, otherwise open a new one
+            self.logFile = self.takePreparedLog(logFile)
+
+    def openLog(self, logFile):
+        return disk_writer().open_text(logFile, header='t,temp,humd\n')
 
     def stopLogging(self):
         with self.logLock:
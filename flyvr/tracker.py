@@ -297,6 +297,12 @@ class TrackThread(Service):
         self.center_pos_y = cnc_status.posY
         self.cnc_init = True
 
+    def prepareLogging(self, path):
+        self.cncThread.prepareLogging(path)
+
+    def cancelPreparedLogging(self):
+        self.cncThread.cancelPreparedLogging()
+
     def startLogging(self, path):
         self.cncThread.startLogging(path)
 
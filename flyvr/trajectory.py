@@ -0,0 +1,94 @@
+from math import sqrt, exp
+
+class TrajectoryMetrics:
+    def __init__(self,
+                 min_step=5e-3, # path length only grows once the fly has moved this far (m)
+                 speed_interval=0.2, # speed is measured over displacements at least this long (s)
+                 speed_tau=0.25, # time constant of the speed low-pass filter (s)
+                 moving_on_speed=2e-3, # speed above which the fly counts as moving (m/s)
+                 moving_off_speed=1e-3 # speed below which the fly counts as stopped (m/s)
+                 ):
+
+        # check that the hysteresis band makes sense
+        if moving_off_speed > moving_on_speed:
+            raise Exception('Invalid moving speed thresholds.')
+
+        # store settings
+        self.min_step = min_step
+        self.speed_interval = speed_interval
+        self.speed_tau = speed_tau
+        self.moving_on_speed = moving_on_speed
+        self.moving_off_speed = moving_off_speed
+
+        self.reset()
+
+    def reset(self):
+        # last position that was added to the path
+        self.anchor_x = None
+        self.anchor_y = None
+
+        # start of the current speed interval
+        self.last_x = None
+        self.last_y = None
+        self.last_t = None
+
+        # running totals
+        self.total_distance = 0
+        self.distance_since_last_food = 0
+        self.speed = 0
+        self.moving = False
+
+    def mark_food(self):
+        # path distance since food restarts every time the fly gets food
+        self.distance_since_last_food = 0
+
+    def update(self, x, y, t):
+        # the first sample only sets the starting point
+        if self.anchor_x is None:
+            self.anchor_x, self.anchor_y = x, y
+            self.last_x, self.last_y, self.last_t = x, y, t
+            return
+
+        # extend the path once the fly is far enough from the last anchor, so
+        # that tracking jitter does not add up to path length
+        dx = x - self.anchor_x
+        dy = y - self.anchor_y
+        step_sq = dx*dx + dy*dy
+        if step_sq > self.min_step*self.min_step:
+            step = sqrt(step_sq)
+            self.total_distance += step
+            self.distance_since_last_food += step
+            self.anchor_x, self.anchor_y = x, y
+
+        # low-pass filtered speed over intervals of at least speed_interval; consecutive samples
+        # are too close together, and their tracking jitter would read as speed
+        dt = t - self.last_t
+        if dt >= self.speed_interval:
+            dx = x - self.last_x
+            dy = y - self.last_y
+            inst_speed = sqrt(dx*dx + dy*dy)/dt
+            alpha = 1 - exp(-dt/self.speed_tau)
+            self.speed += alpha*(inst_speed - self.speed)
+
+            # moving state with hysteresis so it does not chatter near threshold
+            if self.moving:
+                if self.speed < self.moving_off_speed:
+                    self.moving = False
+            elif self.speed > self.moving_on_speed:
+                self.moving = True
+
+            self.last_x, self.last_y, self.last_t = x, y, t
+
+    @property
+    def snapshot(self):
+        return TrajectorySnapshot(total_distance=self.total_distance,
+                                  distance_since_last_food=self.distance_since_last_food,
+                                  speed=self.speed,
+                                  moving=self.moving)
+
+class TrajectorySnapshot:
+    def __init__(self, total_distance, distance_since_last_food, speed, moving):
+        self.total_distance = total_distance
+        self.distance_since_last_food = distance_since_last_food
+        self.speed = speed
+        self.moving = moving
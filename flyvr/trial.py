@@ -1,18 +1,33 @@
-import cv2
 import os
 import platform
 import os.path
 import itertools
+import shutil
 import json
 
 from time import strftime, time, sleep
+from math import degrees
+from queue import Queue, Empty
 
 from flyvr.service import Service
-from threading import Lock
-from flyvr.tracker import TrackThread, ManualVelocity
-from random import choice
+from flyvr.writer import disk_writer
+from flyvr.util import ValueStats
+from threading import Thread, Lock
+import multiprocessing
 
 class TrialThread(Service):
+    # Trial state machine.  It reacts to events: fly present/absent edges from the camera thread,
+    # expiry of its timers, the stage arriving at the arena center and gate commands from the
+    # dispenser.  The (state, event) pairs that cause a transition are listed in
+    # self.transitions; other events are ignored.  The timers of a state (STATE_TIMERS) are
+    # cancelled when the state is left, while trial_timeout runs until the trial ends.
+    # Transitions are logged to transitions.npy in the experiment directory (state and event
+    # names in transitions.json), and the time spent in each state is kept in dwell_stats.
+    STATES = ['started', 'fly detected', 'run', 'fly lost', 'moving back to center']
+    EVENTS = ['fly_present', 'fly_absent', 'detect_timeout', 'lost_timeout', 'trial_timeout', 'at_center',
+              'gate_open', 'gate_closed']
+    STATE_TIMERS = {'fly detected': ['detect_timeout'], 'fly lost': ['lost_timeout']}
+
     def __init__(self, cam, cnc, dispenser, stim, opto, tracker, ui, flyplot, temp,
                  loopTime=10e-3, fly_lost_timeout=2, fly_detected_timeout=2):
 
@@ -48,6 +63,15 @@ class TrialThread(Service):
         self.trialDirLock = Lock()
         self._trial_dir = None
 
+        # next trial, set up ahead of time
+        self.prepareThread = None
+        self.prepared_trial = None
+
+        # finished trials are packed into a single file by a background process
+        self.bundle_trials = True
+        self.bundle_threads = []
+        self.bundle_processes = []
+
         # create folder for data
         if platform.system() == 'Windows':
             topdir = r'F:\FlyVR'
@@ -65,23 +89,111 @@ class TrialThread(Service):
         if self.dispenser is not None:
             self.dispenser.start_logging(self.exp_dir)
 
-        # call constructor from parent
-        super().__init__(minTime=loopTime, maxTime=loopTime, iter_warn=False)
+        # event handling
+        self.loopTime = loopTime
+        self.init_state_machine()
+
+        # transition log
+        with open(os.path.join(self.exp_dir, 'transitions.json'), 'w') as f:
+            json.dump({'states': self.STATES, 'events': self.EVENTS}, f)
+        self.transitionLog = disk_writer().open_npy(os.path.join(self.exp_dir, 'transitions.npy'),
+                                                    dtype=[('t', '<f8'), ('from', 'u1'), ('to', 'u1'), ('event', 'u1')])
+
+        # call constructor from parent; the loop paces itself by waiting for events
+        super().__init__(maxTime=loopTime, iter_warn=False)
+
+    def init_state_machine(self):
+        # events, timers and the transition table; kept apart from the experiment directory
+        # setup so that the state machine can be run on its own
+        self.events = Queue()
+        self.fly_present = False
+        self.timers = {}
+        self.last_pose_t = 0
+        self.transitions = {
+            ('started', 'fly_present'): self.on_fly_found,
+            ('fly detected', 'detect_timeout'): self.on_fly_confirmed,
+            ('fly detected', 'fly_absent'): self.on_fly_lost,
+            ('run', 'fly_absent'): self.on_fly_lost,
+            ('run', 'trial_timeout'): self.on_trial_timeout,
+            ('fly lost', 'fly_present'): self.on_fly_returned,
+            ('fly lost', 'lost_timeout'): self.on_fly_gone,
+            ('moving back to center', 'at_center'): self.on_at_center
+        }
+
+        # per-state dwell times
+        self.state_t = time()
+        self.dwell_stats = {state: ValueStats('s') for state in self.STATES}
 
     @property
     def trial_dir(self):
         with self.trialDirLock:
             return self._trial_dir
 
+    def prepare_next_trial(self):
+        # the next trial's directory, log files and reward map are set up in the background
+        # while waiting for a fly, so that starting the trial only has to swap them in
+        if self.done.is_set() or self.prepareThread is not None or self.prepared_trial is not None:
+            return
+        self.prepareThread = Thread(target=self._prepare_trial)
+        self.prepareThread.start()
+
+    def _prepare_trial(self):
+        # the folder name carries the time the trial was prepared, which can be long before the
+        # fly arrives; the start time is written to trial.json when the trial starts
+        trial_num = next(self.trial_count)
+        folder = 'trial-' + str(trial_num) + '-' + strftime('%Y%m%d-%H%M%S')
+        _trial_dir = os.path.join(self.exp_dir, folder)
+        os.makedirs(_trial_dir)
+
+        self.tracker.prepareLogging(os.path.join(_trial_dir, 'cnc.txt'))
+        self.cam.prepareLogging(os.path.join(_trial_dir, 'cam.txt'), os.path.join(_trial_dir, 'cam_compr.mkv'))
+        self.temp.prepareLogging(os.path.join(_trial_dir, 'temp.txt'))
+
+        if self.opto is not None:
+            self.opto.prepareLogging(os.path.join(_trial_dir, 'opto.txt'))
+            self.opto.prepareRewardMap(trial_num)
+
+        self.prepared_trial = (trial_num, _trial_dir)
+
+    def take_prepared_trial(self):
+        # returns the prepared (trial number, directory), preparing it now if that hasn't happened
+        if self.prepareThread is not None:
+            self.prepareThread.join()
+            self.prepareThread = None
+
+        if self.prepared_trial is None:
+            self._prepare_trial()
+
+        prepared = self.prepared_trial
+        self.prepared_trial = None
+        return prepared
+
+    def discard_prepared_trial(self):
+        if self.prepareThread is not None:
+            self.prepareThread.join()
+            self.prepareThread = None
+
+        if self.prepared_trial is not None:
+            self.tracker.cancelPreparedLogging()
+            self.cam.cancelPreparedLogging()
+            self.temp.cancelPreparedLogging()
+            if self.opto is not None:
+                self.opto.cancelPreparedLogging()
+
+            # nothing was recorded in it
+            shutil.rmtree(self.prepared_trial[1], ignore_errors=True)
+            self.prepared_trial = None
+
     def _start_trial(self):
+        self.trial_num, _trial_dir = self.take_prepared_trial()
         self.trial_start_t = time()
+        with open(os.path.join(_trial_dir, 'trial.json'), 'w') as f:
+            json.dump({'trial': self.trial_num, 'start_t': self.trial_start_t,
+                       'start': strftime('%Y%m%d-%H%M%S')}, f)
         self.tracker.startTracking()
-        self.trial_num = next(self.trial_count)
         print('Started trial ' + str(self.trial_num))
-        folder = 'trial-' + str(self.trial_num) + '-' + strftime('%Y%m%d-%H%M%S')
-        _trial_dir = os.path.join(self.exp_dir, folder)
-        self._trial_dir = _trial_dir
-        os.makedirs(_trial_dir)
+        with self.trialDirLock:
+            self._trial_dir = _trial_dir
 
         self.tracker.startLogging(os.path.join(_trial_dir, 'cnc.txt'))
         self.cam.startLogging(os.path.join(_trial_dir, 'cam.txt'), os.path.join(_trial_dir, 'cam_compr.mkv'))
@@ -89,63 +201,19 @@ class TrialThread(Service):
 
         if self.opto is not None:
             self.opto.startLogging(os.path.join(_trial_dir, 'opto.txt'))
-            self.opto.trial_start_t = self.trial_start_t
-
+            self.opto.loadRewardMap(self.trial_num)
 
             # added resets tp start pf trial to try to fix foodspot issue and reset time when trial starts
-            # reset opto
+            self.opto.resetTrial()
             self.opto.trial_start_t = self.trial_start_t
-            self.opto.foodspots = []
-            self.opto.closest_food = None
-            self.opto.fly_in_food = False
-
-            self.opto.dist_from_center = None
-            self.opto.total_distance = 0
-            self.opto.distance_since_last_food = 0
-            self.opto.closest_food = None
-            self.opto.far_from_food = False
-            self.opto.distance_correct = False  # for center
-            self.opto.path_distance_correct = False  # total path
-            self.opto.long_time_since_food = False
-            self.opto.fly_moving = False
-            self.opto.list_prev_y = [0]
-            self.opto.list_prev_x = [0]
-
-
-            self.opto.long_time_since_food = True
-            self.opto.shouldCreateFood = False
-            self.opto.time_of_last_food = None
-            self.opto.time_since_last_food = None
-
-            if self.opto.shouldRandomizeOffTime == True:
-                self.min_off_time = choice([10, 20, 40, 60])
-                print(f'min off time by randomize chosen = {self.min_off_time}')
-            if self.opto.shouldRandomizeFoodDistance == True:
-                self.opto.shouldCheckFoodDistance = True
-                self.opto.min_dist_from_food = choice([.15, .05]) #, 40, 60]) #not currently set in GUI to specify these
-                print(f'min euc distance from food by randomize chosen = {self.opto.min_dist_from_food}')
-
-                #make new txt file for each trial to determine what choice is
-                if self.exp_dir is not None:
-                    fname = os.path.join(self.exp_dir, 'random_chosen.txt')
-                    rc = {"food euc distance chosen": self.opto.min_dist_from_food}
-                    data = json.dumps(rc)
-                    with open(fname, 'w') as f:
-                        f.write(data)
-        
-            if self.opto.shouldRandomizePathDistance == True:
-                self.opto.path_distance_min = choice([ .05, .15]) #, 40, 60]) #not currently set in GUI to specify these
-                #self.distance_away_required = choice([5, 15]) #distance_away_required is for off_time override not for distance
-                self.opto.shouldCheckTotalPathDistance = True
-                print(f'min path distance from food by randomize chosen = {self.opto.path_distance_min}')
-
-                 #make new txt file for each trial to determine what choice is
-                if self.exp_dir is not None:
-                    fname = os.path.join(self.exp_dir, 'random_chosen.txt')
-                    rc = {"food path distance chosen": self.opto.path_distance_min}
-                    data = json.dumps(rc)
-                    with open(fname, 'w') as f:
-                        f.write(data)
+
+            #make new txt file for each trial to determine what choice is
+            chosen = self.opto.randomizeTrialParameters()
+            if chosen and self.exp_dir is not None:
+                fname = os.path.join(self.exp_dir, 'random_chosen.txt')
+                data = json.dumps(chosen)
+                with open(fname, 'w') as f:
+                    f.write(data)
 
         if self.stim is not None:
             self.stim.nextTrial(self._trial_dir)
@@ -164,40 +232,57 @@ class TrialThread(Service):
         self.tracker.stopTracking()
         self.trial_start_t = None
         self.trial_end_t = time()
+        self.cancel_timer('trial_timeout')
 
         if self.opto is not None:
             self.opto.trial_start_t = self.trial_start_t
             self.opto.stopLogging()
-            self.opto.foodspots = []
-            self.opto.closest_food = None
-            self.opto.fly_in_food = False
-
-            self.opto.dist_from_center = None
-            self.opto.total_distance = 0
-            self.opto.distance_since_last_food = 0
-            self.opto.closest_food = None
-            self.opto.far_from_food = False
-            self.opto.distance_correct = False  # for center
-            self.opto.path_distance_correct = False  # total path
-            self.opto.long_time_since_food = False
-            self.opto.fly_moving = False
-            self.opto.list_prev_y = [0]
-            self.opto.list_prev_x = [0]
-
-            self.opto.long_time_since_food = True
-            self.opto.shouldCreateFood = False
-            self.opto.time_of_last_food = None
-            self.opto.time_since_last_food = None
+            self.opto.resetTrial()
 
         if self.stim is not None:
             self.stim.stopStim(self._trial_dir)
 
-    def get_fly_pos(self):
+        if self.bundle_trials and self._trial_dir is not None:
+            thread = Thread(target=self.bundle_when_written, args=(self._trial_dir, ), daemon=True)
+            thread.start()
+            self.bundle_threads = [t for t in self.bundle_threads if t.is_alive()] + [thread]
+
+        self.prepare_next_trial()
+
+    def bundle_when_written(self, trial_dir):
+        # packs the trial's logs into trial.npz in a separate process, once the disk writer has
+        # closed them
+        if not disk_writer().wait_idle(trial_dir):
+            print('Trial logs still open, not bundling {}.'.format(trial_dir))
+            return
+
+        # spawn rather than fork: a forked copy of this process would inherit the locks held by
+        # its other threads (camera, writer, serial ports, Qt)
+        from flyvr.bundle import bundle_trial
+        process = multiprocessing.get_context('spawn').Process(target=bundle_trial, args=(trial_dir, ))
+        process.start()
+        self.bundle_processes = [p for p in self.bundle_processes if p.is_alive()] + [process]
+
+    def wait_for_bundles(self, timeout=120):
+        # waits for the trials that are still being bundled, e.g. before exiting; the disk
+        # writer has to be running until then
+        t0 = time()
+        for thread in self.bundle_threads:
+            thread.join(max(timeout - (time() - t0), 0))
+        for process in self.bundle_processes:
+            process.join(max(timeout - (time() - t0), 0))
+            if process.is_alive():
+                print('Bundling still running at exit, pid {}.'.format(process.pid))
+
+    def get_fly_pos(self, fly=None):
         ### Get Fly Position ###
 
-        if self.cam is not None and self.cam.fly is not None:
-            camX = self.cam.fly.centerX
-            camY = self.cam.fly.centerY
+        if fly is None and self.cam is not None:
+            fly = self.cam.fly
+
+        if fly is not None:
+            camX = fly.centerX
+            camY = fly.centerY
         else:
             camX = None
             camY = None
@@ -217,98 +302,209 @@ class TrialThread(Service):
             flyY = None
         return flyX, flyY
 
-    def get_fly_angle(self):
+    def get_fly_angle(self, fly=None):
+        # fly.angle is in radians, counterclockwise in the camera image; the stimulus uses degrees
+        if fly is None and self.cam is not None:
+            fly = self.cam.fly
+
         fly_angle = None
-        if self.cam is not None:
-            fly_data = self.cam.flyData
-            if fly_data is not None:
-                fly_angle = 180-fly_data.angle
+        if fly is not None and getattr(fly, 'angle', None) is not None:
+            fly_angle = 180-degrees(fly.angle)
 
         return fly_angle
 
+    def post_pose(self):
+        # posts the pose of the latest camera frame to the stimulus thread, which sends it on its own
+        fly, fly_t = self.cam.fly_sample
+        fly_pos_x, fly_pos_y = self.get_fly_pos(fly)
+        fly_angle = self.get_fly_angle(fly)
+        self.stim.updateStim(self._trial_dir, fly_pos_x=fly_pos_x, fly_pos_y=fly_pos_y, fly_angle=fly_angle,
+                             pose_t=fly_t)
+
+    def start(self):
+        self.prepare_next_trial()
+        self.cam.add_fly_listener(self.onFlyFrame)
+        if self.dispenser is not None:
+            self.dispenser.add_gate_listener(self.onGate)
+        super().start()
+
+    def stop(self):
+        self.cam.remove_fly_listener(self.onFlyFrame)
+        if self.dispenser is not None:
+            self.dispenser.remove_gate_listener(self.onGate)
+        self.done.set()
+        self.post(None)
+        super().stop()
+        self.discard_prepared_trial()
+
+    def cleanup(self):
+        self.transitionLog.close()
+        print(self.dwell_report())
+
+    def post(self, event, t=None):
+        self.events.put((time() if t is None else t, event))
+
+    def onFlyFrame(self, fly, frame_t):
+        # called from the camera thread for each processed frame; only edges are posted
+        present = fly is not None
+        if present != self.fly_present:
+            self.fly_present = present
+            self.post('fly_present' if present else 'fly_absent', frame_t)
+
+    def onGate(self, gate_state, t):
+        self.post('gate_open' if gate_state == 'open' else 'gate_closed', t)
+
+    def set_timer(self, event, duration):
+        self.timers[event] = time() + duration
+
+    def cancel_timer(self, event):
+        self.timers.pop(event, None)
+
+    def dwell_report(self):
+        lines = ['Trial state dwell times:']
+        for state in self.STATES:
+            lines.append('  {}: {}'.format(state, self.dwell_stats[state]))
+        return '\n'.join(lines)
+
+    def handle(self, t, event):
+        handler = self.transitions.get((self.state, event))
+        if handler is None:
+            # gate commands are logged even though they don't change the state
+            if event in ['gate_open', 'gate_closed']:
+                self.log_transition(t, self.state, self.state, event)
+            return
+
+        prev = self.state
+        self.state = handler()
+        self.log_transition(t, prev, self.state, event)
+
+        if self.state != prev:
+            self.dwell_stats[prev].add(t - self.state_t)
+            self.state_t = t
+
+            # deadlines of the state that was left must not fire into a later one
+            for timer in self.STATE_TIMERS.get(prev, []):
+                if timer not in self.STATE_TIMERS.get(self.state, []):
+                    self.cancel_timer(timer)
+
+        # edges seen before this state was entered were ignored, so start it from the current level
+        self.post('fly_present' if self.cam.flyPresent else 'fly_absent')
+
+    def log_transition(self, t, prev, state, event):
+        self.transitionLog.append((t, self.STATES.index(prev), self.STATES.index(state), self.EVENTS.index(event)))
+
+    def wait_time(self):
+        # time until something needs to be done without an event
+        now = time()
+        due = now + 0.1
+        if self.stim is not None or self.state == 'moving back to center':
+            due = min(due, self.last_pose_t + self.loopTime)
+        for event, deadline in self.timers.items():
+            if (self.state, event) in self.transitions:
+                due = min(due, deadline)
+        return max(due - now, 0)
+
     def loopBody(self):
-        if self.stim is not None:
-            fly_pos_x, fly_pos_y = self.get_fly_pos()
-            fly_angle = self.get_fly_angle()
-            self.stim.updateStim(self._trial_dir, fly_pos_x=fly_pos_x, fly_pos_y=fly_pos_y, fly_angle=fly_angle)
-
-        if self.state == 'started':
-            if self.cam.flyPresent:
-                print('Fly possibly found...')
-                self.timer_start = time()
-                self.state = 'fly detected'
-                self.tracker.startTracking()
-                ## add here to update a dispenser state based on a false close or fly stuck in tunnel state
-                #self.dispenser.no_fly_reopen_gate = False
-                if self.dispenser is not None:
-                    self.dispenser.prev_state = 'Idle' #this prevents it from retriggering the gate open state
-                    self.dispenser.state = 'Idle'
-                    print('REOPEN GATE SET TO FALSE--state set to idle')
-        elif self.state == 'fly detected':
-            if (time() - self.timer_start) >= self.fly_detected_timeout:
-                print('Fly found!')
-                self.tracker.startTracking()
-                self._start_trial()
-                self.prev_state = 'fly detected'
-                self.state = 'run'
-
-                ## if fly is found make sure the gate is closed and if not, close it
-                if self.dispenser is not None and self.dispenser.gate_state == 'open' and self.dispenser.gate_clear:
-                  self.dispenser.trigger = 'auto'
-                  self.dispenser.send_close_gate_command()
-                  self.dispenser.state = 'Idle'
-                  print('Dispenser: fly found, going to Idle state.')
-
-            elif not self.cam.flyPresent:
-                print('Fly lost.')
-                self.timer_start = time()
-                self.prev_state = 'fly detected'
-                self.state = 'fly lost'
-                self.tracker.stopTracking()
-
-        elif self.state == 'run':
-            if not self.cam.flyPresent:
-                print('Fly possibly lost...')
-                self.timer_start = time()
-                self.prev_state = 'run'
-                self.state = 'fly lost'
-                #trial timer
-            if self.trial_timer == True and self.trial_start_t is not None:
-                #end trial if time elapsed is greater than set time
-                if (time()-self.trial_start_t) >= self.trial_timeout:
-                    print('Trial is too long-->Starting new trial')
-                    self._stop_trial()
-                    self.tracker.start_moving_to_center()
-                    #self.prev_state = 'fly lost'
-                    self.state = 'moving back to center'
-        elif self.state == 'fly lost':
-            if self.cam.flyPresent:
-                print('Fly located again.')
-                self.timer_start = time()
-                self.tracker.startTracking()
-                if self.prev_state == 'run':
-                    self.state = 'run'
-                elif self.prev_state == 'fly detected':
-                    self.state = 'fly detected'
-            elif (time() - self.timer_start) >= self.fly_lost_timeout:
-                if self.prev_state == 'run':
-                    print('Fly is gone.')
-                    self._stop_trial()
-                self.tracker.start_moving_to_center()
-                self.prev_state = 'fly lost'
-                self.state = 'moving back to center'
-        elif self.state == 'moving back to center':
-            if self.tracker.is_close_to_center():
-                if self.dispenser is not None:
-                    self.dispenser.release_fly()
-
-                    #autocalibrate gate
-                    if self.dispenser.gate_state == 'open' and self.dispenser.gate_clear:
-                        self.dispenser.calibrate_gate()
-                        print('auto calibrating gate')
-                else:
-                    print('Dispenser not connected, please manually release fly')
-                self.prev_state = 'moving back to center'
-                self.state = 'started'
+        now = time()
+        if (now - self.last_pose_t) >= self.loopTime:
+            self.last_pose_t = now
+
+            if self.stim is not None:
+                self.post_pose()
+
+            # the tracker has no arrival event, so the stage is polled while it moves
+            if self.state == 'moving back to center' and self.tracker.is_close_to_center():
+                self.handle(now, 'at_center')
+
+        # expired timers
+        for event, deadline in list(self.timers.items()):
+            if now >= deadline and (self.state, event) in self.transitions:
+                del self.timers[event]
+                self.handle(deadline, event)
+
+        try:
+            t, event = self.events.get(timeout=self.wait_time())
+        except Empty:
+            return
+
+        if event is not None:
+            self.handle(t, event)
+
+    def on_fly_found(self):
+        print('Fly possibly found...')
+        self.set_timer('detect_timeout', self.fly_detected_timeout)
+        self.tracker.startTracking()
+        ## add here to update a dispenser state based on a false close or fly stuck in tunnel state
+        #self.dispenser.no_fly_reopen_gate = False
+        if self.dispenser is not None:
+            self.dispenser.prev_state = 'Idle' #this prevents it from retriggering the gate open state
+            self.dispenser.state = 'Idle'
+            print('REOPEN GATE SET TO FALSE--state set to idle')
+        return 'fly detected'
+
+    def on_fly_confirmed(self):
+        print('Fly found!')
+        self.tracker.startTracking()
+        self._start_trial()
+        self.prev_state = 'fly detected'
+
+        #trial timer
+        if self.trial_timer == True:
+            self.set_timer('trial_timeout', self.trial_timeout)
+
+        ## if fly is found make sure the gate is closed and if not, close it
+        if self.dispenser is not None and self.dispenser.gate_state == 'open' and self.dispenser.gate_clear:
+          self.dispenser.trigger = 'auto'
+          self.dispenser.send_close_gate_command()
+          self.dispenser.state = 'Idle'
+          print('Dispenser: fly found, going to Idle state.')
+
+        return 'run'
+
+    def on_fly_lost(self):
+        if self.state == 'run':
+            print('Fly possibly lost...')
+        else:
+            print('Fly lost.')
+            self.tracker.stopTracking()
+        self.set_timer('lost_timeout', self.fly_lost_timeout)
+        self.prev_state = self.state
+        return 'fly lost'
+
+    def on_trial_timeout(self):
+        #end trial if time elapsed is greater than set time
+        print('Trial is too long-->Starting new trial')
+        self._stop_trial()
+        self.tracker.start_moving_to_center()
+        #self.prev_state = 'fly lost'
+        return 'moving back to center'
+
+    def on_fly_returned(self):
+        print('Fly located again.')
+        self.tracker.startTracking()
+        if self.prev_state == 'run':
+            return 'run'
+        else:
+            self.set_timer('detect_timeout', self.fly_detected_timeout)
+            return 'fly detected'
+
+    def on_fly_gone(self):
+        if self.prev_state == 'run':
+            print('Fly is gone.')
+            self._stop_trial()
+        self.tracker.start_moving_to_center()
+        self.prev_state = 'fly lost'
+        return 'moving back to center'
+
+    def on_at_center(self):
+        if self.dispenser is not None:
+            self.dispenser.release_fly()
+
+            #autocalibrate gate
+            if self.dispenser.gate_state == 'open' and self.dispenser.gate_clear:
+                self.dispenser.calibrate_gate()
+                print('auto calibrating gate')
         else:
-            raise Exception('Invalid state.')
+            print('Dispenser not connected, please manually release fly')
+        self.prev_state = 'moving back to center'
+        return 'started'
@@ -1,8 +1,104 @@
+import sys
+import importlib
 import serial.tools.list_ports
 
+from time import time, perf_counter
+from threading import Lock
+
+# wall-clock time with perf_counter resolution, anchored once at import
+_wall_t0 = time()
+_perf_t0 = perf_counter()
+
+class LazyModule:
+    # stands in for a module that is only imported when one of its attributes is first used, so
+    # that heavy SDKs (OpenCV, pylon, ...) are only loaded by the code paths that need them
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    try:
+                        self._module = importlib.import_module(self._name)
+                    except ImportError as e:
+                        raise ImportError('{} is required for this feature but could not be imported ({}).'.format(self._name, e))
+        return getattr(self._module, attr)
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+def precise_time():
+    return _wall_t0 + (perf_counter() - _perf_t0)
+
+# serial number -> port for every USB serial device, listed once and shared by all devices
+_port_registry = None
+_port_registry_lock = Lock()
+
+def serial_port_registry(refresh=False):
+    global _port_registry
+    with _port_registry_lock:
+        if _port_registry is None or refresh:
+            registry = {}
+            for port in serial.tools.list_ports.comports(include_links=True):
+                if port.serial_number is not None:
+                    registry.setdefault(port.serial_number, '/dev/' + port.description)
+            _port_registry = registry
+        return _port_registry
+
 def serial_number_to_comport(serial_number):
-    for port in serial.tools.list_ports.comports(include_links=True):
-        if port.serial_number == serial_number:
-            return '/dev/' + port.description
+    registry = serial_port_registry()
+    if serial_number not in registry:
+        # the device may have been plugged in after the ports were listed
+        registry = serial_port_registry(refresh=True)
+
+    if serial_number in registry:
+        return registry[serial_number]
     else:
-        raise Exception('Could not find comport with given serial number.')
\ No newline at end of file
+        raise Exception('Could not find comport with given serial number.')
+
+class LatencyStats:
+    # Running count/mean/max of a latency, without keeping the samples
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def __str__(self):
+        if self.count == 0:
+            return 'n=0'
+        return 'n={}, mean={:0.2f} ms, max={:0.2f} ms'.format(self.count, self.mean*1e3, self.max*1e3)
+
+class ValueStats(LatencyStats):
+    # Running count/mean/max of a value, reported in the given unit
+    def __init__(self, unit, scale=1):
+        self.unit = unit
+        self.scale = scale
+        super().__init__()
+
+    def __str__(self):
+        if self.count == 0:
+            return 'n=0'
+        return 'n={}, mean={:0.2f} {}, max={:0.2f} {}'.format(self.count, self.mean*self.scale, self.unit,
+                                                             self.max*self.scale, self.unit)
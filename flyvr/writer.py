@@ -0,0 +1,337 @@
+import os
+import atexit
+
+from collections import deque
+from time import time, sleep
+from threading import Thread, Lock, Event
+
+from flyvr.service import Service
+from flyvr.npylog import NpyAppender
+
+class WriterStream:
+    # Handle given to a producer.  Records are appended to a deque (appends and pops from
+    # opposite ends are thread-safe without a lock) and written out by the DiskWriter thread.
+    def __init__(self, writer, path):
+        self.writer = writer
+        self.path = path
+        self.queue = deque()
+        self.closed = False
+
+        # set by the writer thread if writing fails; records put after that are dropped
+        self.failed = False
+        self.error = None
+
+        # statistics
+        self.bytes_written = 0
+        self.report_bytes = 0
+        self.max_depth = 0
+        self.dropped = 0
+
+    def put(self, record):
+        # returns False if the record was dropped
+        if self.failed:
+            self.dropped += 1
+            return False
+        self.queue.append(record)
+        return True
+
+    def close(self):
+        # the stream is closed by the writer thread once everything queued before has been written
+        self.closed = True
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    # subclasses write a batch of records and return the number of bytes written
+    def commit(self, records):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def fsync(self):
+        pass
+
+    def finish(self):
+        pass
+
+class TextStream(WriterStream):
+    # file-like text log: write(str) and close()
+    def __init__(self, writer, path, header=None):
+        super().__init__(writer, path)
+        self.file = open(path, 'w')
+        if header is not None:
+            self.put(header)
+
+    def write(self, line):
+        return self.put(line)
+
+    def commit(self, records):
+        data = ''.join(records)
+        self.file.write(data)
+        return len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fsync(self):
+        os.fsync(self.file.fileno())
+
+    def finish(self):
+        self.file.close()
+
+class NpyStream(WriterStream):
+    # rows appended to a .npy file through an NpyAppender: append(row) and close()
+    def __init__(self, writer, path, dtype, row_shape=()):
+        super().__init__(writer, path)
+        self.appender = NpyAppender(path, dtype, row_shape=row_shape, flush_interval=float('inf'))
+
+    def append(self, row):
+        return self.put(row)
+
+    def commit(self, records):
+        for row in records:
+            self.appender.append(row)
+        return len(records)*self.appender.row_bytes
+
+    def flush(self):
+        self.appender.flush()
+
+    def fsync(self):
+        os.fsync(self.appender.file.fileno())
+
+    def finish(self):
+        self.appender.close()
+
+class VideoStream(WriterStream):
+    # frames for an already opened cv2.VideoWriter: write(frame) and release().  Frames must not
+    # be modified by the producer after they are written.  At most max_queue frames wait to be
+    # encoded; write() drops frames beyond that (and returns False) rather than letting memory
+    # grow when encoding falls behind.  Once the queue is half full the writer is woken without
+    # waiting for its flush interval, so bursts (e.g. writing out pre-trigger frames) are
+    # encoded as they arrive
+    def __init__(self, writer, path, video_writer, max_queue=128):
+        super().__init__(writer, path)
+        self.video_writer = video_writer
+        self.max_queue = max_queue
+
+        # whether the last write was dropped, to log once per run of dropped frames
+        self.dropping = False
+
+    @property
+    def full(self):
+        # producers that can hold on to their frames check this rather than have write() drop them
+        return len(self.queue) >= self.max_queue
+
+    def write(self, frame):
+        depth = len(self.queue)
+        if depth >= self.max_queue:
+            self.dropped += 1
+            if not self.dropping:
+                self.dropping = True
+                print('Disk writer: {} is falling behind, dropping frames ({} so far)'.format(
+                    self.path, self.dropped))
+            return False
+        if depth > self.max_queue/2:
+            self.writer.sync()
+        self.dropping = False
+        return self.put(frame)
+
+    def release(self):
+        self.close()
+
+    def commit(self, records):
+        for frame in records:
+            self.video_writer.write(frame)
+        return sum(frame.nbytes for frame in records)
+
+    def finish(self):
+        self.video_writer.release()
+
+class DiskWriter(Service):
+    # Owns the rig's log files.  Producers write into streams without touching the disk, and this
+    # thread writes out every stream once per flush_interval (group commit).
+    #
+    # fsync policy: 'never', 'close' (when a stream is closed, i.e. at the end of a trial) or
+    # 'commit' (after every group commit).
+    def __init__(self, flush_interval=0.5, fsync='close', report_interval=None):
+        if fsync not in ['never', 'close', 'commit']:
+            raise Exception('Invalid fsync policy.')
+
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync
+        self.report_interval = report_interval
+
+        self.streamLock = Lock()
+        self.streams = []
+
+        # statistics of streams that have been closed
+        self.closed_count = 0
+        self.closed_bytes = 0
+        self.failed_streams = []
+        self.last_report_t = time()
+
+        # set to run a commit right away
+        self.commit_now = Event()
+
+        # call constructor from parent
+        super().__init__(iter_warn=False)
+
+    def start(self):
+        # a daemon thread, so that a forgotten stop() doesn't keep the process alive; the
+        # streams are still written out at exit through atexit
+        self.thread = Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.done.is_set():
+            self.done.set()
+            self.commit_now.set()
+            self.thread.join()
+
+    def add(self, stream):
+        with self.streamLock:
+            self.streams.append(stream)
+        return stream
+
+    def open_text(self, path, header=None):
+        return self.add(TextStream(self, path, header=header))
+
+    def open_npy(self, path, dtype, row_shape=()):
+        return self.add(NpyStream(self, path, dtype, row_shape=row_shape))
+
+    def add_video(self, path, video_writer, max_queue=128):
+        return self.add(VideoStream(self, path, video_writer, max_queue=max_queue))
+
+    def sync(self):
+        # ask for a commit without waiting for the next flush interval
+        if not self.commit_now.is_set():
+            self.commit_now.set()
+
+    def wait_closed(self, stream, timeout=10):
+        # waits until a closed stream has been written out and its file closed
+        t0 = time()
+        while (time() - t0) < timeout:
+            with self.streamLock:
+                if stream not in self.streams:
+                    return True
+            self.sync()
+            sleep(1e-3)
+        return False
+
+    def wait_idle(self, dir, timeout=60):
+        # waits until every stream writing into dir has been written out and closed
+        dir = os.path.join(os.path.abspath(dir), '')
+        t0 = time()
+        while (time() - t0) < timeout:
+            with self.streamLock:
+                if not any(os.path.abspath(stream.path).startswith(dir) for stream in self.streams):
+                    return True
+            self.sync()
+            sleep(10e-3)
+        return False
+
+    def loopBody(self):
+        self.commit_now.wait(self.flush_interval)
+        self.commit_now.clear()
+        self.commit()
+
+        if self.report_interval is not None and (time() - self.last_report_t) > self.report_interval:
+            print(self.report())
+
+    def cleanup(self):
+        self.commit()
+        print(self.report())
+
+    def commit(self):
+        with self.streamLock:
+            streams = list(self.streams)
+
+        for stream in streams:
+            # one stream failing (disk full, encoder error, ...) must not stop the others
+            try:
+                self.commit_stream(stream)
+            except Exception as e:
+                self.fail_stream(stream, e)
+
+    def commit_stream(self, stream):
+        # read the flag first: anything queued before close() is then written below
+        closing = stream.closed
+
+        depth = len(stream.queue)
+        stream.max_depth = max(stream.max_depth, depth)
+
+        if depth > 0:
+            records = [stream.queue.popleft() for k in range(depth)]
+            stream.bytes_written += stream.commit(records)
+            stream.flush()
+            if self.fsync_policy == 'commit':
+                stream.fsync()
+
+        if closing and len(stream.queue) == 0:
+            if self.fsync_policy == 'close':
+                stream.fsync()
+            stream.finish()
+            self.remove(stream)
+
+    def fail_stream(self, stream, error):
+        # the stream's queued records are dropped, and later ones are dropped as they are put
+        stream.failed = True
+        stream.error = error
+        stream.dropped += len(stream.queue)
+        stream.queue.clear()
+        print('Disk writer: writing {} failed, dropping its records: {!r}'.format(stream.path, error))
+
+        try:
+            stream.finish()
+        except Exception:
+            pass
+        self.remove(stream)
+
+    def remove(self, stream):
+        with self.streamLock:
+            if stream in self.streams:
+                self.streams.remove(stream)
+        self.closed_count += 1
+        self.closed_bytes += stream.bytes_written
+        if stream.failed:
+            self.failed_streams.append(stream)
+
+    def report(self):
+        now = time()
+        dt = max(now - self.last_report_t, 1e-6)
+        self.last_report_t = now
+
+        with self.streamLock:
+            streams = list(self.streams)
+
+        lines = ['Disk writer: {} open streams, {} closed ({:0.1f} MB)'.format(
+            len(streams), self.closed_count, self.closed_bytes/1e6)]
+        for stream in streams:
+            rate = (stream.bytes_written - stream.report_bytes)/dt
+            stream.report_bytes = stream.bytes_written
+            lines.append('  {}: {:0.1f} kB/s, queue {} (max {}), {} dropped'.format(
+                os.path.basename(stream.path), rate/1e3, stream.depth, stream.max_depth, stream.dropped))
+        for stream in self.failed_streams:
+            lines.append('  {}: FAILED ({!r}), {} dropped'.format(stream.path, stream.error, stream.dropped))
+        return '\n'.join(lines)
+
+    @property
+    def backlog(self):
+        # records waiting to be written, over all streams
+        with self.streamLock:
+            return sum(stream.depth for stream in self.streams)
+
+# one writer is shared by every service of the rig
+_disk_writer = None
+_disk_writer_lock = Lock()
+
+def disk_writer():
+    global _disk_writer
+    with _disk_writer_lock:
+        if _disk_writer is None:
+            _disk_writer = DiskWriter()
+            _disk_writer.start()
+            atexit.register(_disk_writer.stop)
+        return _disk_writer
@@ -1,6 +1,5 @@
 import sys
 import os
-import cv2
 import numpy as np
 from time import strftime, time, sleep
 from threading import Thread, Lock, Event
@@ -34,6 +33,7 @@ from flyvr.stim import StimThread
 from flyvr.trial import TrialThread
 from flyvr.temp import TempMonitor
 from qt.plotting import PlotWindow, ImgWindow
+from qt.scheduler import RefreshScheduler
 from qt.gui import GuiThread
 from rangeslider import QRangeSlider
 
@@ -68,6 +68,7 @@ class MainGui():
         self.trial_duration = None
         self.inter_fly_wait = None
         self.max_inter_fly_wait = 10 * 60 # min*sec
+        self.current_max_inter_fly_wait = self.max_inter_fly_wait
         self.turn_off_time = 2 * 60 * 60 # hr*min*sec
 
         # Fly detection parameters
@@ -204,20 +205,11 @@ class MainGui():
         self.ui.stim_within_trial_button.setEnabled(False)
         self.ui.multi_stim_within_trial_button.setEnabled(False)
 
-        # Create timers for displaying parameters on gui for user to see
-        self.camera_timer = None
-        self.cnc_timer = None
-        self.exp_data_timer = None
-        self.dispenser_data_timer = None
-        self.opto_timer = None
-
-        self.trial_timer = QtCore.QTimer()
-        self.trial_timer.timeout.connect(self.trialTimer)
-        self.trial_timer.start(100)
-
-        self.light_checker_timer = QtCore.QTimer()
-        self.light_checker_timer.timeout.connect(self.gui_update_lights)
-        self.light_checker_timer.start(100)
+        # One scheduler refreshes everything displayed on the gui, from one snapshot of the
+        # service state per tick
+        self.scheduler = RefreshScheduler(snapshot=self.take_snapshot)
+        self.scheduler.add('trial', self.trialTimer, 10)
+        self.scheduler.add('lights', self.gui_update_lights, 10)
 
         # Setup fly position plotter
         self.ui.fly_position_plot_button.clicked.connect(lambda x: self.flyPlotter())
@@ -225,13 +217,53 @@ class MainGui():
         # Start Temp and Humd Reading
         self.temp = TempMonitor()
         self.temp.start()
-        self.temp_timer = QtCore.QTimer()
-        self.temp_timer.timeout.connect(self.temp_display)
-        self.temp_timer.start(1000)
+        self.scheduler.add('temp', self.temp_display, 1)
+
+        self.scheduler.start()
+
+    def take_snapshot(self):
+        snapshot = GuiSnapshot()
+
+        snapshot.tracker_on = self.tracker is not None
+        snapshot.cam_on = self.cam is not None
+        snapshot.opto_on = self.opto is not None
+        snapshot.dispenser_on = self.dispenser is not None
+        snapshot.stim_on = self.stim is not None
+
+        if self.temp is not None:
+            snapshot.temp = self.temp.temp
+            snapshot.humd = self.temp.humd
+
+        try:
+            snapshot.cnc_status = self.tracker.cncThread.status
+        except:
+            pass
+
+        try:
+            snapshot.fly_data = self.cam.flyData
+        except:
+            pass
+
+        if self.opto is not None:
+            snapshot.led_status = self.opto.led_status
+
+        if self.dispenser is not None:
+            snapshot.dispenser_state = self.dispenser.state
+            snapshot.gate_state = self.dispenser.gate_state
+
+        trial = self.trial
+        if trial is not None:
+            snapshot.exp = getattr(trial, 'exp', None)
+            snapshot.trial_num = getattr(trial, 'trial_num', None)
+            snapshot.trial_start_t = getattr(trial, 'trial_start_t', None)
+            snapshot.trial_end_t = getattr(trial, 'trial_end_t', None)
+            snapshot.trial_state = getattr(trial, 'state', None)
 
-    def temp_display(self):
-        self.ui.temp_label.setText('{}C'.format(self.temp.temp))
-        self.ui.humd_label.setText('{}%'.format(self.temp.humd))
+        return snapshot
+
+    def temp_display(self, snapshot):
+        self.ui.temp_label.setText('{}C'.format(snapshot.temp))
+        self.ui.humd_label.setText('{}%'.format(snapshot.humd))
 
     def configure_range_sliders(self):
         self.ar_range = QRangeSlider(self.ui)
@@ -332,6 +364,7 @@ class MainGui():
 
     def stimStart(self):
         self.stim = StimThread()
+        self.stim.start()
         self.ui.stim_stop_button.setEnabled(True)
         self.ui.stim_start_button.setEnabled(False)
         self.ui.stim_per_trial_button.setEnabled(True)
@@ -398,6 +431,9 @@ class MainGui():
                         foragingdict.update({'override time limit at 3cm': 'yes'})
                     if self.opto.allowfoodspotreturns == True:
                         foragingdict.update({'foodspot returns' : 'allowed'})
+                    if self.opto.reward_map_path is not None:
+                        foragingdict.update({'reward map': self.opto.reward_map_path})
+                        foragingdict.update({'reward map resolution (m)': self.opto.reward_map_resolution})
                     foraging_data = self.pretty_json(foragingdict)
 
         data = self.pretty_json(d)
@@ -485,11 +521,13 @@ class MainGui():
         self.ui.open_gate_button.setEnabled(True)
         self.ui.calibrate_gate_button.setEnabled(True)
 
-        self.dispenser_data_timer = QtCore.QTimer()
-        self.dispenser_data_timer.timeout.connect(self.gui_dispenser_info)
-        self.dispenser_data_timer.start(100)
+        self.scheduler.add('dispenser_data', self.gui_dispenser_info, 10)
+        self.scheduler.add('dispenser_view', self.dispenser_view.update_window, 20,
+                           visible=self.dispenser_view.isVisible, snapshot=False)
 
     def dispenserStop(self):
+        self.scheduler.remove('dispenser_data')
+        self.scheduler.remove('dispenser_view')
         self.dispenser_view.close()
         self.dispenser.stop()
         self.dispenser = None
@@ -499,9 +537,6 @@ class MainGui():
         self.ui.open_gate_button.setEnabled(False)
         self.ui.calibrate_gate_button.setEnabled(False)
 
-        if self.dispenser_data_timer is not None:
-            self.dispenser_data_timer.stop()
-
         self.ui.dispenser_status_label.setText('N/A')
 
     def openDispenser(self):
@@ -538,15 +573,10 @@ class MainGui():
         self.ui.cnc_move_center_button.setEnabled(True)
         self.ui.cnc_mark_center_button.setEnabled(True)
 
-        self.cnc_timer = QtCore.QTimer()
-        self.cnc_timer.timeout.connect(self.gui_update_cnc)
-        self.cnc_timer.start(100)
+        self.scheduler.add('cnc', self.gui_update_cnc, 10)
 
-    def gui_update_cnc(self):
-        try:
-            cnc_status = self.tracker.cncThread.status
-        except:
-            return
+    def gui_update_cnc(self, snapshot):
+        cnc_status = snapshot.cnc_status
 
         if cnc_status is not None:
             self.ui.cnc_x_label.setText('{:0.3f}'.format(cnc_status.posX))
@@ -559,6 +589,7 @@ class MainGui():
         self.ui.cnc_y_label.setText('N/A')
 
     def trackerStop(self):
+        self.scheduler.remove('cnc')
         self.tracker.stop()
         self.tracker = None
 
@@ -573,9 +604,6 @@ class MainGui():
         self.ui.cnc_move_center_button.setEnabled(False)
         self.ui.cnc_mark_center_button.setEnabled(False)
 
-        if self.cnc_timer is not None:
-            self.cnc_timer.stop()
-
         self.reset_cnc_data()
 
     def markCenter(self):
@@ -592,6 +620,8 @@ class MainGui():
         self.cam.r_min = self.r_min,
         self.cam.r_max = self.r_max
         self.cam_view = CameraView(self.cam)
+        self.scheduler.add('camera_view', self.cam_view.update_window, self.cam_view.fps,
+                           visible=self.cam_view.isVisible, snapshot=False)
 
         self.ui.camera_start_button.setEnabled(False)
         self.ui.camera_stop_button.setEnabled(True)
@@ -601,15 +631,10 @@ class MainGui():
         self.ma_range.setEnabled(True)
         self.MA_range.setEnabled(True)
 
-        self.camera_timer = QtCore.QTimer()
-        self.camera_timer.timeout.connect(self.gui_update_camera)
-        self.camera_timer.start(100)
+        self.scheduler.add('camera', self.gui_update_camera, 10)
 
-    def gui_update_camera(self):
-        try:
-            fly_data = self.cam.flyData
-        except:
-            return
+    def gui_update_camera(self, snapshot):
+        fly_data = snapshot.fly_data
 
         if fly_data is not None and fly_data.flyPresent:
             self.ui.fly_minor_axis_label.setText('{:0.2f}'.format(fly_data.ma*1e3))
@@ -630,6 +655,8 @@ class MainGui():
         self.ui.fly_angle_label.setText('N/A')
 
     def camStop(self):
+        self.scheduler.remove('camera')
+        self.scheduler.remove('camera_view')
         self.cam_view.close()
 
         self.cam.stop()
@@ -645,9 +672,6 @@ class MainGui():
         self.ma_range.setEnabled(False)
         self.MA_range.setEnabled(False)
 
-        if self.camera_timer is not None:
-            self.camera_timer.stop()
-
         self.reset_fly_data()
 
     def optoStart(self):
@@ -661,12 +685,11 @@ class MainGui():
         self.ui.opto_pulse_button.setEnabled(True)
         self.ui.opto_foraging_button.setEnabled(True)
 
-        self.opto_timer = QtCore.QTimer()
-        self.opto_timer.timeout.connect(self.gui_update_opto)
-        self.opto_timer.start(100)
+        self.scheduler.add('opto', self.gui_update_opto, 10)
 
     def optoStop(self):
-        self.opto_timer.stop()
+        self.scheduler.remove('opto')
+        self.scheduler.remove('foraging_details')
         self.opto.off()
         self.opto.stop()
         self.opto = None
@@ -680,6 +703,8 @@ class MainGui():
     def foraging(self):
         self.opto.foraging = True
         self.foraging_details = ForagingDetails(opto=self.opto)
+        self.scheduler.add('foraging_details', self.foraging_details.update_text, 10,
+                           visible=self.foraging_details.ui.isVisible, snapshot=False)
 
     def experimentStart(self):
         if self.cam is None:
@@ -711,9 +736,7 @@ class MainGui():
             self.ui.stop_trial_button.setEnabled(True)
             self.ui.save_metadata_button.setEnabled(True)
 
-            self.exp_data_timer = QtCore.QTimer()
-            self.exp_data_timer.timeout.connect(self.gui_update_exp_info)
-            self.exp_data_timer.start(100)
+            self.scheduler.add('exp_data', self.gui_update_exp_info, 10)
 
     def experimentStop(self):
         self.trial._stop_trial()
@@ -725,8 +748,7 @@ class MainGui():
         self.ui.stop_trial_button.setEnabled(False)
         self.ui.save_metadata_button.setEnabled(False)
 
-        #if self.exp_data_timer is not None:
-        #    self.exp_data_timer.stop()
+        #self.scheduler.remove('exp_data')
 
         #self.ui.experiment_label.setText('N/A')
         #self.ui.trial_num_label.setText('N/A')
@@ -750,31 +772,11 @@ class MainGui():
         self.ui.start_experiment_button.setEnabled(False)
         self.ui.stop_experiment_button.setEnabled(False)
 
-    def gui_update_exp_info(self):
-        exp = None
-        trial_num = None
-        trial_start_t = None
-        big_rig_status = None
-
-        try:
-            exp = self.trial.exp
-        except:
-            pass
-
-        try:
-            trial_num = self.trial.trial_num
-        except:
-            pass
-
-        try:
-            trial_start_t = self.trial.trial_start_t
-        except:
-            pass
-
-        try:
-            big_rig_status = self.trial.state
-        except:
-            pass
+    def gui_update_exp_info(self, snapshot):
+        exp = snapshot.exp
+        trial_num = snapshot.trial_num
+        trial_start_t = snapshot.trial_start_t
+        big_rig_status = snapshot.trial_state
 
         if exp is not None:
             self.ui.experiment_label.setText('{}'.format(str(exp)))
@@ -812,46 +814,49 @@ class MainGui():
     #    if e.key() == Qt.Key_Escape:
     #        self.close()
 
-    def gui_update_lights(self):
-        if self.tracker is not None:
+    def gui_update_lights(self, snapshot):
+        if snapshot.tracker_on:
             self.ui.cnc_red_light.hide()
         else:
             self.ui.cnc_red_light.show()
 
-        if self.cam is not None:
+        if snapshot.cam_on:
             self.ui.cam_red_light.hide()
         else:
             self.ui.cam_red_light.show()
 
-        if self.opto is not None:
+        if snapshot.opto_on:
             self.ui.opto_red_light.hide()
         else:
             self.ui.opto_red_light.show()
 
-        if self.dispenser is not None:
+        if snapshot.dispenser_on:
             self.ui.dispenser_red_light.hide()
         else:
             self.ui.dispenser_red_light.show()
 
-        if self.stim is not None:
+        if snapshot.stim_on:
             self.ui.stim_red_light.hide()
         else:
             self.ui.stim_red_light.show()
 
-    def gui_update_opto(self):
-        if self.opto.led_status == 'on':
+    def gui_update_opto(self, snapshot):
+        if snapshot.led_status == 'on':
             self.ui.opto_label_on.show()
             self.ui.opto_label_off.hide()
-        elif self.opto.led_status == 'off':
+        elif snapshot.led_status == 'off':
             self.ui.opto_label_off.show()
             self.ui.opto_label_on.hide()
 
-    def gui_dispenser_info(self):
-        self.ui.dispenser_status_label.setText(self.dispenser.state)
-        if self.dispenser.gate_state == 'open':
+    def gui_dispenser_info(self, snapshot):
+        if snapshot.dispenser_state is None:
+            return
+
+        self.ui.dispenser_status_label.setText(snapshot.dispenser_state)
+        if snapshot.gate_state == 'open':
             self.ui.gate_label_open.show()
             self.ui.gate_label_closed.hide()
-        elif self.dispenser.gate_state == 'closed':
+        elif snapshot.gate_state == 'closed':
             self.ui.gate_label_closed.show()
             self.ui.gate_label_open.hide()
 
@@ -869,12 +874,14 @@ class MainGui():
         #     self.message = []
         # else:
         self.flypositionwindow = FlyPositionWindow(cam=self.cam, cnc=self.tracker, opto=self.opto)
+        self.scheduler.add('fly_position', self.flypositionwindow.update_plot, 10,
+                           visible=self.flypositionwindow.isVisible, snapshot=False)
 
-    def trialTimer(self):
-        self.current_max_inter_fly_wait = self.max_inter_fly_wait
+    def trialTimer(self, snapshot):
         if self.trial is not None:
-            if self.trial.trial_end_t is not None:
-                self.inter_fly_wait = self.trial.trial_end_t - time()
+            # only count the wait between trials, i.e. while no trial is running
+            if snapshot.trial_end_t is not None and snapshot.trial_start_t is None:
+                self.inter_fly_wait = time() - snapshot.trial_end_t
 
                 # re-release fly if we've been waiting too long (and keep trying)
                 if self.inter_fly_wait > self.current_max_inter_fly_wait:
@@ -884,30 +891,18 @@ class MainGui():
 
                 #turn everything off if we have been waiting way too long
                 if self.inter_fly_wait > self.turn_off_time:
-                    self.shutdown()
+                    QApplication.instance().quit() # main() calls shutdown once the event loop exits
+            else:
+                self.current_max_inter_fly_wait = self.max_inter_fly_wait
 
         # can add ability to trigger UV light after a trial had gone long or fly hasn't moved
 
     def shutdown(self, app):
         app.exec_()
 
-        # Shutdown timers
-        if self.camera_timer is not None:
-            self.camera_timer.stop()
-        if self.cnc_timer is not None:
-            self.cnc_timer.stop()
-        if self.exp_data_timer is not None:
-            self.exp_data_timer.stop()
-        if self.dispenser_data_timer is not None:
-            self.dispenser_data_timer.stop()
-        if self.trial_timer is not None:
-            self.trial_timer.stop()
-        if self.light_checker_timer is not None:
-            self.light_checker_timer.stop()
-        if self.opto_timer is not None:
-            self.opto_timer.stop()
-        if self.temp_timer is not None:
-            self.temp_timer.stop()
+        # Shutdown gui refreshes
+        self.scheduler.stop()
+        print(self.scheduler.report())
 
         # Shutdown extra views
         if self.dispenser_view is not None:
@@ -926,6 +921,8 @@ class MainGui():
             self.cam_view.close()
         if self.cam is not None:
             self.cam.stop()
+        if self.stim is not None:
+            self.stim.stop()
         if self.dispenser is not None:
             self.dispenser.stop()
         if self.temp is not None:
@@ -950,6 +947,29 @@ class MainGui():
                 print('Disabling closed loop angle...')
                 self.stim.closed_loop_angle = False
 
+class GuiSnapshot():
+    # service state read once per gui refresh tick
+    def __init__(self):
+        self.tracker_on = False
+        self.cam_on = False
+        self.opto_on = False
+        self.dispenser_on = False
+        self.stim_on = False
+
+        self.temp = None
+        self.humd = None
+        self.cnc_status = None
+        self.fly_data = None
+        self.led_status = None
+        self.dispenser_state = None
+        self.gate_state = None
+
+        self.exp = None
+        self.trial_num = None
+        self.trial_start_t = None
+        self.trial_end_t = None
+        self.trial_state = None
+
 class Mail():
     def __init__(self):
         message = None
@@ -1001,10 +1021,12 @@ class CameraView(QWidget):
         self.height = 496
 
         self.cam = cam
+        self.fps = fps
 
-        self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.update_window)
-        self.timer.start(int(1/fps*1000))
+        # the camera thread produces frames at the size and rate that are shown
+        self.cam.requestPreview(self.width, self.height, fps)
+        self.preview_frame = None
+        self.preview_count = 0
 
         self.initUI()
 
@@ -1013,30 +1035,35 @@ class CameraView(QWidget):
         self.setGeometry(self.left, self.top, self.width, self.height)
 
         self.image_label = QtWidgets.QLabel()
+        self.image_label.setScaledContents(True)
         self.main_layout = QtWidgets.QVBoxLayout()
         self.main_layout.addWidget(self.image_label)
+
         self.setLayout(self.main_layout)
 
         self.show()
 
+    def closeEvent(self, event):
+        # the camera thread stops making previews once nothing shows them
+        self.cam.cancelPreview()
+        super().closeEvent(event)
+
     def update_window(self):
         try:
-            img = self.cam.drawFrame
+            img, count = self.cam.preview
         except:
             return
 
-        if img is not None:
+        if img is not None and count != self.preview_count:
+            # keep a reference, since the QImage points at the array's memory
+            self.preview_frame = img
+            self.preview_count = count
+
             height, width, bytesPerComponent = img.shape
-            bytesPerLine = 3 * width
-            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, img)
-            q_img = QtGui.QImage(img.data, width, height, bytesPerLine, QtGui.QImage.Format_RGB888)
+            q_img = QtGui.QImage(img.data, width, height, img.strides[0], QtGui.QImage.Format_RGB888)
             pixmap = QtGui.QPixmap.fromImage(q_img)
             self.image_label.setPixmap(pixmap)
 
-    def close(self):
-        self.timer.stop()
-        super().close()
-
 class DispenserView(QWidget):
     def __init__(self, dispenser, fps=24):
         super().__init__()
@@ -1047,22 +1074,22 @@ class DispenserView(QWidget):
         self.height = 300
 
         self.dispenser = dispenser
-        self.plot_data = np.zeros((128, 128))
-        self.processed_data = np.zeros((128, 128))
+        self.num_rows = 128
 
         # For processed data plot
-        self.start = np.zeros(self.dispenser.gate_start)
         self.gate = np.zeros(self.dispenser.gate_end - self.dispenser.gate_start)
         self.end = np.zeros(128 - self.dispenser.gate_end)
 
         self.gate_markers = np.zeros((128))
         self.gate_markers[self.dispenser.gate_start] = 255
         self.gate_markers[self.dispenser.gate_end] = 255
-        self.whole_plot = np.zeros((129, 128))
 
-        self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.update_window)
-        self.timer.start(50)
+        # Scrolling history of raw (left) and processed (right) frames.  Every row is written
+        # twice, num_rows apart, so that the newest num_rows rows are always one contiguous
+        # block that the displayed image can point at directly; the row just above that block
+        # holds the gate markers.
+        self.ring = np.zeros((2*self.num_rows + 1, 256), dtype=np.uint8)
+        self.ring_row = 1
 
         self.initUI()
 
@@ -1070,9 +1097,24 @@ class DispenserView(QWidget):
         self.setWindowTitle(self.title)
         self.setGeometry(self.left, self.top, self.width, self.height)
 
+        # let the label scale the pixmap when painting rather than rescaling every frame
         self.image_label = QtWidgets.QLabel()
+        self.image_label.setScaledContents(True)
+        self.image_label.setMinimumSize(800, 400)
         self.main_layout = QtWidgets.QVBoxLayout()
         self.main_layout.addWidget(self.image_label)
+
+        # which detector decides gate clear / fly passed
+        self.detector_box = QtWidgets.QComboBox()
+        self.detector_box.addItems(FlyDispenser.DETECTOR_TYPES)
+        self.detector_box.setCurrentText(self.dispenser.detector_type)
+        self.detector_box.currentTextChanged.connect(self.dispenser.set_detector_type)
+        detector_layout = QtWidgets.QHBoxLayout()
+        detector_layout.addWidget(QtWidgets.QLabel('Gate detector:'))
+        detector_layout.addWidget(self.detector_box)
+        detector_layout.addStretch()
+        self.main_layout.addLayout(detector_layout)
+
         self.setLayout(self.main_layout)
 
         self.show()
@@ -1080,13 +1122,13 @@ class DispenserView(QWidget):
     def update_window(self):
         if self.dispenser.display_frame is not None:
 
-            # Create raw display
-            self.plot_data = np.roll(self.plot_data, 1, 0)
-            self.plot_data[0] = self.dispenser.display_frame
-            self.left_plot = np.vstack((self.gate_markers, self.plot_data))
-
             # Create processed display
-            if self.dispenser.prev_frame is not None:
+            if self.dispenser.detector_type == 'rolling':
+                # Pixels that stand out from the rolling background
+                gate_mask, end_mask = self.dispenser.detector.masks()
+                self.gate = gate_mask.astype(int) * 255
+                self.end = end_mask.astype(int) * 255
+            elif self.dispenser.prev_frame is not None:
                 # Process gate to end
                 diff = -np.abs(self.dispenser.raw_data[self.dispenser.gate_end:] - self.dispenser.prev_frame[self.dispenser.gate_end:])
                 self.end = diff < self.dispenser.fly_passed_threshold
@@ -1102,24 +1144,27 @@ class DispenserView(QWidget):
                 else:
                     print(f'background region is {self.dispenser.background_region}')
 
-            processed_frame = np.concatenate((self.start,self.gate,self.end))
-            self.processed_data = np.roll(self.processed_data, 1, 0)
-            self.processed_data[0] = processed_frame
-            self.right_plot = np.vstack((self.gate_markers, self.processed_data))
+            # Move up one row and write the newest raw and processed frames in both copies
+            self.ring_row -= 1
+            if self.ring_row < 1:
+                self.ring_row = self.num_rows
 
-            # Concatenate left and right
-            self.whole_plot = np.hstack((self.left_plot, self.right_plot))
-            self.whole_plot = self.whole_plot.astype(np.uint8)
+            row = np.asarray(self.dispenser.display_frame).astype(np.uint8)
+            g0 = 128 + self.dispenser.gate_start
+            g1 = 128 + self.dispenser.gate_end
+            for k in (self.ring_row, self.ring_row + self.num_rows):
+                self.ring[k, :128] = row
+                self.ring[k, 128:g0] = 0
+                self.ring[k, g0:g1] = self.gate
+                self.ring[k, g1:] = self.end
 
-        img = QtGui.QImage(self.whole_plot, self.whole_plot.shape[1], self.whole_plot.shape[0], QtGui.QImage.Format_Indexed8)
-        pixmap = QtGui.QPixmap.fromImage(img)
-        #pixmap = pixmap.scaledToWidth(800)
-        pixmap = pixmap.scaled(800, 400)
-        self.image_label.setPixmap(pixmap)
+            # gate markers above the newest row on both sides
+            self.ring[self.ring_row - 1, :128] = self.gate_markers
+            self.ring[self.ring_row - 1, 128:] = self.gate_markers
 
-    def close(self):
-        self.timer.stop()
-        super().close()
+        view = self.ring[self.ring_row - 1:self.ring_row + self.num_rows]
+        img = QtGui.QImage(view, view.shape[1], view.shape[0], view.strides[0], QtGui.QImage.Format_Indexed8)
+        self.image_label.setPixmap(QtGui.QPixmap.fromImage(img))
 
 class FlyPositionWindow(QWidget):
     def __init__(self, cam, cnc, opto):
@@ -1137,20 +1182,26 @@ class FlyPositionWindow(QWidget):
 
         self.fly_points = pg.ScatterPlotItem(size=2, pen=pg.mkPen(None), brush=pg.mkBrush(0, 0, 0, 120))
         self.flyplot.addItem(self.fly_points)
-        self.x_plot = []
-        self.y_plot = []
+
+        # whole-trial trajectory in preallocated arrays, doubled in size when full
+        self.x_plot = np.zeros(65536)
+        self.y_plot = np.zeros(65536)
+        self.num_points = 0
+        self.num_plotted = 0
 
         self.food_points = pg.ScatterPlotItem(size=10, pen=pg.mkPen(None), brush=pg.mkBrush(255, 0, 0, 120))
         self.flyplot.addItem(self.food_points)
         self.food_x = []
         self.food_y = []
+        self.food_count = None
 
-
+        # limit num points to plot to maintain fast performance: older points are decimated,
+        # the most recent ones are always drawn
         self.max_vector_length = 1000
+        self.max_decimated_length = 4000
 
-        self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.update_plot)
-        self.timer.start(100)
+        # set by clear_plot, which is called from the trial thread
+        self.should_clear = Event()
 
     def initUI(self):
         self.setWindowTitle(self.title)
@@ -1168,15 +1219,38 @@ class FlyPositionWindow(QWidget):
         self.flyplot.setYRange(-0.4, 0.4, padding=0)
         self.show()
 
+    def append_point(self, x, y):
+        if self.num_points == len(self.x_plot):
+            self.x_plot = np.concatenate((self.x_plot, np.zeros(len(self.x_plot))))
+            self.y_plot = np.concatenate((self.y_plot, np.zeros(len(self.y_plot))))
+        self.x_plot[self.num_points] = x
+        self.y_plot[self.num_points] = y
+        self.num_points += 1
+
+    def plot_points(self):
+        n = self.num_points
+        split = max(n - self.max_vector_length, 0)
+
+        # power-of-two stride, so that the decimated points don't jump around as points are added
+        stride = 1
+        while split > stride*self.max_decimated_length:
+            stride *= 2
+
+        x = np.concatenate((self.x_plot[:split:stride], self.x_plot[split:n]))
+        y = np.concatenate((self.y_plot[:split:stride], self.y_plot[split:n]))
+        self.fly_points.setData(x, y)
+        self.num_plotted = n
+
     def update_plot(self):
+        if self.should_clear.is_set():
+            self.should_clear.clear()
+            self.num_points = 0
+            self.food_count = None
+            self.plot_points()
+
         self.flyX = None
         self.flyY = None
 
-        # limit num points to plot to maintain fast performance
-        if len(self.x_plot) > self.max_vector_length:
-            self.x_plot = self.x_plot[1:]
-            self.y_plot = self.y_plot[1:]
-
         if self.camThread is not None and self.camThread.fly is not None:
             camX = self.camThread.fly.centerX
             camY = self.camThread.fly.centerY
@@ -1199,20 +1273,24 @@ class FlyPositionWindow(QWidget):
             self.flyY = None
 
         if self.flyY is not None and self.flyX is not None:
-            self.x_plot.append((self.flyX - self.cncThread.center_pos_x)*-1) #-1 to flip x-axis
-            self.y_plot.append((self.flyY - self.cncThread.center_pos_y))
-            self.fly_points.setData(self.x_plot, self.y_plot)
+            self.append_point((self.flyX - self.cncThread.center_pos_x)*-1, #-1 to flip x-axis
+                              (self.flyY - self.cncThread.center_pos_y))
 
+        if self.num_points != self.num_plotted:
+            self.plot_points()
+
+        # food spots only change when the fly finds food
         if self.opto is not None:
-            self.food_x = [((food['x'] - self.cncThread.center_pos_x)*-1) for food in self.opto.foodspots] #-1 to flip x-axis
-            self.food_y = [(food['y'] - self.cncThread.center_pos_y) for food in self.opto.foodspots]
-            self.food_points.setData(self.food_x, self.food_y)
+            foodspots = self.opto.foodspots
+            if len(foodspots) != self.food_count:
+                self.food_x = [((food['x'] - self.cncThread.center_pos_x)*-1) for food in foodspots] #-1 to flip x-axis
+                self.food_y = [(food['y'] - self.cncThread.center_pos_y) for food in foodspots]
+                self.food_points.setData(self.food_x, self.food_y)
+                self.food_count = len(foodspots)
 
     def clear_plot(self):
-        self.x_plot = []
-        self.y_plot = []
-        self.food_x = []
-        self.food_y = []
+        # the plot itself is cleared on the GUI thread
+        self.should_clear.set()
 
 class ForagingDetails():
     def __init__(self, opto):
@@ -1220,10 +1298,6 @@ class ForagingDetails():
         self.ui = uic.loadUi('foraging.ui')
         self.ui.show()
 
-        self.text_update_timer = QtCore.QTimer()
-        self.text_update_timer.timeout.connect(self.update_text)
-        self.text_update_timer.start(100)
-
         # Setup checkboxes for what food creation parameters to use
         self.ui.min_food_distance_checkbox.stateChanged.connect(lambda x: self.foodDistance())
         self.ui.min_fly_dist_from_center_checkbox.stateChanged.connect(lambda x: self.flyDistance())
@@ -1414,6 +1488,9 @@ class ForagingDetails():
 
     def update_text(self):
 
+        # path metrics are read once, so the labels below agree with each other
+        trajectory = self.opto.trajectory.snapshot
+
         ### Display food data ###
 
         self.ui.num_food_label.setText('{}'.format(len(self.opto.foodspots)))
@@ -1441,8 +1518,8 @@ class ForagingDetails():
             self.ui.last_food_x_label.setText('None')
             self.ui.last_food_y_label.setText('None')
 
-        if self.opto.total_distance is not None:
-            self.ui.total_path_label.setText('{:0.0f}mm'.format(self.opto.total_distance *1000)) #*100 cm
+        if trajectory.total_distance is not None:
+            self.ui.total_path_label.setText('{:0.0f}mm'.format(trajectory.total_distance *1000)) #*100 cm
         else:
             self.ui.total_path_label.setText('None')
 
@@ -1463,7 +1540,7 @@ class ForagingDetails():
         else:
             self.ui.time_since_food_met_label.setText('False')
 
-        if self.opto.fly_moving:
+        if trajectory.moving:
             self.ui.fly_moving_met_label.setText('True')
         else:
             self.ui.fly_moving_met_label.setText('False')
@@ -1514,8 +1591,8 @@ class ForagingDetails():
         else:
             self.ui.time_since_food_label.setText('N/A')
 
-        if self.opto.distance_since_last_food is not None:
-            self.ui.current_path_distance_label.setText('{:0.0f}mm'.format(self.opto.distance_since_last_food*1000)) #100
+        if trajectory.distance_since_last_food is not None:
+            self.ui.current_path_distance_label.setText('{:0.0f}mm'.format(trajectory.distance_since_last_food*1000)) #100
         else:
             self.ui.current_path_distance_label.setText('N/A')
 
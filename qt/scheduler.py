@@ -0,0 +1,92 @@
+from time import time
+
+from PyQt5 import QtCore
+
+from flyvr.util import LatencyStats
+
+class ScheduledRefresh:
+    def __init__(self, callback, rate, visible=None, snapshot=True):
+        self.callback = callback
+        self.period = 1.0/rate
+        self.visible = visible
+        self.snapshot = snapshot
+        self.last_t = 0
+        self.run_time = LatencyStats()
+
+class RefreshScheduler:
+    # One timer drives every periodic GUI update.  Each refresh declares its own rate, refreshes
+    # of hidden windows are skipped, and the service state shown by the main window is read
+    # once per tick through the snapshot function rather than by every refresh on its own.
+    def __init__(self, snapshot=None, report_interval=None):
+        self.snapshot = snapshot
+        self.report_interval = report_interval
+
+        self.refreshes = {}
+        self.frame_time = LatencyStats()
+        self.last_report_t = time()
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.tick)
+
+    def add(self, name, callback, rate, visible=None, snapshot=True):
+        # callback(snapshot) is called about rate times per second, or callback() if snapshot
+        # is False.  visible is an optional function; the refresh is skipped if it returns False
+        self.refreshes[name] = ScheduledRefresh(callback, rate, visible=visible, snapshot=snapshot)
+        self.update_interval()
+
+    def remove(self, name):
+        if name in self.refreshes:
+            del self.refreshes[name]
+            self.update_interval()
+
+    def update_interval(self):
+        # tick as fast as the fastest refresh needs
+        if len(self.refreshes) > 0:
+            self.interval = min(refresh.period for refresh in self.refreshes.values())
+            self.timer.setInterval(int(self.interval*1000))
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def tick(self):
+        tick_start = time()
+
+        # half a tick of slack, so that refreshes slower than the tick rate don't drift
+        due = []
+        for refresh in self.refreshes.values():
+            if (tick_start - refresh.last_t) < (refresh.period - 0.5*self.interval):
+                continue
+            if refresh.visible is not None and not refresh.visible():
+                continue
+            due.append(refresh)
+
+        if len(due) == 0:
+            return
+
+        snapshot = None
+        if self.snapshot is not None and any(refresh.snapshot for refresh in due):
+            snapshot = self.snapshot()
+
+        for refresh in due:
+            refresh.last_t = tick_start
+            t0 = time()
+            if refresh.snapshot:
+                refresh.callback(snapshot)
+            else:
+                refresh.callback()
+            refresh.run_time.add(time() - t0)
+
+        self.frame_time.add(time() - tick_start)
+
+        if self.report_interval is not None and (tick_start - self.last_report_t) > self.report_interval:
+            print(self.report())
+            self.last_report_t = tick_start
+
+    def report(self):
+        lines = ['GUI frame time: {}'.format(self.frame_time)]
+        for name, refresh in self.refreshes.items():
+            lines.append('  {}: {}'.format(name, refresh.run_time))
+        return '\n'.join(lines)
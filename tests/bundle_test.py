@@ -0,0 +1,71 @@
+import os.path
+import tempfile
+import json
+import numpy as np
+
+from time import time, perf_counter
+
+from flyvr.bundle import bundle_trial, load_bundle
+
+def write_fake_trial(trial_dir, duration=30*60, cam_rate=124.2, cnc_rate=80, seed=0):
+    # logs in the formats the rig writes, for a trial of the given duration
+    rng = np.random.RandomState(seed)
+    t0 = time()
+
+    n = int(duration*cam_rate)
+    t = t0 + np.arange(n)/cam_rate
+    np.savetxt(os.path.join(trial_dir, 'cam.txt'), np.column_stack((t, rng.randn(n, 3))), delimiter=',',
+               header='t,x,y,angle', comments='', fmt='%.17g')
+
+    n = int(duration*cnc_rate)
+    t = t0 + np.arange(n)/cnc_rate
+    np.savetxt(os.path.join(trial_dir, 'cnc.txt'), np.column_stack((t, rng.randn(n, 2))), delimiter=',',
+               header='t,x,y', comments='', fmt='%.17g')
+
+    t = t0 + np.arange(duration)
+    np.savetxt(os.path.join(trial_dir, 'temp.txt'), np.column_stack((t, 22 + rng.randn(duration), 40 + rng.randn(duration))),
+               delimiter=',', header='t,temp,humd', comments='', fmt='%0.2f')
+
+    with open(os.path.join(trial_dir, 'opto.txt'), 'w') as f:
+        f.write('time, LED Status\n')
+        for k in range(0, duration, 5):
+            f.write('{}, {}, {}\n'.format('led', t0 + k, 'on' if k % 10 else 'off'))
+            f.write('{}, {}, {}, {}\n'.format('food', t0 + k + 0.5, rng.randn(), rng.randn()))
+
+    with open(os.path.join(trial_dir, 'stimuli.jsonl'), 'w') as f:
+        for k in range(0, duration, 20):
+            f.write(json.dumps({'t': t0 + k, 'event': 'UpdateStim', 'params': {'rate': 100}}) + '\n')
+
+def run(trial_dir):
+    write_fake_trial(trial_dir)
+
+    t_start = perf_counter()
+    cam = np.loadtxt(os.path.join(trial_dir, 'cam.txt'), delimiter=',', skiprows=1, ndmin=2)
+    cnc = np.loadtxt(os.path.join(trial_dir, 'cnc.txt'), delimiter=',', skiprows=1, ndmin=2)
+    text_time = perf_counter() - t_start
+
+    bundle_trial(trial_dir)
+
+    t_start = perf_counter()
+    bundle = load_bundle(trial_dir)
+    cam_x = bundle['cam/x']
+    cnc_x = bundle['cnc/x']
+    # touch every value, so that the time includes reading the data
+    cam_x.sum()
+    cnc_x.sum()
+    bundle_time = perf_counter() - t_start
+
+    assert np.array_equal(np.asarray(cam_x), cam[:, 1])
+    assert np.array_equal(np.asarray(cnc_x), cnc[:, 1])
+    assert np.allclose(bundle['cam/t'] + bundle.meta['t0'], cam[:, 0])
+
+    print('Streams: {}'.format(', '.join('{} ({})'.format(name, info['length'])
+                                         for name, info in bundle.meta['streams'].items())))
+    print('Text load: {:0.1f} ms, bundle load: {:0.1f} ms'.format(text_time*1e3, bundle_time*1e3))
+
+def main():
+    with tempfile.TemporaryDirectory() as trial_dir:
+        run(trial_dir)
+
+if __name__ == '__main__':
+    main()
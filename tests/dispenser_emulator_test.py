@@ -0,0 +1,63 @@
+import os.path
+import tempfile
+
+from time import time, sleep
+
+from flyvr.dispenser import FlyDispenser
+from flyvr.emulator import DispenserEmulator
+
+def wait_for(condition, timeout):
+    t0 = time()
+    while time() - t0 < timeout:
+        if condition():
+            return True
+        sleep(1e-3)
+    return False
+
+def main(num_flies=5, timeout=10, detector_type='snapshot'):
+    # one scripted fly per release
+    passages = [{'delay': 0.8, 'speed': 150 + 50*k, 'width': 3, 'contrast': 40} for k in range(num_flies)]
+    emulator = DispenserEmulator(passages=passages)
+    emulator.start()
+
+    log_dir = tempfile.mkdtemp()
+    dispenser = FlyDispenser(serial_port=emulator.port,
+                             background_region_file=os.path.join(log_dir, 'background_region.npy'))
+    dispenser.set_detector_type(detector_type)
+    dispenser.start_logging(log_dir)
+    dispenser.start()
+
+    # let the dispenser go through Reset
+    wait_for(lambda: dispenser.state == 'Idle', timeout)
+
+    num_ok = 0
+    for k in range(num_flies):
+        t0 = time()
+        dispenser.release_fly()
+
+        # gate should open, then close again once the fly has gone through
+        opened = wait_for(lambda: emulator.gate_state == 'open', timeout)
+        closed = opened and wait_for(lambda: emulator.gate_state == 'closed', timeout)
+
+        if closed:
+            num_ok += 1
+            print('Fly {}: gate cycled in {:0.2f} s'.format(k+1, time()-t0))
+        else:
+            print('Fly {}: gate did not cycle (state {})'.format(k+1, dispenser.state))
+            dispenser.close_gate()
+            wait_for(lambda: emulator.gate_state == 'closed', timeout)
+
+        sleep(0.2)
+
+    dispenser.stop()
+    dispenser.stop_logging()
+    emulator.stop()
+
+    print('{}/{} flies dispensed'.format(num_ok, num_flies))
+    print('Emulator frames sent: {}, dropped: {}'.format(emulator.frames_sent, emulator.frames_dropped))
+    print('Logs in {}'.format(log_dir))
+
+if __name__ == '__main__':
+    for detector_type in FlyDispenser.DETECTOR_TYPES:
+        print('Detector: {}'.format(detector_type))
+        main(detector_type=detector_type)
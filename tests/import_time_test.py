@@ -0,0 +1,41 @@
+import sys
+import subprocess
+
+# modules in the order they are usually imported; each is timed in a fresh interpreter so that
+# nothing is already cached by an earlier import
+MODULES = ['flyvr.util', 'flyvr.service', 'flyvr.npylog', 'flyvr.passage', 'flyvr.emulator',
+           'flyvr.dispenser', 'flyvr.cnc', 'flyvr.tracker', 'flyvr.temp', 'flyvr.camera',
+           'flyvr.stim', 'flyvr.trial', 'flyvr.opto', 'flyvr.bootstrap', 'flyvr.headless']
+
+# modules that should only be loaded once a device actually uses them
+HEAVY = ['cv2', 'pypylon', 'vrcam', 'flystim', 'flyrpc', 'matplotlib', 'PyQt5']
+
+def import_time(module):
+    # returns the cumulative import time in seconds and the heavy modules that were loaded
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception('Could not import {}:\n{}'.format(module, result.stderr))
+
+    total = None
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if name == module:
+            total = int(cumulative)*1e-6
+        if name.split('.')[0] in HEAVY:
+            loaded.add(name.split('.')[0])
+
+    return total, sorted(loaded)
+
+def main():
+    print('{:20s} {:>10s}  {}'.format('module', 'time (ms)', 'heavy modules loaded'))
+    for module in MODULES:
+        total, loaded = import_time(module)
+        print('{:20s} {:10.1f}  {}'.format(module, total*1e3, ', '.join(loaded) if loaded else '-'))
+
+if __name__ == '__main__':
+    main()
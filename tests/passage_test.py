@@ -0,0 +1,95 @@
+import numpy as np
+
+from flyvr.passage import PassageDetector
+
+GATE_START = 40
+GATE_END = 60
+
+def background(rng, level=100, noise=2.0):
+    return level + noise*rng.randn(128)
+
+def with_blob(frame, center, width=3, contrast=-40):
+    # dark fly over the given pixels
+    frame = frame.copy()
+    frame[max(center - width//2, 0):center + width//2 + 1] += contrast
+    return frame
+
+def test_warmup():
+    rng = np.random.RandomState(0)
+    detector = PassageDetector(gate_start=GATE_START, gate_end=GATE_END, warmup_frames=20)
+
+    # nothing is decided until the background has been estimated
+    for k in range(19):
+        detector.update(background(rng))
+        assert not detector.warmed_up
+        assert not detector.gate_clear and not detector.fly_passed
+
+    # a fly passing during warm-up does not end up in the background (median)
+    detector.update(with_blob(background(rng), 70))
+    assert detector.warmed_up
+    assert abs(detector.mean[70] - 100) < 5
+    print('Warm-up OK')
+
+def test_background_update():
+    rng = np.random.RandomState(1)
+    detector = PassageDetector(gate_start=GATE_START, gate_end=GATE_END, warmup_frames=20, alpha=0.02)
+    for k in range(20):
+        detector.update(background(rng))
+
+    # background only: gate clear, nothing passing
+    for k in range(50):
+        detector.update(background(rng))
+        assert detector.gate_clear and not detector.fly_passed
+        assert detector.gate_count < 2 and detector.passed_count < 3
+
+    # slow drift of the lighting is followed
+    for k in range(500):
+        detector.update(background(rng, level=100 + 5*k/500))
+    assert abs(np.mean(detector.mean) - 105) < 1
+    assert detector.gate_clear and not detector.fly_passed
+
+    # a fly standing still in the gate is not folded into the background
+    frame = with_blob(background(rng, level=105), 50)
+    for k in range(200):
+        detector.update(frame + 2.0*rng.randn(128))
+        assert not detector.gate_clear
+    print('Background update OK')
+
+def test_moving_blob():
+    rng = np.random.RandomState(2)
+    detector = PassageDetector(gate_start=GATE_START, gate_end=GATE_END, warmup_frames=20)
+    for k in range(40):
+        detector.update(background(rng))
+
+    # a fly walks from the start of the tunnel to the end, one pixel per frame
+    gate_frames = 0
+    passed_frames = 0
+    for center in range(5, 124):
+        detector.update(with_blob(background(rng), center))
+
+        in_gate = GATE_START <= center < GATE_END
+        past_gate = center - 1 >= GATE_END
+        if in_gate:
+            assert detector.gate_count >= 2 and not detector.gate_clear
+            gate_frames += 1
+        if past_gate:
+            assert detector.passed_count >= 3 and detector.fly_passed
+            passed_frames += 1
+        if center < GATE_START - 1:
+            assert detector.gate_clear and not detector.fly_passed
+
+    assert gate_frames == GATE_END - GATE_START and passed_frames > 0
+
+    # once it has left, the tunnel is clear again
+    for k in range(5):
+        detector.update(background(rng))
+    assert detector.gate_clear and not detector.fly_passed
+    print('Moving blob: {} frames in the gate, {} past it'.format(gate_frames, passed_frames))
+
+def main():
+    test_warmup()
+    test_background_update()
+    test_moving_blob()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+from math import cos, sin, pi
+from time import time
+
+from flyvr.trial import TrialThread
+from flyvr.stim import StimThread
+
+class FakeManager:
+    # stands in for the stimulus server; nothing is sent in this test
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class FakeFly:
+    def __init__(self, centerX, centerY, angle):
+        self.centerX = centerX
+        self.centerY = centerY
+        self.angle = angle
+
+class FakeStatus:
+    posX = 0.0
+    posY = 0.0
+
+class FakeCnc:
+    status = FakeStatus()
+
+class FakeCam:
+    fly_sample = (None, None)
+
+def make_trial(cam, stim):
+    # only the attributes used by post_pose; the full constructor creates experiment directories
+    trial = TrialThread.__new__(TrialThread)
+    trial.cam = cam
+    trial.cnc = FakeCnc()
+    trial.stim = stim
+    trial._trial_dir = None
+    return trial
+
+def main(fps=124.2, radius=5e-3, period=2.0, duration=4.0):
+    # fly walking in a circle, heading along its path, as the camera thread would report it
+    cam = FakeCam()
+    stim = StimThread(manager=FakeManager())
+    trial = make_trial(cam, stim)
+
+    t0 = time() - duration
+    n = int(duration*fps)
+    for k in range(n):
+        t = t0 + k/fps
+        phase = 2*pi*t/period
+        cam.fly_sample = (FakeFly(radius*cos(phase), radius*sin(phase), (phase + pi/2) % (2*pi)), t)
+        trial.post_pose()
+        predicted = stim.extrapolator.predict(t + stim.render_latency)
+        assert predicted is not None and predicted[2] is not None
+
+    extrapolator = stim.extrapolator
+    assert extrapolator.pos_error.count > 0 and extrapolator.angle_error.count > 0
+    print('Extrapolated: {}, {}'.format(extrapolator.pos_error, extrapolator.angle_error))
+    print('Latest pose: {}, {}'.format(extrapolator.held_pos_error, extrapolator.held_angle_error))
+    assert extrapolator.pos_error.mean < extrapolator.held_pos_error.mean
+
+    # the stimulus gets degrees: 180 minus the camera angle
+    fly, _ = cam.fly_sample
+    assert abs(trial.get_fly_angle(fly) - (180 - fly.angle*180/pi)) < 1e-9
+
+    # without an angle estimate the position is still extrapolated
+    extrapolator.reset()
+    for k in range(10):
+        t = t0 + k/fps
+        extrapolator.add(t, 1e-3*k, 0, None)
+    predicted = extrapolator.predict(t + 1/fps)
+    assert predicted[2] is None and abs(predicted[0] - 1e-3*10) < 1e-6
+    print('Position-only samples kept: {}'.format(len(extrapolator.samples)))
+
+    # poses are stale by the age of their camera frame, not by how long they waited to be sent
+    stale = stim.stale_count
+    stim.send_pose((time() - 2*stim.max_pose_age, 0, 0, 0))
+    assert stim.stale_count == stale + 1
+    print('Stale pose from an old frame dropped.')
+
+if __name__ == '__main__':
+    main()
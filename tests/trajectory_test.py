@@ -0,0 +1,77 @@
+import numpy as np
+
+from math import pi, cos, sin
+
+from flyvr.trajectory import TrajectoryMetrics
+
+def walk(metrics, speed, duration, t0, x0, tick=5e-3):
+    # straight walk along x at a constant speed; returns the end time and position
+    n = int(round(duration/tick))
+    for k in range(1, n+1):
+        metrics.update(x0 + speed*k*tick, 0, t0 + k*tick)
+    return t0 + n*tick, x0 + speed*n*tick
+
+def test_path_length(radius=0.02, laps=20, tick=5e-3, period=10.0):
+    # path length of a circle, in constant memory however long the walk is
+    metrics = TrajectoryMetrics(min_step=5e-3)
+    n = int(laps*period/tick)
+    for k in range(n+1):
+        t = k*tick
+        phase = 2*pi*t/period
+        metrics.update(radius*cos(phase), radius*sin(phase), t)
+
+        if k == 1000:
+            names = set(vars(metrics))
+
+    # nothing grows with the number of samples: the same attributes, all of them scalars
+    assert set(vars(metrics)) == names
+    assert all(np.isscalar(value) or value is None for _, value in vars(metrics).items())
+
+    # 5 mm chords of the circle, so slightly shorter than its circumference
+    expected = laps*2*pi*radius
+    assert 0.97*expected < metrics.total_distance <= expected
+    print('Path length: {:0.1f} mm (circle {:0.1f} mm)'.format(metrics.total_distance*1e3, expected*1e3))
+
+    # distance since food restarts at food
+    metrics.mark_food()
+    assert metrics.distance_since_last_food == 0
+
+def test_hysteresis():
+    metrics = TrajectoryMetrics(moving_on_speed=2e-3, moving_off_speed=1e-3)
+    t, x = 0, 0
+    metrics.update(x, 0, t)
+
+    # tracking jitter on a standing fly is not movement
+    rng = np.random.RandomState(0)
+    for k in range(1, 1000):
+        t = k*5e-3
+        metrics.update(rng.randn()*50e-6, rng.randn()*50e-6, t)
+    assert not metrics.moving
+    print('Standing with jitter: {:0.2f} mm/s'.format(metrics.speed*1e3))
+
+    # speed between the thresholds does not start movement
+    t, x = walk(metrics, 1.5e-3, 3, t, 0)
+    assert not metrics.moving
+
+    # above the on threshold it does
+    t, x = walk(metrics, 5e-3, 3, t, x)
+    assert metrics.moving
+
+    # between the thresholds the fly still counts as moving
+    t, x = walk(metrics, 1.5e-3, 3, t, x)
+    assert metrics.moving
+
+    # below the off threshold it stops
+    t, x = walk(metrics, 0.2e-3, 3, t, x)
+    assert not metrics.moving
+
+    snapshot = metrics.snapshot
+    assert snapshot.moving == metrics.moving and snapshot.total_distance == metrics.total_distance
+    print('Hysteresis edges OK')
+
+def main():
+    test_path_length()
+    test_hysteresis()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from time import time, sleep
+
+from flyvr.trial import TrialThread
+
+class FakeCam:
+    flyPresent = False
+
+class FakeTracker:
+    def startTracking(self):
+        pass
+
+    def stopTracking(self):
+        pass
+
+class FakeLog:
+    def __init__(self):
+        self.rows = []
+
+    def append(self, row):
+        self.rows.append(row)
+
+def make_trial(fly_detected_timeout, fly_lost_timeout):
+    # only the state machine; the full constructor creates experiment directories
+    trial = TrialThread.__new__(TrialThread)
+    trial.state = 'started'
+    trial.prev_state = 'started'
+    trial.cam = FakeCam()
+    trial.tracker = FakeTracker()
+    trial.dispenser = None
+    trial.stim = None
+    trial.fly_detected_timeout = fly_detected_timeout
+    trial.fly_lost_timeout = fly_lost_timeout
+    trial.loopTime = 10e-3
+    trial.transitionLog = FakeLog()
+    trial.init_state_machine()
+    return trial
+
+def run_for(trial, duration):
+    t0 = time()
+    while (time() - t0) < duration:
+        trial.loopBody()
+
+def set_fly(trial, present):
+    # what the camera thread does on a fly present/absent edge
+    trial.cam.flyPresent = present
+    trial.post('fly_present' if present else 'fly_absent')
+    run_for(trial, 20e-3)
+
+def main():
+    trial = make_trial(fly_detected_timeout=0.2, fly_lost_timeout=1.0)
+
+    # the fly shows up, then leaves before it is confirmed
+    set_fly(trial, True)
+    assert trial.state == 'fly detected' and 'detect_timeout' in trial.timers
+    set_fly(trial, False)
+    assert trial.state == 'fly lost'
+    assert 'detect_timeout' not in trial.timers and 'lost_timeout' in trial.timers
+
+    # wait past the old detection deadline: nothing happens
+    run_for(trial, 0.4)
+    assert trial.state == 'fly lost'
+
+    # the fly comes back, and the lost deadline doesn't follow it into the detected state
+    set_fly(trial, True)
+    assert trial.state == 'fly detected' and 'lost_timeout' not in trial.timers
+
+    states = [TrialThread.STATES[row[2]] for row in trial.transitionLog.rows]
+    assert states == ['fly detected', 'fly lost', 'fly detected']
+    print('Transitions: {}'.format(' -> '.join(['started'] + states)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os.path
+import tempfile
+import numpy as np
+
+from time import sleep
+
+from flyvr.writer import DiskWriter
+
+class FailingVideoWriter:
+    # stands in for a cv2.VideoWriter whose encoder fails after a few frames
+    def __init__(self, fail_after):
+        self.count = 0
+        self.fail_after = fail_after
+
+    def write(self, frame):
+        self.count += 1
+        if self.count > self.fail_after:
+            raise Exception('encoder failed')
+
+    def release(self):
+        pass
+
+class CountingVideoWriter:
+    def __init__(self):
+        self.count = 0
+
+    def write(self, frame):
+        self.count += 1
+
+    def release(self):
+        pass
+
+class SlowVideoWriter:
+    def write(self, frame):
+        sleep(10e-3)
+
+    def release(self):
+        pass
+
+def main():
+    with tempfile.TemporaryDirectory() as dir:
+        writer = DiskWriter(flush_interval=0.05)
+        writer.start()
+
+        # a failing stream is dropped without stopping the others
+        text = writer.open_text(os.path.join(dir, 'log.txt'), header='t\n')
+        video = writer.add_video(os.path.join(dir, 'video.mkv'), FailingVideoWriter(fail_after=5))
+        frame = np.zeros((4, 4, 3), dtype=np.uint8)
+        for k in range(20):
+            text.write('{}\n'.format(k))
+            video.write(frame)
+            sleep(10e-3)
+        text.close()
+        assert writer.wait_closed(text)
+
+        with open(os.path.join(dir, 'log.txt'), 'r') as f:
+            assert len(f.readlines()) == 21
+        assert video.failed and video not in writer.streams
+        assert not video.write(frame) and len(video.queue) == 0
+        print('Failed stream: {!r}, {} frames dropped'.format(video.error, video.dropped))
+
+        # frames beyond max_queue are dropped when encoding falls behind
+        video = writer.add_video(os.path.join(dir, 'slow.mkv'), SlowVideoWriter(), max_queue=10)
+        written = sum(video.write(frame) for k in range(100))
+        # the writer may take one batch off the queue while the frames are written
+        assert written <= 2*10 + 1 and video.dropped == 100 - written
+        print('Slow encoder: {} frames queued, {} dropped'.format(written, video.dropped))
+        video.release()
+        assert writer.wait_closed(video)
+
+        # a burst larger than the flush interval can hold is kept when encoding keeps up: the
+        # writer is woken once the queue is half full
+        writer.flush_interval = 0.5
+        video = writer.add_video(os.path.join(dir, 'burst.mkv'), CountingVideoWriter(), max_queue=128)
+        for k in range(250):
+            for j in range(4):
+                video.write(frame)
+            sleep(2e-3)
+        video.release()
+        assert writer.wait_closed(video)
+        assert video.dropped == 0 and video.video_writer.count == 1000
+        print('Burst: {} frames written, max queue {}'.format(video.video_writer.count, video.max_depth))
+
+        writer.stop()
+
+if __name__ == '__main__':
+    main()